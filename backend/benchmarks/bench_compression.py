@@ -0,0 +1,50 @@
+"""
+Bytes on the wire and time of GET /questions per page size (?per_page=) and Accept-Encoding:
+identity, gzip and brotli (if the brotli package is installed), with the page built in memory (jsonify)
+and streamed (stream_json_object), and the time spent compressing the body alone.
+
+    python -m benchmarks.bench_compression [number_of_questions]
+"""
+import os
+import sys
+import tempfile
+
+from flaskr import create_app
+from flaskr.compression import compress, brotli
+from benchmarks.common import seed_questions, measure, print_row
+
+PAGE_SIZES = [10, 100, 1000]
+# the pages are read by two apps (buffered and streamed), so they need a database file they can share
+DATABASE_FILE = os.path.join(tempfile.gettempdir(), 'trivia_bench_compression.db')
+DATABASE_PATH = 'sqlite:///' + DATABASE_FILE
+
+
+def create_client(stream_min_questions):
+    return create_app({'SQLALCHEMY_DATABASE_URI': DATABASE_PATH, 'DATABASE_INIT': 'manual', 'RESPONSE_CACHE_SECONDS': 0,
+                       'MAX_QUESTIONS_PER_PAGE': max(PAGE_SIZES), 'STREAM_MIN_QUESTIONS': stream_min_questions}).test_client()
+
+
+def main(number_of_questions):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': DATABASE_PATH, 'DATABASE_INIT': 'eager'})
+    with app.app_context():
+        seed_questions(number_of_questions)
+    buffered_client = create_client(stream_min_questions=number_of_questions + 1)
+    streamed_client = create_client(stream_min_questions=1)
+    encodings = ['identity', 'gzip', 'br'] if brotli is not None else ['identity', 'gzip']
+    print('{} questions'.format(number_of_questions))
+    print_row('page size', 'encoding', 'bytes on the wire', 'buffered p50/p99 ms', 'streamed p50/p99 ms', 'compress only p50/p99 ms')
+    for page_size in PAGE_SIZES:
+        path = '/questions?per_page={}&page=2'.format(page_size)
+        body = buffered_client.get(path).get_data()
+        for encoding in encodings:
+            headers = {'Accept-Encoding': encoding}
+            bytes_on_the_wire = len(buffered_client.get(path, headers=headers).get_data())
+            buffered = measure(lambda: buffered_client.get(path, headers=headers).get_data())
+            streamed = measure(lambda: streamed_client.get(path, headers=headers).get_data())
+            compress_only = measure(lambda: compress(body, encoding)) if encoding != 'identity' else (0, 0)
+            print_row(page_size, encoding, bytes_on_the_wire, *['{:.3f} / {:.3f}'.format(p50, p99) for p50, p99 in [buffered, streamed, compress_only]])
+    os.remove(DATABASE_FILE)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,61 @@
+"""
+Compares the old POST /quizzes selection (load every question of the category, or of the whole table for "ALL",
+filter out previous_questions with a list membership test, random.choice) with the decks of QuizQuestionSelector,
+and with the adaptive mode (a question of a given difficulty, dealt from the (category, difficulty) decks),
+and prints how much memory the decks take.
+
+    python -m benchmarks.bench_quiz_selection [number_of_questions ...]
+"""
+import random
+import sys
+
+from models import db, Question
+from flaskr.quiz import QuizQuestionSelector
+from benchmarks.common import create_benchmark_app, seed_questions, measure, print_row
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+# how many questions the player has already been asked
+NUMBER_OF_PREVIOUS_QUESTIONS = 20
+
+
+def pick_question_by_loading_the_category(category_id, previous_questions):
+    list_of_all_questions = Question.query.filter(Question.category == category_id).all()
+    list_of_not_asked_questions = [question for question in list_of_all_questions if question.id not in previous_questions]
+    return None if len(list_of_not_asked_questions) == 0 else random.choice(list_of_not_asked_questions)
+
+
+def pick_question_by_loading_every_question(previous_questions):
+    list_of_all_questions = Question.query.order_by(Question.id).all()
+    list_of_not_asked_questions = [question for question in list_of_all_questions if question.id not in previous_questions]
+    return None if len(list_of_not_asked_questions) == 0 else random.choice(list_of_not_asked_questions)
+
+
+# bytes held by the id arrays of the selector
+def deck_memory(selector):
+    arrays = [selector.category_by_id, selector.difficulty_by_id, selector.all_questions.ids] \
+        + [deck.ids for deck in selector.decks_by_category.values()] + [deck.ids for deck in selector.decks_by_difficulty.values()]
+    return sum(ids.itemsize * len(ids) for ids in arrays)
+
+
+def main(sizes):
+    app = create_benchmark_app()
+    with app.app_context():
+        print_row('questions', 'load category (p50/p99 ms)', 'deck (p50/p99 ms)', 'load ALL (p50/p99 ms)', 'ALL deck (p50/p99 ms)', 'difficulty (p50/p99 ms)', 'deck memory (MB)')
+        for number_of_questions in sizes:
+            seed_questions(number_of_questions)
+            previous_questions = random.sample(range(1, number_of_questions + 1), NUMBER_OF_PREVIOUS_QUESTIONS)
+            selector = QuizQuestionSelector()
+            selector.load()
+            old_path = measure(lambda: pick_question_by_loading_the_category(1, previous_questions), repeat=20)
+            new_path = measure(lambda: selector.pick_question(1, previous_questions), repeat=200)
+            old_all_path = measure(lambda: pick_question_by_loading_every_question(previous_questions), repeat=5)
+            new_all_path = measure(lambda: selector.pick_question(None, previous_questions), repeat=200)
+            adaptive_path = measure(lambda: selector.pick_question(1, previous_questions, difficulty=3), repeat=200)
+            db.session.remove()
+            print_row(number_of_questions, '{:.3f} / {:.3f}'.format(*old_path), '{:.3f} / {:.3f}'.format(*new_path),
+                      '{:.3f} / {:.3f}'.format(*old_all_path), '{:.3f} / {:.3f}'.format(*new_all_path), '{:.3f} / {:.3f}'.format(*adaptive_path),
+                      '{:.1f}'.format(deck_memory(selector) / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES)
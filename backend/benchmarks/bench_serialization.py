@@ -0,0 +1,60 @@
+"""
+Cost of turning questions into a JSON response.
+Compares reading Question objects and calling Question.format() with reading plain rows (QUESTION_ROW_COLUMNS),
+then times GET /questions and GET /categories/<id>/questions with Flask's JSON encoder and with orjson.
+
+    python -m benchmarks.bench_serialization [number_of_questions]
+"""
+import json
+import os
+import sys
+import tempfile
+
+from flaskr import create_app
+from flaskr.serialization import orjson
+from models import db, format_question_row, Question, QUESTION_ROW_COLUMNS
+from benchmarks.common import seed_questions, measure, print_row
+
+PAGE_SIZES = [10, 100, 1000]
+# the endpoints are timed on two apps, so they need a database file they can share
+DATABASE_FILE = os.path.join(tempfile.gettempdir(), 'trivia_bench_serialization.db')
+DATABASE_PATH = 'sqlite:///' + DATABASE_FILE
+
+
+def benchmark_read_path(number_of_questions):
+    print_row('page size', 'format() p50/p99 ms', 'rows p50/p99 ms')
+    for page_size in PAGE_SIZES:
+        def read_objects():
+            db.session.expunge_all()
+            return json.dumps([question.format() for question in Question.query.order_by(Question.id).limit(page_size)])
+
+        def read_rows():
+            db.session.expunge_all()
+            return json.dumps([format_question_row(row) for row in db.session.query(*QUESTION_ROW_COLUMNS).order_by(Question.id).limit(page_size)])
+
+        objects_p50, objects_p99 = measure(read_objects)
+        rows_p50, rows_p99 = measure(read_rows)
+        print_row(page_size, '{:.3f} / {:.3f}'.format(objects_p50, objects_p99), '{:.3f} / {:.3f}'.format(rows_p50, rows_p99))
+
+
+def benchmark_endpoints(number_of_questions):
+    encoders = ['default', 'orjson'] if orjson is not None else ['default']
+    print_row('endpoint', *['{} p50/p99 ms'.format(encoder) for encoder in encoders])
+    clients = []
+    for encoder in encoders:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': DATABASE_PATH, 'JSON_ENCODER': encoder, 'DATABASE_INIT': 'manual'})
+        clients.append(app.test_client())
+    for path in ['/questions?page=1', '/questions?page={}'.format(number_of_questions // 20), '/categories/1/questions']:
+        timings = [measure(lambda: client.get(path)) for client in clients]
+        print_row(path, *['{:.3f} / {:.3f}'.format(p50, p99) for p50, p99 in timings])
+
+
+if __name__ == '__main__':
+    number_of_questions = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    app = create_app({'SQLALCHEMY_DATABASE_URI': DATABASE_PATH, 'DATABASE_INIT': 'eager'})
+    with app.app_context():
+        seed_questions(number_of_questions)
+        print('{} questions'.format(number_of_questions))
+        benchmark_read_path(number_of_questions)
+    benchmark_endpoints(number_of_questions)
+    os.remove(DATABASE_FILE)
@@ -0,0 +1,65 @@
+"""
+Shared helpers for the benchmarks in this folder.
+Run every benchmark from the backend folder, e.g. `python -m benchmarks.bench_quiz_selection`.
+"""
+import random
+import statistics
+import time
+
+from flask import Flask
+
+from models import setup_db, db, reconcile_question_counts, Question, Category
+
+CATEGORY_TYPES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+# synthetic questions are made of words drawn from a vocabulary of this many made-up words
+VOCABULARY_SIZE = 5000
+WORDS_PER_QUESTION = 8
+# rows per INSERT statement when seeding
+SEED_BATCH_SIZE = 10000
+
+
+# an app bound to a throwaway database (an in-memory SQLite database by default), with its tables created
+def create_benchmark_app(database_path='sqlite://'):
+    app = Flask(__name__)
+    app.config['DATABASE_INIT'] = 'eager'
+    setup_db(app, database_path)
+    return app
+
+
+def make_vocabulary(rng):
+    return [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 10))) for _ in range(VOCABULARY_SIZE)]
+
+
+# fill the categories and questions tables with number_of_questions synthetic questions
+def seed_questions(number_of_questions, seed=0):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    db.session.execute(Question.__table__.delete())
+    db.session.execute(Category.__table__.delete())
+    db.session.execute(Category.__table__.insert(), [{'id': index + 1, 'type': category_type} for index, category_type in enumerate(CATEGORY_TYPES)])
+    for start in range(0, number_of_questions, SEED_BATCH_SIZE):
+        rows = [{
+            'id': question_id,
+            'question': 'Which {}?'.format(' '.join(rng.choice(vocabulary) for _ in range(WORDS_PER_QUESTION))),
+            'answer': 'Answer {}'.format(question_id),
+            'category': rng.randint(1, len(CATEGORY_TYPES)),
+            'difficulty': rng.randint(1, 5)
+            } for question_id in range(start + 1, min(start + SEED_BATCH_SIZE, number_of_questions) + 1)]
+        db.session.execute(Question.__table__.insert(), rows)
+    db.session.commit()
+    reconcile_question_counts()
+
+
+# call function `repeat` times and return the median and the 99th percentile latency, in milliseconds
+def measure(function, repeat=50):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+
+def print_row(*columns):
+    print(''.join('{:<28}'.format(column) for column in columns))
@@ -0,0 +1,135 @@
+"""
+Load test of the sync (Flask) and async (ASGI) modes of the trivia API, see flaskr/asgi.py.
+Many concurrent clients play quizzes and browse questions for a fixed time,
+and the throughput and latency of each mode are printed side by side.
+
+Start both servers on the same database, then point the load test at them:
+
+    TRIVIA_SERVER_MODE=sync RATE_LIMIT_BACKEND=none uvicorn --factory flaskr.asgi:create_server_app --port 8001
+    TRIVIA_SERVER_MODE=async uvicorn --factory flaskr.asgi:create_server_app --port 8002
+    python -m benchmarks.load_test_modes --sync-url http://127.0.0.1:8001 --async-url http://127.0.0.1:8002 --concurrency 200
+
+The load comes from one address, so the rate limit of the sync mode is turned off (RATE_LIMIT_BACKEND=none).
+Or let the load test start them (needs uvicorn, and DATABASE_URL set for both modes):
+
+    python -m benchmarks.load_test_modes --spawn --concurrency 200
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import print_row
+
+SPAWN_PORTS = {'sync': 8001, 'async': 8002}
+
+
+# one request of a player: mostly quiz questions, some browsing and searching, like the frontend
+def random_request(rng, categories):
+    category_id = rng.choice(categories)
+    roll = rng.random()
+    if roll < 0.5:
+        previous_questions = rng.sample(range(1, 1000), 5)
+        return 'POST', '/quizzes', {'previous_questions': previous_questions, 'quiz_category': {'id': category_id, 'type': 'any'}}
+    if roll < 0.7:
+        return 'GET', '/questions?page={}'.format(rng.randint(1, 3)), None
+    if roll < 0.9:
+        return 'GET', '/categories/{}/questions'.format(category_id), None
+    return 'POST', '/questions/search', {'searchTerm': rng.choice(['the', 'what', 'which', 'who'])}
+
+
+def run_client(base_url, deadline, seed, categories, latencies, errors, lock):
+    url = urllib.parse.urlsplit(base_url)
+    connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+    rng = random.Random(seed)
+    while time.monotonic() < deadline:
+        method, path, body = random_request(rng, categories)
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body=json.dumps(body) if body is not None else None, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            failed = response.status >= 500
+        except (OSError, http.client.HTTPException):
+            failed = True
+            connection.close()
+            connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            if failed:
+                errors.append(elapsed)
+            else:
+                latencies.append(elapsed)
+    connection.close()
+
+
+def load_test(base_url, concurrency, duration):
+    url = urllib.parse.urlsplit(base_url)
+    connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+    connection.request('GET', '/categories')
+    categories = [int(category_id) for category_id in json.loads(connection.getresponse().read())['categories']]
+    connection.close()
+    latencies, errors, lock = [], [], threading.Lock()
+    deadline = time.monotonic() + duration
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for seed in range(concurrency):
+            executor.submit(run_client, base_url, deadline, seed, categories, latencies, errors, lock)
+    latencies.sort()
+    return {
+        'requests_per_second': len(latencies) / duration,
+        'p50_ms': statistics.median(latencies) if latencies else float('nan'),
+        'p99_ms': latencies[int(len(latencies) * 0.99)] if latencies else float('nan'),
+        'errors': len(errors)
+    }
+
+
+def spawn_server(mode):
+    environment = dict(os.environ, TRIVIA_SERVER_MODE=mode, RATE_LIMIT_BACKEND='none')
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', '--factory', 'flaskr.asgi:create_server_app',
+                               '--port', str(SPAWN_PORTS[mode]), '--log-level', 'warning'], env=environment)
+    base_url = 'http://127.0.0.1:{}'.format(SPAWN_PORTS[mode])
+    for _ in range(100):
+        try:
+            http.client.HTTPConnection('127.0.0.1', SPAWN_PORTS[mode], timeout=1).request('GET', '/categories')
+            return server, base_url
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('The {} server did not start'.format(mode))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sync-url')
+    parser.add_argument('--async-url')
+    parser.add_argument('--spawn', action='store_true', help='start both servers with uvicorn')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per mode')
+    arguments = parser.parse_args()
+
+    print_row('mode', 'requests/s', 'p50 ms', 'p99 ms', 'errors')
+    for mode, base_url in [('sync', arguments.sync_url), ('async', arguments.async_url)]:
+        server = None
+        if arguments.spawn:
+            server, base_url = spawn_server(mode)
+        if base_url is None:
+            continue
+        try:
+            result = load_test(base_url, arguments.concurrency, arguments.duration)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        print_row(mode, '{:.1f}'.format(result['requests_per_second']), '{:.2f}'.format(result['p50_ms']), '{:.2f}'.format(result['p99_ms']), result['errors'])
+
+
+if __name__ == '__main__':
+    main()
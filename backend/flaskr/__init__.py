@@ -1,36 +1,338 @@
 import os
-from flask import Flask, request, abort, jsonify, flash, redirect, url_for
+import sys
+import click
+from flask import Flask, Response, request, abort, jsonify, flash, redirect, url_for, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
+import time
+import threading
+import tempfile
+import shutil
+import hmac
+from functools import partial, wraps
 
-from models import setup_db, Question, Category
+from models import setup_db, init_db, ensure_db_initialized, read_only_session, get_pool_stats, format_question_row, count_questions, reconcile_question_counts, delete_questions, run_in_transaction, Question, Category, QUESTION_ROW_COLUMNS, ALL_QUESTIONS
+from .serialization import register_json_encoder, stream_json_object
+from .compression import register_compression
+from .metrics import register_metrics
+from .quiz import QuizQuestionSelector, get_adaptive_difficulty, get_quiz_category_id, get_previous_question_ids, to_integer
+from .search import create_question_search
+from .categories import CategoryCache, CATEGORY_CACHE_SECONDS
+from .bulk import import_questions, export_questions, import_categories, export_categories
+from .quiz_sessions import QuizSession, create_quiz_session_store, new_session_id
+from .response_cache import create_response_cache
+from .rate_limit import create_rate_limit
+from .snapshot import create_question_snapshot_store
+from .jobs import create_job_queue
+from .single_flight import SingleFlight
 
+# questions per page when the client does not ask for a number with ?per_page= (QUESTIONS_PER_PAGE in the app config),
+# and the most a client may ask for (MAX_QUESTIONS_PER_PAGE)
 QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 1000
+# pages of at least this many questions are streamed as they are encoded instead of built in memory (STREAM_MIN_QUESTIONS)
+STREAM_MIN_QUESTIONS = 200
+# at most this many ids per batch fetch or batch delete (MAX_BATCH_IDS in the app config)
+MAX_BATCH_IDS = 1000
+# how long (in seconds) a cached total_questions count is trusted before it is recounted
+QUESTION_COUNT_CACHE_SECONDS = 30
 
 # define a helper function to return a list of questions on a particular page
-def paginate_questions(request, selection):
+# the query must select QUESTION_ROW_COLUMNS, ordered by Question.id. The LIMIT/OFFSET is pushed into the query,
+# so only the questions on this page are loaded from the database, not the whole table.
+# If ?after_id= is given, use keyset pagination instead (WHERE id > after_id LIMIT n),
+# which stays fast on deep pages because the database does not have to skip the OFFSET rows.
+def paginate_questions(request, query, page_size=QUESTIONS_PER_PAGE):
     page = request.args.get('page', 1, type=int)
-    start_index = (page - 1) * QUESTIONS_PER_PAGE
-    end_index = start_index + QUESTIONS_PER_PAGE
-    list_of_questions_on_this_page = selection[start_index:end_index]
+    after_id = request.args.get('after_id', None, type=int)
+    offset = get_page_offset(page, after_id, page_size)
+    if offset is None:
+        return []
+    if after_id is not None:
+        query = query.filter(Question.id > after_id)
+    list_of_questions_on_this_page = query.offset(offset).limit(page_size).all()
     # format the list of questions on this page, so that each question is a dictionary, and can be jsonifyed. 
-    # Else, it will be a list of Question objects, which cannot be jsonifyed.
-    return [question.format() for question in list_of_questions_on_this_page]
+    # Else, it will be a list of rows, which cannot be jsonifyed.
+    return [format_question_row(row) for row in list_of_questions_on_this_page]
 
-def convert_category_list_to_category_dict(list_of_categories):
-    categories_in_dictionary = {category.id : category.type for category in list_of_categories}
-    return categories_in_dictionary
+# the same as paginate_questions, with the rows of the page read by get_page(limit, offset=, after_id=) from the question snapshot
+def paginate_snapshot_questions(request, get_page, page_size=QUESTIONS_PER_PAGE):
+    page = request.args.get('page', 1, type=int)
+    after_id = request.args.get('after_id', None, type=int)
+    offset = get_page_offset(page, after_id, page_size)
+    if offset is None:
+        return []
+    list_of_questions_on_this_page = get_page(page_size, offset=offset, after_id=after_id)
+    return [format_question_row(row) for row in list_of_questions_on_this_page]
+
+# the number of rows to skip for ?page= (0 with ?after_id=, which skips by id instead), or None if the page does not exist
+def get_page_offset(page, after_id, page_size=QUESTIONS_PER_PAGE):
+    if after_id is not None:
+        return 0
+    if page < 1:
+        return None
+    return (page - 1) * page_size
+
+# the cursor the client should send as ?after_id= to get the next page, or None if this is the last page
+def get_next_after_id(list_of_questions_on_this_page, page_size=QUESTIONS_PER_PAGE):
+    if len(list_of_questions_on_this_page) < page_size:
+        return None
+    return list_of_questions_on_this_page[-1]['id']
+
+# the number of questions per page: per_page (?per_page=) if the client gave one, at most max_page_size, else page_size
+def get_page_size(per_page, page_size=QUESTIONS_PER_PAGE, max_page_size=MAX_QUESTIONS_PER_PAGE):
+    if per_page is None:
+        return page_size
+    return max(1, min(per_page, max_page_size))
+
+# the question ids of a batch request: ?ids=1,2,3 (or repeated ?ids=1&ids=2), or {"ids": [1, 2, 3]} in the JSON body.
+# Duplicates are dropped, keeping the order of the request. Aborts with 400 if there are none, too many, or ids that are not integers.
+def get_batch_question_ids(request, max_batch_ids=MAX_BATCH_IDS):
+    request_body = request.get_json(silent=True)
+    if isinstance(request_body, dict) and 'ids' in request_body:
+        raw_ids = request_body['ids'] if isinstance(request_body['ids'], list) else [request_body['ids']]
+    else:
+        raw_ids = [raw_id for argument in request.args.getlist('ids') for raw_id in argument.split(',') if raw_id.strip()]
+    try:
+        question_ids = list(dict.fromkeys(int(raw_id) for raw_id in raw_ids))
+    except (TypeError, ValueError):
+        abort(400, description='ids must be integers')
+    if not question_ids:
+        abort(400, description='No question ids are provided')
+    if len(question_ids) > max_batch_ids:
+        abort(400, description='At most {} ids per request'.format(max_batch_ids))
+    return question_ids
+
+"""
+The request parsing and the JSON bodies shared by the routes of create_app and the async mode (flaskr/asgi.py),
+so both serve the same API. The parsers raise ValueError, which the routes turn into 400 Bad Request.
+"""
+# the Question of POST /questions, not added to the session yet
+def get_new_question(request_body):
+    if request_body is None:
+        raise ValueError('Request body is empty')
+    question = request_body.get('question', None)
+    answer = request_body.get('answer', None)
+    category = request_body.get('category', None)
+    difficulty = request_body.get('difficulty', None)
+    if not all([question, answer, category, difficulty]):
+        raise ValueError('One of the required fields is empty')
+    return Question(question=question, answer=answer,
+                    category=to_integer(category, 'category must be an integer'),
+                    difficulty=to_integer(difficulty, 'difficulty must be an integer'))
+
+# the search term of POST /questions/search, without the surrounding spaces
+def get_search_term(request_body):
+    if not request_body or 'searchTerm' not in request_body:
+        raise ValueError('Search term is not provided')
+    return (request_body.get('searchTerm') or '').strip()
+
+# (category id or None for 'ALL', previous question ids, difficulty or None) of POST /quizzes
+def get_quiz_request(request_body):
+    if not request_body:
+        raise ValueError('Request body is empty')
+    return get_quiz_category_id(request_body), get_previous_question_ids(request_body), get_adaptive_difficulty(request_body)
+
+# the body of a page of questions. next_after_id is only sent to the clients paging with ?after_id=,
+# and categories (id: type) only by GET /questions
+def get_questions_page_body(list_of_questions_on_this_page, total_questions, current_category, page_size, after_id_requested, categories=None):
+    response_body = {
+        'success': True,
+        'questions': list_of_questions_on_this_page,
+        'total_questions': total_questions,
+        'current_category': current_category
+        }
+    if categories is not None:
+        response_body['categories'] = categories
+    if after_id_requested:
+        response_body['next_after_id'] = get_next_after_id(list_of_questions_on_this_page, page_size)
+    return response_body
+
+def get_categories_body(category_catalogue):
+    return {
+        'success': True,
+        'categories': category_catalogue.categories,
+        'total_categories': category_catalogue.total_categories,
+        'question_counts': category_catalogue.question_counts,
+        'total_questions': category_catalogue.total_questions
+        }
+
+def get_quiz_question_body(random_question, difficulty=None):
+    response_body = {
+        'success': True,
+        'question': random_question.format() if random_question else None
+        }
+    if difficulty is not None:
+        response_body['difficulty'] = difficulty
+    return response_body
+
+# the tags of the cached responses that new or deleted questions of these categories make stale
+def get_question_response_tags(category_ids):
+    return ['questions', 'categories'] + ['category:{}'.format(category_id) for category_id in set(category_ids)]
+
+class QuestionCountCache:
+    """
+    Caches the number of questions, in total (category_id=None) or per category,
+    so that paging through questions does not read the question counters on every request.
+    Counts expire after ttl seconds, and are dropped by invalidate() whenever a question is created or deleted.
+    A count read before an invalidate() is not kept (see store), so it cannot outlive the write that changed it.
+    """
+    def __init__(self, ttl=QUESTION_COUNT_CACHE_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.invalidations = 0
+
+    # the cached count, or None if it is not cached or has expired
+    def get_cached(self, category_id=None):
+        with self.lock:
+            cached = self.counts.get(category_id)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+        return None
+
+    # invalidations_before is self.invalidations taken before the count was read:
+    # if a write invalidated the cache since, the count may be stale and is not kept
+    def store(self, category_id, count, invalidations_before=None):
+        with self.lock:
+            if invalidations_before is None or self.invalidations == invalidations_before:
+                self.counts[category_id] = (count, time.monotonic())
+
+    def get(self, category_id=None):
+        count = self.get_cached(category_id)
+        if count is None:
+            invalidations_before = self.invalidations
+            count = count_questions(category_id)
+            self.store(category_id, count, invalidations_before)
+        return count
+
+    def invalidate(self):
+        with self.lock:
+            self.counts.clear()
+            self.invalidations += 1
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
+    register_json_encoder(app)
+    request_metrics = register_metrics(app)
+    # gzip/brotli, negotiated with Accept-Encoding, for the responses over COMPRESSION_MIN_BYTES
+    register_compression(app)
 
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     """
     CORS(app)
+    question_count_cache = QuestionCountCache()
+    # worker threads running the derived-data maintenance (snapshot, quiz decks, search index, counters) and the background
+    # bulk imports off the request thread, from a queue in this process or in a SQLite file shared by the workers (JOB_QUEUE_BACKEND)
+    job_queue = create_job_queue(app)
+    # the memory-mapped snapshot of the questions and categories shared by the worker processes, if QUESTION_SNAPSHOT_PATH is set.
+    # It serves the question pages and the quizzes without querying the database
+    question_snapshot = create_question_snapshot_store(app, job_queue)
+    if question_snapshot is not None:
+        quiz_question_selector = QuizQuestionSelector(
+            load_rows=lambda: question_snapshot.get().quiz_rows(),
+            # a question created since the last rebuild is not in the snapshot yet
+            get_question=lambda question_id: question_snapshot.get().get_question(question_id) or Question.query.get(question_id))
+        question_snapshot.on_reload.append(quiz_question_selector.invalidate)
+    else:
+        quiz_question_selector = QuizQuestionSelector()
+    quiz_session_store = create_quiz_session_store(app.config)
+    question_search = create_question_search(app)
+    category_cache = CategoryCache(ttl=app.config.get('CATEGORY_CACHE_SECONDS', CATEGORY_CACHE_SECONDS))
+    # cached responses of the GET endpoints below, tagged with the data they show:
+    # 'questions' (every question page), 'categories' (GET /categories, whose counts change with every question)
+    # and 'category:<id>' (the pages of one category)
+    response_cache = create_response_cache(app.config)
+    if question_snapshot is not None:
+        # the cached pages were read from the previous snapshot (the pages requested between a write and the rebuild
+        # do not show the write yet), so drop them once a new one is opened, by this worker's rebuild or another's
+        question_snapshot.on_reload.append(response_cache.clear)
+    # token buckets per client of the endpoints doing the most database work per call: the quiz and the search
+    rate_limit = create_rate_limit(app.config)
+    # concurrent identical searches share one query (SEARCH_SINGLE_FLIGHT = False in the app config turns it off)
+    search_single_flight = SingleFlight() if app.config.get('SEARCH_SINGLE_FLIGHT', True) else None
+
+    max_batch_ids = app.config.get('MAX_BATCH_IDS', MAX_BATCH_IDS)
+    question_page_size = app.config.get('QUESTIONS_PER_PAGE', QUESTIONS_PER_PAGE)
+    max_question_page_size = app.config.get('MAX_QUESTIONS_PER_PAGE', MAX_QUESTIONS_PER_PAGE)
+    stream_min_questions = app.config.get('STREAM_MIN_QUESTIONS', STREAM_MIN_QUESTIONS)
+
+    # the /internal endpoints changing the server state (running jobs, dropping caches) need "Authorization: Bearer <token>"
+    # with the INTERNAL_ADMIN_TOKEN of the app config or the environment. Without a token they are turned off and answer 403
+    internal_admin_token = app.config.get('INTERNAL_ADMIN_TOKEN', os.getenv('INTERNAL_ADMIN_TOKEN'))
+
+    def admin_only(view_function):
+        @wraps(view_function)
+        def admin_view(**view_arguments):
+            authorization = request.headers.get('Authorization', '').encode('utf-8')
+            if not internal_admin_token or not hmac.compare_digest(authorization, 'Bearer {}'.format(internal_admin_token).encode('utf-8')):
+                abort(403)
+            return view_function(**view_arguments)
+        return admin_view
+
+    def get_request_page_size():
+        return get_page_size(request.args.get('per_page', None, type=int), question_page_size, max_question_page_size)
+
+    # the response of a page of questions: large pages are streamed (and not kept by the response cache)
+    def make_questions_response(response_body):
+        if len(response_body['questions']) < stream_min_questions:
+            return jsonify(response_body), 200
+        questions = response_body.pop('questions')
+        return Response(stream_with_context(stream_json_object(response_body, 'questions', questions)), mimetype='application/json')
+
+    # the cached responses new or deleted questions of these categories make stale, and the snapshot
+    def invalidate_question_responses(*category_ids):
+        response_cache.invalidate_tags(get_question_response_tags(category_ids))
+        if question_snapshot is not None:
+            question_snapshot.request_rebuild()
+
+    # after a bulk import: drop the cached data, and reload the quiz decks and the search index in the background.
+    # Until they are reloaded, the quiz and the search keep using the previous ones (without the imported questions)
+    def refresh_derived_data():
+        question_count_cache.invalidate()
+        category_cache.invalidate()
+        response_cache.clear()
+        job_queue.enqueue('reload-quiz-decks', unique=True)
+        job_queue.enqueue('reload-search-index', unique=True)
+        if question_snapshot is not None:
+            question_snapshot.request_rebuild()
+
+    """
+    Jobs of the job queue, run by name with JSON arguments (see flaskr/jobs.py).
+    import-questions(path)
+        imports the NDJSON file at path (then deletes it) like POST /questions/bulk, and returns the import summary
+    rebuild-snapshot, reconcile-question-counts
+        the same as the CLI commands
+    reload-quiz-decks, reload-search-index
+        rebuild the in-memory indexes of the process that enqueued them
+    """
+    def import_questions_job(path):
+        ensure_db_initialized(app)
+        try:
+            with open(path, 'rb') as file:
+                import_summary = import_questions(file)
+        finally:
+            os.unlink(path)
+        refresh_derived_data()
+        return import_summary
+
+    def reconcile_question_counts_job():
+        corrected_counts = reconcile_question_counts()
+        question_count_cache.invalidate()
+        return {'corrected_question_counts': len(corrected_counts)}
+
+    # an import that ran halfway would insert its first rows twice if it ran again
+    job_queue.register('import-questions', import_questions_job, rerun=False)
+    job_queue.register('reconcile-question-counts', reconcile_question_counts_job)
+    job_queue.register('reload-quiz-decks', lambda: quiz_question_selector.load(), local=True)
+    job_queue.register('reload-search-index', lambda: question_search.load(), local=True)
+    if question_snapshot is not None:
+        job_queue.register('rebuild-snapshot', question_snapshot.rebuild)
     
     """
     @TODO: Use the after_request decorator to set Access-Control-Allow
@@ -47,15 +349,122 @@ def create_app(test_config=None):
     for all available categories.
     """
     @app.route('/categories', methods=['GET'])
+    @response_cache.cached(lambda: ['categories'])
     def get_all_categories():
-        list_of_all_categories = Category.query.order_by(Category.id).all()
-        if len(list_of_all_categories) == 0:
+        category_catalogue = category_cache.get()
+        if category_catalogue.total_categories == 0:
+            abort(404)
+        response = jsonify(get_categories_body(category_catalogue))
+        # the ETag changes with the categories and with the question counts, which change with every new or deleted question.
+        # So browsers and CDNs must revalidate on every request (no-cache), and get an empty 304 Not Modified
+        # with If-None-Match instead of downloading the list again while nothing changed
+        response.set_etag(category_catalogue.etag)
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    
+    # hit/miss counters of the category cache
+    @app.route('/internal/cache/categories', methods=['GET'])
+    def get_category_cache_stats():
+        return jsonify({
+            'success': True,
+            'category_cache': category_cache.stats()
+            }), 200
+    
+    # connection pool statistics (checked out connections, overflow, time spent waiting for a connection),
+    # to size DB_POOL_SIZE / DB_MAX_OVERFLOW under load
+    @app.route('/internal/pool', methods=['GET'])
+    def get_connection_pool_stats():
+        return jsonify({
+            'success': True,
+            'pools': get_pool_stats(app)
+            }), 200
+    
+    # request latency histograms and SQL query counts per route, in the Prometheus text format
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(request_metrics.render() + job_queue.render_metrics(), mimetype='text/plain; version=0.0.4')
+    
+    # hit/miss counters (and hit ratio) of the response cache
+    @app.route('/internal/cache/responses', methods=['GET'])
+    def get_response_cache_stats():
+        return jsonify({
+            'success': True,
+            'response_cache': response_cache.stats()
+            }), 200
+    
+    # allowed/rejected counters of the rate limit, and how many searches were coalesced
+    @app.route('/internal/rate-limit', methods=['GET'])
+    def get_rate_limit_stats():
+        return jsonify({
+            'success': True,
+            'rate_limit': rate_limit.stats(),
+            'search_single_flight': search_single_flight.stats() if search_single_flight else None
+            }), 200
+    
+    # size and age of the question snapshot, and how often it was rebuilt and reopened by this worker
+    @app.route('/internal/snapshot', methods=['GET'])
+    def get_question_snapshot_stats():
+        if question_snapshot is None:
+            abort(404, description='QUESTION_SNAPSHOT_PATH is not set')
+        question_snapshot.get()
+        return jsonify({
+            'success': True,
+            'snapshot': question_snapshot.stats()
+            }), 200
+    
+    # workers, queue depth per status, and the jobs run by this worker (done, failed, time waiting and running) per name
+    @app.route('/internal/jobs', methods=['GET'])
+    def get_job_queue_stats():
+        return jsonify({
+            'success': True,
+            'job_queue': job_queue.stats()
+            }), 200
+    
+    # status of a job, with its result once done or its error once failed
+    @app.route('/internal/jobs/<int:job_id>', methods=['GET'])
+    def get_job(job_id):
+        job = job_queue.get(job_id)
+        if job is None:
             abort(404)
-        categories_in_dictionary = convert_category_list_to_category_dict(list_of_all_categories)
         return jsonify({
             'success': True,
-            'categories': categories_in_dictionary,
-            'total_categories': Category.query.count()
+            'job': job.format()
+            }), 200
+    
+    # run a maintenance job without arguments (e.g. /internal/jobs/reconcile-question-counts) in the background
+    @app.route('/internal/jobs/<name>', methods=['POST'])
+    @admin_only
+    def enqueue_job(name):
+        if name not in job_queue.functions or name == 'import-questions':
+            abort(404)
+        job_id = job_queue.enqueue(name, unique=True)
+        return jsonify({
+            'success': True,
+            'job_id': job_id
+            }), 202
+    
+    # drop every cached response
+    @app.route('/internal/cache/responses', methods=['DELETE'])
+    @admin_only
+    def clear_response_cache():
+        response_cache.clear()
+        return jsonify({
+            'success': True,
+            'response_cache': response_cache.stats()
+            }), 200
+    
+    # drop the cached categories, e.g. after editing the categories table by hand
+    @app.route('/internal/cache/categories', methods=['DELETE'])
+    @admin_only
+    def invalidate_category_cache():
+        category_cache.invalidate()
+        response_cache.clear()
+        if question_snapshot is not None:
+            question_snapshot.request_rebuild()
+        return jsonify({
+            'success': True,
+            'category_cache': category_cache.stats()
             }), 200
 
     """
@@ -71,18 +480,25 @@ def create_app(test_config=None):
     Clicking on the page numbers should update the questions.
     """
     @app.route('/questions', methods=['GET'])
+    @response_cache.cached(lambda: ['questions'])
     def get_paginated_questions():
-        list_of_all_questions = Question.query.order_by(Question.id).all()
-        list_of_questions_on_this_page = paginate_questions(request, list_of_all_questions)
+        if 'ids' in request.args:
+            return get_questions_by_ids()
+        page_size = get_request_page_size()
+        if question_snapshot is not None:
+            snapshot = question_snapshot.get()
+            list_of_questions_on_this_page = paginate_snapshot_questions(request, snapshot.page, page_size)
+            total_questions = snapshot.count_questions()
+            # the categories of the same snapshot as the page
+            categories = snapshot.get_categories()
+        else:
+            list_of_questions_on_this_page = paginate_questions(request, read_only_session().query(*QUESTION_ROW_COLUMNS).order_by(Question.id), page_size)
+            total_questions = question_count_cache.get()
+            categories = category_cache.get().categories
         if len(list_of_questions_on_this_page) == 0:
             abort(404)
-        return jsonify({
-            'success': True,
-            'questions': list_of_questions_on_this_page,
-            'total_questions': Question.query.count(),
-            'categories': convert_category_list_to_category_dict(Category.query.order_by(Category.id).all()),
-            'current_category': None
-            }), 200
+        return make_questions_response(get_questions_page_body(list_of_questions_on_this_page, total_questions, None, page_size,
+                                                               'after_id' in request.args, categories=categories))
         
     """
     @TODO:
@@ -96,11 +512,50 @@ def create_app(test_config=None):
         question_to_be_deleted = Question.query.filter(Question.id == id).one_or_none()
         if question_to_be_deleted is None:
             abort(404, description='Question with id {} not found'.format(id))
-        question_to_be_deleted.delete()
+        # run again if it deadlocks with a concurrent write of the same question counters
+        run_in_transaction(question_to_be_deleted.delete)
+        question_count_cache.invalidate()
+        category_cache.invalidate()
+        invalidate_question_responses(question_to_be_deleted.category)
+        quiz_question_selector.remove_question(id)
+        question_search.remove_question(id)
         return jsonify({
             'success': True,
             'deleted_question_id': id
             }), 200
+    
+    """
+    Batch fetch and batch delete, for moderation tools handling many questions at once.
+    GET /questions?ids=1,2,3 reads the questions with one IN query, in the order of the ids.
+    DELETE /questions?ids=1,2,3 (or with {"ids": [1, 2, 3]} as JSON body) deletes them with one statement, in one transaction.
+    Both report the ids that do not exist in missing_ids, instead of failing.
+    """
+    def get_questions_by_ids():
+        question_ids = get_batch_question_ids(request, max_batch_ids)
+        questions_by_id = {row.id: format_question_row(row) for row in read_only_session().query(*QUESTION_ROW_COLUMNS).filter(Question.id.in_(question_ids))}
+        return jsonify({
+            'success': True,
+            'questions': [questions_by_id[question_id] for question_id in question_ids if question_id in questions_by_id],
+            'missing_ids': [question_id for question_id in question_ids if question_id not in questions_by_id]
+            }), 200
+    
+    @app.route('/questions', methods=['DELETE'])
+    def delete_questions_by_ids():
+        question_ids = get_batch_question_ids(request, max_batch_ids)
+        deleted_questions = run_in_transaction(partial(delete_questions, question_ids))
+        deleted_question_ids = {question_id for question_id, _ in deleted_questions}
+        if deleted_questions:
+            question_count_cache.invalidate()
+            category_cache.invalidate()
+            invalidate_question_responses(*[category for _, category in deleted_questions])
+            for question_id in deleted_question_ids:
+                quiz_question_selector.remove_question(question_id)
+                question_search.remove_question(question_id)
+        return jsonify({
+            'success': True,
+            'deleted_question_ids': [question_id for question_id in question_ids if question_id in deleted_question_ids],
+            'missing_ids': [question_id for question_id in question_ids if question_id not in deleted_question_ids]
+            }), 200
         
     
     
@@ -116,55 +571,99 @@ def create_app(test_config=None):
     """
     @app.route('/questions', methods=['POST'])
     def create_a_new_question():
-        request_body = request.get_json()
-        if request_body is None:
-            abort(400, description='Request body is empty')
-        question = request_body.get('question', None)
-        answer = request_body.get('answer', None)
-        category = request_body.get('category', None)
-        difficulty = request_body.get('difficulty', None)
-        if not all([question, answer, category, difficulty]):
-            abort(400, description='One of the required fields is empty')
-        new_question = Question(question=question, answer=answer, category=int(category), difficulty=int(difficulty))
-        new_question.insert()
+        try:
+            new_question = get_new_question(request.get_json())
+        except ValueError as error:
+            abort(400, description=str(error))
+        run_in_transaction(new_question.insert)
+        question_count_cache.invalidate()
+        category_cache.invalidate()
+        invalidate_question_responses(new_question.category)
+        quiz_question_selector.add_question(new_question)
+        question_search.add_question(new_question)
         return jsonify({
             'success': True,
             'created_question_id': new_question.id
             }), 201
         
+    """
+    Bulk import and export of questions, as NDJSON (one JSON question per line).
+    POST /questions/bulk reads the request body as a stream, checks every row like POST /questions,
+    and inserts the valid rows in batches (COPY on PostgreSQL), reporting the invalid rows by line number.
+    GET /questions/export streams every question from a server-side cursor.
+    With ?background=true, the body is saved to a temporary file and imported by an import-questions job:
+    the response is 202 with the job id, and GET /internal/jobs/<id> tells the import summary once it is done.
+    The same import/export is available from the command line, see the CLI commands at the end of create_app.
+    """
+    @app.route('/questions/bulk', methods=['POST'])
+    def bulk_import_questions():
+        if request.args.get('background', 'false').lower() == 'true':
+            import_file_descriptor, import_path = tempfile.mkstemp(prefix='trivia-import-', suffix='.ndjson')
+            with os.fdopen(import_file_descriptor, 'wb') as import_file:
+                shutil.copyfileobj(request.stream, import_file)
+                is_empty = import_file.tell() == 0
+            if is_empty:
+                os.unlink(import_path)
+                abort(400, description='Request body is empty')
+            return jsonify({
+                'success': True,
+                'job_id': job_queue.enqueue('import-questions', path=import_path)
+                }), 202
+        import_summary = import_questions(request.stream)
+        if import_summary['inserted_questions'] == 0 and import_summary['rejected_questions'] == 0:
+            abort(400, description='Request body is empty')
+        # the questions changed, so the derived data must be rebuilt
+        refresh_derived_data()
+        return jsonify({
+            'success': True,
+            **import_summary
+            }), 200
+    
+    @app.route('/questions/export', methods=['GET'])
+    def bulk_export_questions():
+        return Response(stream_with_context(export_questions()), mimetype='application/x-ndjson')
+    
     """
     @TODO:
     Create a POST endpoint to get questions based on a search term.
     It should return any questions for whom the search term
     is a substring of the question.
+    (Now: any questions having a word starting with each word of the search term, see flaskr/search.py)
 
     TEST: Search by any phrase. The questions list will update to include
     only question that include that string within their question.
     Try using the word "title" to start.
     """
     @app.route('/questions/search', methods=['POST'])
+    @rate_limit.limited
     def search_questions():
-        request_body = request.get_json()
         # if searchTerm is NOT in the request body, then abort(400) BAD REQUEST
-        if not 'searchTerm' in request_body:
-            abort(400, description='Search term is not provided')
+        try:
+            search_term = get_search_term(request.get_json())
+        except ValueError as error:
+            abort(400, description=str(error))
         
-        search_term = request_body.get('searchTerm', '').strip()
         # if search term is empty, return all questions
         if search_term == '':
             return redirect(url_for('get_paginated_questions'))
-        found_questions = Question.query.order_by(Question.id).filter(Question.question.ilike('%{}%'.format(search_term))).all()
-        
-        if len(found_questions) == 0:
-            # pass, because the frontend will handle the flash message
-           pass
+        # every word of the search term is matched as a prefix of a word of the question, best matches first.
+        # This runs on the full-text index instead of scanning every question with ILIKE '%term%'
+        page = max(request.args.get('page', 1, type=int), 1)
+        page_size = get_request_page_size()
+        def search_page():
+            return question_search.search(search_term, limit=page_size, offset=(page - 1) * page_size)
+        if search_single_flight is not None:
+            found_questions, total_questions = search_single_flight.do((search_term, page, page_size), search_page)
+        else:
+            found_questions, total_questions = search_page()
         
-        return jsonify({
+        # if nothing is found, pass, because the frontend will handle the flash message
+        return make_questions_response({
             'success': True,
-            'questions': paginate_questions(request, found_questions),
-            'total_questions': len(found_questions),
+            'questions': [format_question_row(row) for row in found_questions],
+            'total_questions': total_questions,
             'current_category': None
-            }), 200
+            })
         
     """
     @TODO:
@@ -175,17 +674,24 @@ def create_app(test_config=None):
     category to be shown.
     """
     @app.route('/categories/<int:category_id>/questions', methods=['GET'])
+    @response_cache.cached(lambda category_id: ['category:{}'.format(category_id)])
     def get_questions_based_on_category(category_id):
-        category = Category.query.filter(Category.id == category_id).one_or_none()
-        if not category:
-            abort(422, description='Category with id {} does not exist'.format(category_id))
-        list_of_questions_belong_to_this_category = Question.query.order_by(Question.id).filter(Question.category == category_id).all()
-        return jsonify({
-            'success': True,
-            'questions': paginate_questions(request, list_of_questions_belong_to_this_category),
-            'total_questions': len(list_of_questions_belong_to_this_category),
-            'current_category': category_id
-            }), 200
+        page_size = get_request_page_size()
+        if question_snapshot is not None:
+            snapshot = question_snapshot.get()
+            if not snapshot.has_category(category_id):
+                abort(422, description='Category with id {} does not exist'.format(category_id))
+            list_of_questions_on_this_page = paginate_snapshot_questions(request, partial(snapshot.category_page, category_id), page_size)
+            total_questions = snapshot.count_questions(category_id)
+        else:
+            category = read_only_session().query(Category).filter(Category.id == category_id).one_or_none()
+            if not category:
+                abort(422, description='Category with id {} does not exist'.format(category_id))
+            questions_belong_to_this_category = read_only_session().query(*QUESTION_ROW_COLUMNS).order_by(Question.id).filter(Question.category == category_id)
+            list_of_questions_on_this_page = paginate_questions(request, questions_belong_to_this_category, page_size)
+            total_questions = question_count_cache.get(category_id)
+        return make_questions_response(get_questions_page_body(list_of_questions_on_this_page, total_questions, category_id, page_size,
+                                                               'after_id' in request.args))
         
     """
     @TODO:
@@ -199,40 +705,86 @@ def create_app(test_config=None):
     and shown whether they were correct or not.
     """
     @app.route('/quizzes', methods=['POST'])
+    @rate_limit.limited
     def get_current_quiz_question():
+        # None for the 'ALL' category. In the adaptive mode, the difficulty follows the player's recent answers
+        try:
+            id_of_quiz_category, previous_questions, difficulty = get_quiz_request(request.get_json())
+        except ValueError as error:
+            abort(400, description=str(error))
+        # random_question is None if every question of this category is in previous_questions
+        random_question = quiz_question_selector.pick_question(id_of_quiz_category, previous_questions, difficulty)
+        return jsonify(get_quiz_question_body(random_question, difficulty)), 200
+    
+    
+    """
+    Quiz sessions: instead of sending the whole previous_questions list on every POST /quizzes,
+    the client creates a session for a category once, then asks the session for the next question.
+    The server keeps the shuffled question ids of the session, so every call is O(1) and the request stays the same size.
+    """
+    @app.route('/quizzes/sessions', methods=['POST'])
+    @rate_limit.limited
+    def create_quiz_session():
         request_body = request.get_json()
         if not request_body:
             abort(400, description='Request body is empty')
-        previous_questions = request_body.get('previous_questions', [])
-        quiz_category = request_body.get('quiz_category', None)
+        try:
+            id_of_quiz_category = get_quiz_category_id(request_body)
+        except ValueError as error:
+            abort(400, description=str(error))
         
-        if quiz_category is None:
-            abort(400, description='Quiz category is not provided')
-            
-        quiz_category_object = Category(**quiz_category)
-        id_of_quiz_category = quiz_category_object.id
-        type_of_quiz_category = quiz_category_object.type
-        
-        # handle case when user clicks on 'ALL' category
-        if id_of_quiz_category == 0 and type_of_quiz_category == 'click':
-            list_of_all_questions = Question.query.order_by(Question.id).all()
-        else:
-            list_of_all_questions = Question.query.filter(Question.category == id_of_quiz_category).all()
-        list_of_not_asked_questions = [question for question in list_of_all_questions if question.id not in previous_questions]
-        # use Ternary operator to assign random_question to None if list_of_not_asked_questions is empty
-        random_question = None if len(list_of_not_asked_questions) == 0 else random.choice(list_of_not_asked_questions)
+        quiz_session = QuizSession.create(id_of_quiz_category, quiz_question_selector.question_ids(id_of_quiz_category))
+        session_id = new_session_id()
+        quiz_session_store.save(session_id, quiz_session)
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'total_questions': len(quiz_session.question_ids)
+            }), 201
+    
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    @rate_limit.limited
+    def get_next_quiz_session_question(session_id):
+        # the store advances the session atomically, so concurrent calls never get the same question
+        next_question = None
+        while next_question is None:
+            next_question_id = quiz_session_store.next_question_id(session_id)
+            if next_question_id is None:
+                abort(404, description='Quiz session {} not found or expired'.format(session_id))
+            question_id, quiz_session = next_question_id
+            if question_id is None:
+                break
+            # skip questions that were deleted after the session was created
+            next_question = Question.query.get(question_id)
         
         return jsonify({
             'success': True,
-            'question': random_question.format() if random_question else None
+            'question': next_question.format() if next_question else None,
+            'session': quiz_session
             }), 200
     
+    @app.route('/quizzes/sessions/<session_id>', methods=['DELETE'])
+    def delete_quiz_session(session_id):
+        if not quiz_session_store.delete(session_id):
+            abort(404, description='Quiz session {} not found or expired'.format(session_id))
+        return jsonify({
+            'success': True,
+            'deleted_session_id': session_id
+            }), 200
     
     """
     @TODO:
     Create error handlers for all expected errors
     including 404 and 422.
     """
+    @app.errorhandler(403)
+    def forbidden(error):
+        return jsonify({
+            "success": False,
+            "error": 403,
+            "message": "Forbidden"
+            }), 403
+
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({
@@ -264,5 +816,81 @@ def create_app(test_config=None):
             "error": 422,
             "message": "Unprocessable Entity"
             }), 422
+    
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": "Too Many Requests"
+            })
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
+    """
+    CLI commands, run from the backend folder with FLASK_APP=flaskr.
+    Together they can replace restoring trivia.psql:
+        flask import-categories data/categories.ndjson
+        flask import-questions data/questions.ndjson
+    """
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create the missing tables, indexes and question counters (needed once with DATABASE_INIT=manual)."""
+        init_db(app)
+        click.echo('Initialized the database')
+    
+    @app.cli.command('import-questions')
+    @click.argument('file', type=click.File('rb'))
+    def import_questions_command(file):
+        """Import questions from an NDJSON file ('-' for stdin)."""
+        ensure_db_initialized(app)
+        import_summary = import_questions(file)
+        for error in import_summary['errors']:
+            click.echo('line {}: {}'.format(error['line'], error['error']), err=True)
+        click.echo('Imported {} questions, rejected {}'.format(import_summary['inserted_questions'], import_summary['rejected_questions']))
+        if question_snapshot is not None:
+            question_snapshot.rebuild_now()
+        if import_summary['rejected_questions']:
+            sys.exit(1)
+    
+    @app.cli.command('build-snapshot')
+    def build_snapshot_command():
+        """Write the question snapshot to QUESTION_SNAPSHOT_PATH (after editing the database by hand)."""
+        if question_snapshot is None:
+            click.echo('QUESTION_SNAPSHOT_PATH is not set', err=True)
+            sys.exit(1)
+        ensure_db_initialized(app)
+        question_snapshot.rebuild_now()
+        click.echo('Wrote the snapshot of {} questions to {}'.format(question_snapshot.get().number_of_questions, question_snapshot.path))
+    
+    @app.cli.command('export-questions')
+    @click.argument('file', type=click.File('w'), default='-')
+    def export_questions_command(file):
+        """Export every question to an NDJSON file (stdout by default)."""
+        file.writelines(export_questions())
+    
+    @app.cli.command('import-categories')
+    @click.argument('file', type=click.File('r'))
+    def import_categories_command(file):
+        """Import (or update) categories from an NDJSON file."""
+        ensure_db_initialized(app)
+        click.echo('Imported {} categories'.format(import_categories(file)))
+        if question_snapshot is not None:
+            question_snapshot.rebuild_now()
+    
+    @app.cli.command('reconcile-question-counts')
+    def reconcile_question_counts_command():
+        """Recompute the question counters (total and per category) from the questions table."""
+        ensure_db_initialized(app)
+        corrected_counts = reconcile_question_counts()
+        for category_id, (old_count, new_count) in sorted(corrected_counts.items()):
+            click.echo('{}: {} -> {}'.format('total' if category_id == ALL_QUESTIONS else 'category {}'.format(category_id), old_count, new_count))
+        click.echo('Corrected {} question counters'.format(len(corrected_counts)))
+    
+    @app.cli.command('export-categories')
+    @click.argument('file', type=click.File('w'), default='-')
+    def export_categories_command(file):
+        """Export every category to an NDJSON file (stdout by default)."""
+        file.writelines(export_categories())
+    
     return app
-
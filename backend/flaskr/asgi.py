@@ -0,0 +1,481 @@
+"""
+Async deployment mode of the trivia API.
+
+create_asgi_app() serves the same routes and JSON as the Flask app of create_app() for the frontend
+(categories, questions, search, quizzes), as an ASGI application on SQLAlchemy's asyncio engine,
+so a request waiting for the database does not hold a worker thread.
+It needs an async driver: asyncpg for PostgreSQL, aiosqlite for SQLite.
+The other endpoints (quiz sessions, bulk import/export, /internal/...) are only served by the Flask app.
+The routes it serves also skip some behaviours of the Flask app:
+    - the read replica and the read-your-writes cookie (every query goes to the primary database)
+    - the Server-Timing header and the /internal/metrics counters
+    - the retries of run_in_transaction on serialization failures and deadlocks
+    - the reads from the question snapshot (QUESTION_SNAPSHOT_PATH)
+    - the compression of the responses
+Tables are created according to DATABASE_INIT, like setup_db: 'eager' on startup, 'lazy' on the first request, 'manual' never.
+
+The mode is selected when the server starts, with the TRIVIA_SERVER_MODE environment variable:
+
+    TRIVIA_SERVER_MODE=async uvicorn --factory flaskr.asgi:create_server_app
+    TRIVIA_SERVER_MODE=sync uvicorn --factory flaskr.asgi:create_server_app   (the Flask app, on a thread pool)
+
+`flask run` and gunicorn keep serving the Flask app as before.
+"""
+import asyncio
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+from urllib.parse import parse_qs, parse_qsl
+
+from sqlalchemy import select, func, desc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from models import db, Question, Category, QuestionCount, default_database_path, DEFAULT_ENGINE_OPTIONS, DATABASE_INIT, QUESTION_ROW_COLUMNS, ALL_QUESTIONS, \
+    format_question_row, question_count_updates, missing_question_counts_query
+from . import create_app, QuestionCountCache, get_page_size, get_page_offset, get_new_question, get_search_term, get_quiz_request, \
+    get_questions_page_body, get_categories_body, get_quiz_question_body, get_question_response_tags, QUESTIONS_PER_PAGE, MAX_QUESTIONS_PER_PAGE
+from .quiz import QuizQuestionSelector
+from .search import PostgresQuestionSearch, InvertedIndexQuestionSearch
+from .categories import CategoryCache, CATEGORY_CACHE_SECONDS
+from .response_cache import CachedResponse, create_response_cache
+from .rate_limit import create_rate_limit
+
+logger = logging.getLogger('flaskr.asgi')
+
+# the async driver used for each database, and the package it needs (see requirements-async.txt)
+ASYNC_DRIVERS = {
+    'postgresql': ('postgresql+asyncpg', 'asyncpg'),
+    'sqlite': ('sqlite+aiosqlite', 'aiosqlite')
+}
+
+ERROR_MESSAGES = {
+    400: 'Bad Request',
+    404: 'Resource Not Found',
+    405: 'Method Not Allowed',
+    422: 'Unprocessable Entity',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error'
+}
+
+# same headers as the after_request hook and Flask-CORS of create_app
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+    (b'access-control-allow-methods', b'GET,PUT,POST,DELETE,PATCH,OPTIONS')
+]
+
+
+class HTTPError(Exception):
+    def __init__(self, status, description=None, headers=None):
+        super().__init__(description)
+        self.status = status
+        self.headers = headers or []
+
+
+# the same URL as the Flask app, with the async driver of the database.
+# Raises RuntimeError if there is no async driver for the database, or if its package is not installed
+def get_async_database_url(database_path):
+    url = make_url(database_path)
+    backend_name = url.get_backend_name()
+    if backend_name not in ASYNC_DRIVERS:
+        raise RuntimeError('The async mode does not support {} databases, only {}'.format(backend_name, ', '.join(ASYNC_DRIVERS)))
+    drivername, package = ASYNC_DRIVERS[backend_name]
+    if importlib.util.find_spec(package) is None:
+        raise RuntimeError('The async mode needs the {} package for {}: pip install -r requirements-async.txt'.format(package, backend_name))
+    return url.set(drivername=drivername)
+
+
+class AsyncRequest:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        query_string = scope.get('query_string', b'').decode('latin-1')
+        self.args = parse_qs(query_string, keep_blank_values=True)
+        # (name, value) pairs in the order of the query string, like request.args.items(multi=True)
+        self.arguments = parse_qsl(query_string, keep_blank_values=True)
+        self.client_address = (scope.get('client') or [None])[0]
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+        self.body = body
+
+    # like request.args.get of Flask: default if the argument is missing or cannot be converted
+    def get_arg(self, name, default=None, type=None):
+        if name not in self.args:
+            return default
+        value = self.args[name][0]
+        try:
+            return type(value) if type else value
+        except ValueError:
+            return default
+
+    def get_json(self):
+        if not self.body:
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400, 'Request body is not valid JSON')
+
+
+class AsyncResponse:
+    def __init__(self, body=None, status=200, headers=None):
+        self.status = status
+        self.headers = list(headers or [])
+        if body is None:
+            self.body = b''
+        else:
+            # same JSON as jsonify: sorted keys, compact separators
+            self.body = json.dumps(body, sort_keys=True, separators=(',', ':')).encode('utf-8')
+            self.headers.append((b'content-type', b'application/json'))
+
+
+class AsyncTriviaApp:
+    """
+    The ASGI application. It keeps the same in-memory helpers as create_app (count cache, category cache,
+    quiz question pools, search index, response cache, rate limit), and loads them through an AsyncSession instead of db.session.
+    The request parsing and the JSON bodies are the functions of flaskr/__init__.py the Flask routes use.
+    """
+    def __init__(self, config):
+        database_path = config.get('SQLALCHEMY_DATABASE_URI') or default_database_path
+        database_url = get_async_database_url(config.get('ASYNC_DATABASE_URI') or database_path)
+        engine_options = {}
+        if database_url.get_backend_name() != 'sqlite':
+            engine_options.update(DEFAULT_ENGINE_OPTIONS)
+        self.engine = create_async_engine(database_url, **engine_options)
+        self.session_factory = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.is_postgres = database_url.get_backend_name() == 'postgresql'
+        self.database_init = config.get('DATABASE_INIT', DATABASE_INIT)
+        self.database_initialized = False
+        self.database_init_lock = asyncio.Lock()
+
+        self.question_count_cache = QuestionCountCache()
+        self.category_cache = CategoryCache(ttl=config.get('CATEGORY_CACHE_SECONDS', CATEGORY_CACHE_SECONDS))
+        # the decks are reloaded by get_current_quiz_question through the AsyncSession, never by the selector itself
+        self.quiz_question_selector = QuizQuestionSelector(reload_on_read=False)
+        self.full_text_search = PostgresQuestionSearch()
+        self.inverted_index = InvertedIndexQuestionSearch()
+        self.response_cache = create_response_cache(config)
+        self.rate_limit = create_rate_limit(config)
+        self.question_page_size = config.get('QUESTIONS_PER_PAGE', QUESTIONS_PER_PAGE)
+        self.max_question_page_size = config.get('MAX_QUESTIONS_PER_PAGE', MAX_QUESTIONS_PER_PAGE)
+
+        # (method, rule, handler, options): 'tags' caches the responses like @response_cache.cached (called with the path arguments),
+        # 'rate_limited' takes a token like @rate_limit.limited
+        self.routes = [
+            ('GET', '/categories', self.get_all_categories, {'tags': lambda: ['categories']}),
+            ('GET', '/questions', self.get_paginated_questions, {'tags': lambda: ['questions']}),
+            ('POST', '/questions', self.create_a_new_question, {}),
+            ('DELETE', '/questions/<int>', self.delete_question, {}),
+            ('POST', '/questions/search', self.search_questions, {'rate_limited': True}),
+            ('GET', '/categories/<int>/questions', self.get_questions_based_on_category, {'tags': lambda category_id: ['category:{}'.format(category_id)]}),
+            ('POST', '/quizzes', self.get_current_quiz_question, {'rate_limited': True})
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+            return
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        if self.database_init == 'lazy':
+            await self.ensure_db_initialized()
+        response = await self.dispatch(AsyncRequest(scope, body))
+        await send({'type': 'http.response.start', 'status': response.status, 'headers': response.headers + CORS_HEADERS})
+        await send({'type': 'http.response.body', 'body': response.body})
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.database_init == 'eager':
+                    await self.ensure_db_initialized()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # like ensure_db_initialized of models.py: create the tables that do not exist yet, once
+    async def ensure_db_initialized(self):
+        if self.database_initialized:
+            return
+        async with self.database_init_lock:
+            if not self.database_initialized:
+                async with self.engine.begin() as connection:
+                    await connection.run_sync(db.Model.metadata.create_all)
+                self.database_initialized = True
+
+    # find the handler of the route, and turn HTTPError into the JSON errors of create_app
+    async def dispatch(self, request):
+        if request.method == 'OPTIONS':
+            return AsyncResponse()
+        path_matched = False
+        for method, rule, handler, options in self.routes:
+            path_arguments = match_rule(rule, request.path)
+            if path_arguments is None:
+                continue
+            path_matched = True
+            if method != request.method:
+                continue
+            try:
+                if options.get('rate_limited'):
+                    self.take_rate_limit_token(request, handler)
+                if 'tags' in options:
+                    return await self.cached_response(request, handler, path_arguments, options['tags'](*path_arguments))
+                return await self.call_handler(request, handler, path_arguments)
+            except HTTPError as error:
+                return self.error_response(error.status, error.headers)
+            except Exception:
+                logger.exception('Exception on %s %s', request.method, request.path)
+                return self.error_response(500)
+        return self.error_response(405 if path_matched else 404)
+
+    async def call_handler(self, request, handler, path_arguments):
+        async with self.session_factory() as session:
+            return await handler(request, session, *path_arguments)
+
+    # the same buckets as @rate_limit.limited: the key is the name of the handler, which is the endpoint of the Flask route
+    def take_rate_limit_token(self, request, handler):
+        allowed, retry_after = self.rate_limit.acquire(handler.__name__, request.client_address)
+        if not allowed:
+            raise HTTPError(429, 'Rate limit exceeded, retry in {} seconds'.format(retry_after),
+                            headers=[(b'retry-after', str(retry_after).encode('latin-1'))])
+
+    # the same as @response_cache.cached: 200 responses are kept with an ETag and a Cache-Control, and If-None-Match gets a 304
+    async def cached_response(self, request, handler, path_arguments, tags):
+        key = self.response_cache.make_key(request.path, request.arguments)
+        cached_response = self.response_cache.get(key)
+        if cached_response is None:
+            invalidations_before = self.response_cache.invalidations
+            response = await self.call_handler(request, handler, path_arguments)
+            if response.status != 200:
+                return response
+            headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in response.headers]
+            header_names = {name for name, _ in headers}
+            if 'etag' not in header_names:
+                headers.append(('etag', '"{}"'.format(hashlib.sha1(response.body).hexdigest())))
+            if 'cache-control' not in header_names:
+                headers.append(('cache-control', 'public, max-age={}'.format(self.response_cache.max_age)))
+            cached_response = CachedResponse(response.status, headers, response.body)
+            self.response_cache.set(key, cached_response, tags, invalidations_before)
+        headers = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in cached_response.headers]
+        etag = dict(cached_response.headers).get('etag')
+        if etag is not None and request.headers.get('if-none-match') == etag:
+            return AsyncResponse(status=304, headers=[header for header in headers if header[0] != b'content-type'])
+        response = AsyncResponse(status=cached_response.status_code, headers=headers)
+        response.body = cached_response.body
+        return response
+
+    def error_response(self, status, headers=None):
+        return AsyncResponse({
+            'success': False,
+            'error': status,
+            'message': ERROR_MESSAGES[status]
+            }, status, headers)
+
+    # drop what new or deleted questions of these categories make stale, like the Flask routes
+    def invalidate_question_data(self, *category_ids):
+        self.question_count_cache.invalidate()
+        self.category_cache.invalidate()
+        self.response_cache.invalidate_tags(get_question_response_tags(category_ids))
+
+    async def get_category_catalogue(self, session):
+        catalogue = self.category_cache.get_cached()
+        if catalogue is None:
+            invalidations_before = self.category_cache.invalidations
+            list_of_all_categories = (await session.execute(select(Category).order_by(Category.id))).scalars().all()
+            question_counts = dict((await session.execute(select(QuestionCount.category_id, QuestionCount.count))).all())
+            query = missing_question_counts_query(question_counts, [category.id for category in list_of_all_categories])
+            if query is not None:
+                question_counts.update(dict((await session.execute(query)).all()))
+            catalogue = self.category_cache.store(list_of_all_categories, question_counts, invalidations_before)
+        return catalogue
+
+    # same as models.count_questions: read the question counter, COUNT(*) if there is none
+    async def count_questions(self, session, category_id=None):
+        count = self.question_count_cache.get_cached(category_id)
+        if count is not None:
+            return count
+        invalidations_before = self.question_count_cache.invalidations
+        count = (await session.execute(select(QuestionCount.count).where(QuestionCount.category_id == (category_id or ALL_QUESTIONS)))).scalar()
+        if count is None:
+            statement = select(func.count()).select_from(Question)
+            if category_id is not None:
+                statement = statement.where(Question.category == category_id)
+            count = (await session.execute(statement)).scalar()
+        self.question_count_cache.store(category_id, count, invalidations_before)
+        return count
+
+    def get_page_size(self, request):
+        return get_page_size(request.get_arg('per_page', None, type=int), self.question_page_size, self.max_question_page_size)
+
+    # same as paginate_questions, on a select() of QUESTION_ROW_COLUMNS ordered by Question.id
+    async def paginate_questions(self, request, session, statement, page_size):
+        after_id = request.get_arg('after_id', None, type=int)
+        offset = get_page_offset(request.get_arg('page', 1, type=int), after_id, page_size)
+        if offset is None:
+            return []
+        if after_id is not None:
+            statement = statement.where(Question.id > after_id)
+        list_of_questions_on_this_page = (await session.execute(statement.offset(offset).limit(page_size))).all()
+        return [format_question_row(row) for row in list_of_questions_on_this_page]
+
+    async def get_all_categories(self, request, session):
+        category_catalogue = await self.get_category_catalogue(session)
+        if category_catalogue.total_categories == 0:
+            raise HTTPError(404)
+        return AsyncResponse(get_categories_body(category_catalogue), headers=[
+            (b'etag', '"{}"'.format(category_catalogue.etag).encode('latin-1')),
+            (b'cache-control', b'public, no-cache')
+        ])
+
+    async def get_paginated_questions(self, request, session):
+        page_size = self.get_page_size(request)
+        list_of_questions_on_this_page = await self.paginate_questions(request, session, select(*QUESTION_ROW_COLUMNS).order_by(Question.id), page_size)
+        if len(list_of_questions_on_this_page) == 0:
+            raise HTTPError(404)
+        return AsyncResponse(get_questions_page_body(list_of_questions_on_this_page, await self.count_questions(session), None, page_size,
+                                                     'after_id' in request.args, categories=(await self.get_category_catalogue(session)).categories))
+
+    async def delete_question(self, request, session, id):
+        question_to_be_deleted = await session.get(Question, id)
+        if question_to_be_deleted is None:
+            raise HTTPError(404, 'Question with id {} not found'.format(id))
+        await session.delete(question_to_be_deleted)
+        for statement in question_count_updates({question_to_be_deleted.category: -1}):
+            await session.execute(statement)
+        await session.commit()
+        self.invalidate_question_data(question_to_be_deleted.category)
+        self.quiz_question_selector.remove_question(id)
+        self.inverted_index.remove_question(id)
+        return AsyncResponse({
+            'success': True,
+            'deleted_question_id': id
+            })
+
+    async def create_a_new_question(self, request, session):
+        try:
+            new_question = get_new_question(request.get_json())
+        except ValueError as error:
+            raise HTTPError(400, str(error))
+        session.add(new_question)
+        for statement in question_count_updates({new_question.category: 1}):
+            await session.execute(statement)
+        await session.commit()
+        self.invalidate_question_data(new_question.category)
+        self.quiz_question_selector.add_question(new_question)
+        self.inverted_index.add_question(new_question)
+        return AsyncResponse({
+            'success': True,
+            'created_question_id': new_question.id
+            }, 201)
+
+    async def search_questions(self, request, session):
+        try:
+            search_term = get_search_term(request.get_json())
+        except ValueError as error:
+            raise HTTPError(400, str(error))
+        # if search term is empty, return all questions
+        if search_term == '':
+            return AsyncResponse(status=302, headers=[(b'location', b'/questions')])
+        page = max(request.get_arg('page', 1, type=int), 1)
+        page_size = self.get_page_size(request)
+        offset = (page - 1) * page_size
+        if self.is_postgres:
+            found_questions, total_questions = await self.full_text_search_questions(session, search_term, page_size, offset)
+        else:
+            found_questions, total_questions = await self.inverted_index_search_questions(session, search_term, page_size, offset)
+        return AsyncResponse({
+            'success': True,
+            'questions': [format_question_row(row) for row in found_questions],
+            'total_questions': total_questions,
+            'current_category': None
+            })
+
+    # the same queries as PostgresQuestionSearch.search
+    async def full_text_search_questions(self, session, search_term, page_size, offset):
+        ts_query = self.full_text_search.build_query(search_term)
+        if ts_query is None:
+            return [], 0
+        document = self.full_text_search.document
+        matches = document.op('@@')(ts_query)
+        total_questions = (await session.execute(select(func.count()).select_from(Question).where(matches))).scalar()
+        statement = select(*QUESTION_ROW_COLUMNS).where(matches).order_by(desc(func.ts_rank(document, ts_query)), Question.id)
+        found_questions = (await session.execute(statement.offset(offset).limit(page_size))).all()
+        return found_questions, total_questions
+
+    async def inverted_index_search_questions(self, session, search_term, page_size, offset):
+        if self.inverted_index.needs_reload():
+            self.inverted_index.load((await session.execute(select(Question.id, Question.question))).all())
+        ids_on_this_page, total_questions = self.inverted_index.search_ids(search_term, page_size, offset)
+        rows = (await session.execute(select(*QUESTION_ROW_COLUMNS).where(Question.id.in_(ids_on_this_page)))).all()
+        questions_by_id = {row.id: row for row in rows}
+        return [questions_by_id[question_id] for question_id in ids_on_this_page if question_id in questions_by_id], total_questions
+
+    async def get_questions_based_on_category(self, request, session, category_id):
+        category = await session.get(Category, category_id)
+        if not category:
+            raise HTTPError(422, 'Category with id {} does not exist'.format(category_id))
+        statement = select(*QUESTION_ROW_COLUMNS).where(Question.category == category_id).order_by(Question.id)
+        page_size = self.get_page_size(request)
+        list_of_questions_on_this_page = await self.paginate_questions(request, session, statement, page_size)
+        return AsyncResponse(get_questions_page_body(list_of_questions_on_this_page, await self.count_questions(session, category_id), category_id,
+                                                     page_size, 'after_id' in request.args))
+
+    async def get_current_quiz_question(self, request, session):
+        try:
+            id_of_quiz_category, previous_questions, difficulty = get_quiz_request(request.get_json())
+        except ValueError as error:
+            raise HTTPError(400, str(error))
+
+        if self.quiz_question_selector.needs_reload():
+            self.quiz_question_selector.load((await session.execute(select(Question.id, Question.category, Question.difficulty))).all())
+        random_question = None
+        while random_question is None:
+            question_id = self.quiz_question_selector.pick_question_id(id_of_quiz_category, previous_questions, difficulty)
+            if question_id is None:
+                break
+            random_question = await session.get(Question, question_id)
+            if random_question is None:
+                # the question was deleted by another worker since the pools were loaded
+                self.quiz_question_selector.remove_question(question_id)
+        return AsyncResponse(get_quiz_question_body(random_question, difficulty))
+
+
+# '/questions/<int>' matches '/questions/12' and returns [12], None if path does not match rule
+def match_rule(rule, path):
+    rule_parts = rule.strip('/').split('/')
+    path_parts = path.strip('/').split('/')
+    if len(rule_parts) != len(path_parts):
+        return None
+    path_arguments = []
+    for rule_part, path_part in zip(rule_parts, path_parts):
+        if rule_part == '<int>':
+            if not path_part.isdigit():
+                return None
+            path_arguments.append(int(path_part))
+        elif rule_part != path_part:
+            return None
+    return path_arguments
+
+
+def create_asgi_app(test_config=None):
+    config = dict(test_config or {})
+    return AsyncTriviaApp(config)
+
+
+# the ASGI app of the mode selected by TRIVIA_SERVER_MODE ('sync', the default, or 'async').
+# In sync mode the Flask app runs on a pool of TRIVIA_SYNC_THREADS threads, like a threaded gunicorn worker.
+def create_server_app(test_config=None):
+    server_mode = (test_config or {}).get('TRIVIA_SERVER_MODE') or os.getenv('TRIVIA_SERVER_MODE', 'sync')
+    if server_mode == 'async':
+        return create_asgi_app(test_config)
+    from uvicorn.middleware.wsgi import WSGIMiddleware
+    return WSGIMiddleware(create_app(test_config), workers=int(os.getenv('TRIVIA_SYNC_THREADS', 10)))
@@ -0,0 +1,177 @@
+import csv
+import io
+import json
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, read_only_session, update_question_counts, reconcile_question_counts, Question, Category
+from .quiz import to_integer
+
+# how many questions are inserted per statement (and committed per transaction) by import_questions
+IMPORT_BATCH_SIZE = 1000
+# how many questions are fetched per round trip by export_questions
+EXPORT_BATCH_SIZE = 1000
+# at most this many per-row errors are reported back, the others are only counted
+MAX_REPORTED_ERRORS = 1000
+
+QUESTION_COLUMNS = ['question', 'answer', 'category', 'difficulty']
+
+
+# check one row of an import, the same way POST /questions does, and return it ready to be inserted.
+# Raises ValueError with the reason if the row is not a valid question.
+def validate_question_row(row, category_ids):
+    if not isinstance(row, dict):
+        raise ValueError('Row is not a JSON object')
+    if not all(row.get(column) for column in QUESTION_COLUMNS):
+        raise ValueError('One of the required fields is empty')
+    message = 'category, difficulty and id must be integers'
+    question_row = {
+        'question': str(row['question']),
+        'answer': str(row['answer']),
+        'category': to_integer(row['category'], message),
+        'difficulty': to_integer(row['difficulty'], message)
+        }
+    if row.get('id') is not None:
+        question_row['id'] = to_integer(row['id'], message)
+    if question_row['category'] not in category_ids:
+        raise ValueError('Category with id {} does not exist'.format(question_row['category']))
+    return question_row
+
+
+# insert a batch of validated rows in one statement: COPY on PostgreSQL, executemany anywhere else.
+# The question counters are updated in the same transaction.
+def insert_question_rows(rows):
+    rows_with_id = [row for row in rows if 'id' in row]
+    rows_without_id = [row for row in rows if 'id' not in row]
+    if rows_without_id and db.session.connection().dialect.driver == 'psycopg2':
+        copy_question_rows(rows_without_id)
+    elif rows_without_id:
+        db.session.execute(Question.__table__.insert(), rows_without_id)
+    if rows_with_id:
+        db.session.execute(Question.__table__.insert(), rows_with_id)
+    category_deltas = {}
+    for row in rows:
+        category_deltas[row['category']] = category_deltas.get(row['category'], 0) + 1
+    update_question_counts(category_deltas)
+
+
+def copy_question_rows(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in QUESTION_COLUMNS])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('COPY questions ({}) FROM STDIN WITH (FORMAT csv)'.format(', '.join(QUESTION_COLUMNS)), buffer)
+
+
+# rows imported with their own id do not move the id sequence of PostgreSQL forward, so move it past the largest id
+def reset_question_id_sequence():
+    if db.session.connection().dialect.name == 'postgresql':
+        db.session.execute(text("SELECT setval(pg_get_serial_sequence('questions', 'id'), coalesce(max(id), 1)) FROM questions"))
+
+
+"""
+import_questions(lines)
+    inserts the questions of an NDJSON stream (one JSON question per line, like the body of POST /questions,
+    optionally with an id), IMPORT_BATCH_SIZE rows per statement and per commit.
+    Invalid rows are skipped and reported with their line number.
+    Returns the number of inserted questions, the number of rejected rows and the reported errors.
+"""
+def import_questions(lines, batch_size=IMPORT_BATCH_SIZE):
+    category_ids = {category_id for (category_id,) in db.session.query(Category.id)}
+    summary = {'inserted_questions': 0, 'rejected_questions': 0, 'errors': []}
+    # (line number, row) of the valid rows waiting to be inserted
+    batch = []
+    has_explicit_ids = False
+
+    def reject(line_number, error):
+        summary['rejected_questions'] += 1
+        if len(summary['errors']) < MAX_REPORTED_ERRORS:
+            summary['errors'].append({'line': line_number, 'error': error})
+
+    def flush():
+        try:
+            insert_question_rows([row for _, row in batch])
+            db.session.commit()
+            summary['inserted_questions'] += len(batch)
+        except SQLAlchemyError:
+            # a row was refused by the database (e.g. a duplicate id), so insert this batch one row at a time to find it
+            db.session.rollback()
+            for line_number, row in batch:
+                try:
+                    insert_question_rows([row])
+                    db.session.commit()
+                    summary['inserted_questions'] += 1
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    # the text of the database error names tables and constraints, so it only goes to the log
+                    current_app.logger.warning('Import of line %s refused by the database', line_number, exc_info=True)
+                    reject(line_number, 'Unprocessable Entity: refused by the database (e.g. a duplicate id)')
+        batch.clear()
+
+    for line_number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            question_row = validate_question_row(json.loads(line), category_ids)
+        except ValueError as error:
+            # json.JSONDecodeError is a ValueError too
+            reject(line_number, str(error))
+            continue
+        has_explicit_ids = has_explicit_ids or 'id' in question_row
+        batch.append((line_number, question_row))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    if has_explicit_ids:
+        reset_question_id_sequence()
+        db.session.commit()
+    return summary
+
+
+"""
+export_questions()
+    yields every question as one line of NDJSON, ordered by id.
+    Questions are read EXPORT_BATCH_SIZE rows at a time from a server-side cursor (on PostgreSQL),
+    so the whole table is never held in memory.
+"""
+def export_questions(batch_size=EXPORT_BATCH_SIZE):
+    query = read_only_session().query(Question.id, Question.question, Question.answer, Question.category, Question.difficulty) \
+        .order_by(Question.id) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+    for question_id, question, answer, category, difficulty in query:
+        yield json.dumps({
+            'id': question_id,
+            'question': question,
+            'answer': answer,
+            'category': category,
+            'difficulty': difficulty
+            }) + '\n'
+
+
+# same as import_questions / export_questions, for the categories (one {"id": ..., "type": ...} per line).
+# The question counters are reconciled afterwards, so that the new categories get theirs.
+def import_categories(lines):
+    inserted_categories = 0
+    for line in lines:
+        if line.strip():
+            db.session.merge(Category(**json.loads(line)))
+            inserted_categories += 1
+    db.session.commit()
+    if db.session.connection().dialect.name == 'postgresql':
+        db.session.execute(text("SELECT setval(pg_get_serial_sequence('categories', 'id'), coalesce(max(id), 1)) FROM categories"))
+        db.session.commit()
+    reconcile_question_counts()
+    return inserted_categories
+
+
+def export_categories():
+    for category in read_only_session().query(Category).order_by(Category.id):
+        yield json.dumps(category.format()) + '\n'
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import threading
+import time
+
+from models import read_only_session, read_question_counts, missing_question_counts_query, Category, ALL_QUESTIONS
+
+# how long (in seconds) the cached categories are trusted before they are read again from the database
+CATEGORY_CACHE_SECONDS = 300
+
+
+class CategoryCatalogue:
+    """
+    The categories as every endpoint returns them (id: type), their number, the number of questions
+    of each category (id: count) and in total, and a strong ETag computed from their content.
+    """
+    def __init__(self, categories, question_counts=None):
+        question_counts = question_counts or {}
+        self.categories = categories
+        self.total_categories = len(categories)
+        self.question_counts = {category_id: question_counts.get(category_id, 0) for category_id in categories}
+        self.total_questions = question_counts.get(ALL_QUESTIONS, 0)
+        self.etag = hashlib.sha1(json.dumps([categories, self.question_counts], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CategoryCache:
+    """
+    Caches the categories table, which almost never changes, and the question counters, so that GET /categories and GET /questions
+    do not query them on every request. The cache expires after ttl seconds, and invalidate() drops it right away
+    (the endpoints creating or deleting questions call it, since the counts change).
+    Hits and misses are counted, see stats().
+    """
+    def __init__(self, ttl=CATEGORY_CACHE_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.catalogue = None
+        self.loaded_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self):
+        catalogue = self.get_cached()
+        if catalogue is None:
+            invalidations_before = self.invalidations
+            session = read_only_session()
+            list_of_all_categories = session.query(Category).order_by(Category.id).all()
+            question_counts = read_question_counts(session)
+            # a category without a counter (e.g. inserted by hand, before the next reconcile) is counted with COUNT(*), not shown as empty
+            query = missing_question_counts_query(question_counts, [category.id for category in list_of_all_categories])
+            if query is not None:
+                question_counts.update(dict(session.execute(query).all()))
+            catalogue = self.store(list_of_all_categories, question_counts, invalidations_before)
+        return catalogue
+
+    # the cached catalogue, or None (counted as a miss) if it is not cached or has expired
+    def get_cached(self):
+        with self.lock:
+            if self.catalogue is not None and time.monotonic() - self.loaded_at < self.ttl:
+                self.hits += 1
+                return self.catalogue
+            self.misses += 1
+            return None
+
+    # cache the categories read from the database (ordered by id) and the question counters, and return them as a catalogue.
+    # invalidations_before is self.invalidations taken before the database was read: if a write invalidated the cache since,
+    # what was read may be stale, so it is returned to this request but not kept
+    def store(self, list_of_all_categories, question_counts=None, invalidations_before=None):
+        catalogue = CategoryCatalogue({category.id: category.type for category in list_of_all_categories}, question_counts)
+        with self.lock:
+            if invalidations_before is None or self.invalidations == invalidations_before:
+                self.catalogue = catalogue
+                self.loaded_at = time.monotonic()
+        return catalogue
+
+    def invalidate(self):
+        with self.lock:
+            self.catalogue = None
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'cached': self.catalogue is not None
+                }
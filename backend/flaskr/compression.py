@@ -0,0 +1,109 @@
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# responses smaller than this (in bytes) are sent as they are: compressing them saves less than the CPU it costs
+COMPRESSION_MIN_BYTES = 1024
+# zlib level of gzip (1 fastest .. 9 smallest) and brotli quality (0 fastest .. 11 smallest).
+# The responses are compressed on every request, so both are kept low: brotli 4 is about as fast as gzip 6 and smaller
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+# responses of these types are compressed
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/plain', 'text/html', 'text/csv'}
+
+
+"""
+create_compressor(encoding, gzip_level, brotli_quality)
+    returns (compress, flush, finish): compress(chunk) and flush() return the compressed bytes ready to be sent,
+    flush() forcing out everything given so far (for streamed responses), and finish() returns the end of the stream
+"""
+def create_compressor(encoding, gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=brotli_quality)
+        return compressor.process, compressor.flush, compressor.finish
+    # wbits 31: the gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def compress(data, encoding, gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY):
+    compress_chunk, _, finish = create_compressor(encoding, gzip_level, brotli_quality)
+    return compress_chunk(data) + finish()
+
+
+class ResponseCompression:
+    """
+    Compresses the responses with the best encoding the client accepts (Accept-Encoding, with its q-values)
+    among encodings, brotli first. Responses smaller than min_bytes are left alone. Streamed responses
+    (GET /questions/export, large question pages) are compressed chunk by chunk, each chunk flushed so the client
+    can decode it right away. A compressed response gets a weak ETag, since its bytes differ from the uncompressed one,
+    and If-None-Match still matches it (the weak comparison is used). Every compressible response gets
+    Vary: Accept-Encoding, so a shared cache does not send a compressed body to a client that cannot read it.
+    """
+    def __init__(self, encodings, min_bytes=COMPRESSION_MIN_BYTES, gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY):
+        self.encodings = encodings
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    # after_request hook
+    def compress_response(self, response):
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code < 200 or response.status_code in (204, 206, 304) or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers or request.method == 'HEAD':
+            return response
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = self.compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_bytes:
+                return response
+            response.set_data(compress(data, encoding, self.gzip_level, self.brotli_quality))
+        response.headers['Content-Encoding'] = encoding
+        etag, is_weak = response.get_etag()
+        if etag is not None and not is_weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def compress_stream(self, chunks, encoding):
+        compress_chunk, flush, finish = create_compressor(encoding, self.gzip_level, self.brotli_quality)
+        try:
+            for chunk in chunks:
+                compressed_chunk = compress_chunk(chunk.encode('utf-8') if isinstance(chunk, str) else chunk) + flush()
+                if compressed_chunk:
+                    yield compressed_chunk
+            yield finish()
+        finally:
+            # let the generator of the response clean up (e.g. close its database cursor and app context)
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+
+"""
+register_compression(app)
+    compresses the responses of app, from the app config: RESPONSE_COMPRESSION (True by default, False turns it off),
+    COMPRESSION_MIN_BYTES, GZIP_LEVEL and BROTLI_QUALITY. brotli is offered if the brotli package is installed, gzip always.
+    Behind a reverse proxy that already compresses (nginx gzip on), turn it off to not compress twice
+"""
+def register_compression(app):
+    if not app.config.get('RESPONSE_COMPRESSION', True):
+        return None
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    response_compression = ResponseCompression(
+        encodings,
+        min_bytes=app.config.get('COMPRESSION_MIN_BYTES', COMPRESSION_MIN_BYTES),
+        gzip_level=app.config.get('GZIP_LEVEL', GZIP_LEVEL),
+        brotli_quality=app.config.get('BROTLI_QUALITY', BROTLI_QUALITY))
+    app.after_request(response_compression.compress_response)
+    return response_compression
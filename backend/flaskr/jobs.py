@@ -0,0 +1,353 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+# worker threads running the jobs of each process
+JOB_WORKERS = 2
+# how often (in seconds) an idle worker looks for new jobs; a job enqueued in the same process wakes it right away
+JOB_POLL_SECONDS = 0.5
+# finished jobs are kept this long (in seconds) so their status can be read, then dropped
+JOB_HISTORY_SECONDS = 3600
+# the in-process store keeps at most this many finished jobs
+MAX_FINISHED_JOBS = 1000
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class Job:
+    """
+    A call of a registered job function by name, with JSON arguments, so that a job can be stored in SQLite and run by
+    another worker process. owner is the pid of the process that must run it (for jobs rebuilding the in-memory indexes
+    of that process), or None if any process may. The result (or the error message) is kept once the job has run.
+    """
+    def __init__(self, name, arguments, owner=None, run_after=0, id=None, status=QUEUED, enqueued_at=None,
+                 started_at=None, finished_at=None, result=None, error=None):
+        self.id = id
+        self.name = name
+        self.arguments = arguments
+        self.owner = owner
+        self.run_after = run_after
+        self.status = status
+        self.enqueued_at = enqueued_at if enqueued_at is not None else time.time()
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.result = result
+        self.error = error
+
+    def format(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'arguments': self.arguments,
+            'status': self.status,
+            'enqueued_at': self.enqueued_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result': self.result,
+            'error': self.error
+            }
+
+
+class InMemoryJobStore:
+    """
+    Keeps the jobs in this process: lost on restart, and only run by this process' workers.
+    """
+    def __init__(self, max_finished_jobs=MAX_FINISHED_JOBS):
+        self.max_finished_jobs = max_finished_jobs
+        self.lock = threading.Lock()
+        self.next_id = 1
+        # id -> Job, queued and running jobs
+        self.pending = OrderedDict()
+        # id -> Job, oldest first
+        self.finished = OrderedDict()
+        # jobs of this store die with the process, so none is ever run again
+        self.names_not_to_rerun = set()
+
+    def add(self, job):
+        with self.lock:
+            job.id = self.next_id
+            self.next_id += 1
+            self.pending[job.id] = job
+            return job.id
+
+    # the id of a queued job with the same name and arguments, or None
+    def find_queued(self, name, arguments, owner):
+        with self.lock:
+            for job in self.pending.values():
+                if job.status == QUEUED and job.name == name and job.arguments == arguments and job.owner == owner:
+                    return job.id
+        return None
+
+    # mark the oldest job that is due as running, and return it (or None)
+    def claim(self, worker_pid):
+        now = time.time()
+        with self.lock:
+            for job in self.pending.values():
+                if job.status == QUEUED and job.run_after <= now:
+                    job.status = RUNNING
+                    job.started_at = now
+                    return job
+        return None
+
+    def finish(self, job):
+        with self.lock:
+            del self.pending[job.id]
+            self.finished[job.id] = job
+            while len(self.finished) > self.max_finished_jobs or \
+                    (self.finished and next(iter(self.finished.values())).finished_at < time.time() - JOB_HISTORY_SECONDS):
+                self.finished.popitem(last=False)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.pending.get(job_id) or self.finished.get(job_id)
+
+    # number of jobs per status
+    def count(self):
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        with self.lock:
+            for job in list(self.pending.values()) + list(self.finished.values()):
+                counts[job.status] += 1
+        return counts
+
+
+class SqliteJobStore:
+    """
+    Keeps the jobs in a SQLite file, so queued jobs survive a restart and every worker process on the machine
+    (all using the same file) shares the queue. A job is claimed in an IMMEDIATE transaction, so two processes
+    never run the same job. Jobs left running by a process that died are queued again when the store is opened,
+    except the jobs named in names_not_to_rerun, which may have partly run (an import would insert its rows twice): they fail.
+    """
+    columns = ['id', 'name', 'arguments', 'owner', 'run_after', 'status', 'enqueued_at', 'started_at', 'finished_at', 'result', 'error']
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+        self.names_not_to_rerun = set()
+
+    # one connection per process, opened on first use (not in the parent of forked workers), and used under the lock
+    # by the request and worker threads. Must be called with the lock held
+    def get_connection(self):
+        if self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.connection_pid = os.getpid()
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, '
+                                    'arguments TEXT NOT NULL, owner INTEGER, worker INTEGER, run_after REAL NOT NULL, status TEXT NOT NULL, '
+                                    'enqueued_at REAL NOT NULL, started_at REAL, finished_at REAL, result TEXT, error TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS ix_jobs_status_run_after ON jobs (status, run_after)')
+            self.requeue_jobs_of_dead_workers()
+        return self.connection
+
+    def requeue_jobs_of_dead_workers(self):
+        for job_id, name, worker_pid in self.connection.execute('SELECT id, name, worker FROM jobs WHERE status = ?', (RUNNING,)).fetchall():
+            if is_process_alive(worker_pid):
+                continue
+            if name in self.names_not_to_rerun:
+                self.connection.execute('UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ? AND status = ?',
+                                        (FAILED, time.time(), 'The worker process running the job died', job_id, RUNNING))
+            else:
+                self.connection.execute('UPDATE jobs SET status = ?, worker = NULL, started_at = NULL WHERE id = ? AND status = ?',
+                                        (QUEUED, job_id, RUNNING))
+
+    def to_job(self, row):
+        values = dict(zip(self.columns, row))
+        values['arguments'] = json.loads(values['arguments'])
+        values['result'] = json.loads(values['result']) if values['result'] is not None else None
+        return Job(**values)
+
+    def add(self, job):
+        with self.lock:
+            cursor = self.get_connection().execute(
+                'INSERT INTO jobs (name, arguments, owner, run_after, status, enqueued_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (job.name, json.dumps(job.arguments, sort_keys=True), job.owner, job.run_after, QUEUED, job.enqueued_at))
+            job.id = cursor.lastrowid
+            return job.id
+
+    def find_queued(self, name, arguments, owner):
+        with self.lock:
+            row = self.get_connection().execute('SELECT id FROM jobs WHERE status = ? AND name = ? AND arguments = ? AND owner IS ?',
+                                                (QUEUED, name, json.dumps(arguments, sort_keys=True), owner)).fetchone()
+        return row[0] if row else None
+
+    def claim(self, worker_pid):
+        now = time.time()
+        with self.lock:
+            connection = self.get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute(
+                    'SELECT {} FROM jobs WHERE status = ? AND run_after <= ? AND (owner IS NULL OR owner = ?) ORDER BY id LIMIT 1'
+                    .format(', '.join(self.columns)), (QUEUED, now, worker_pid)).fetchone()
+                if row is not None:
+                    connection.execute('UPDATE jobs SET status = ?, worker = ?, started_at = ? WHERE id = ?', (RUNNING, worker_pid, now, row[0]))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        job = self.to_job(row)
+        job.status = RUNNING
+        job.started_at = now
+        return job
+
+    def finish(self, job):
+        with self.lock:
+            connection = self.get_connection()
+            connection.execute('UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ? WHERE id = ?',
+                               (job.status, job.finished_at, json.dumps(job.result), job.error, job.id))
+            connection.execute('DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?', (DONE, FAILED, time.time() - JOB_HISTORY_SECONDS))
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.get_connection().execute('SELECT {} FROM jobs WHERE id = ?'.format(', '.join(self.columns)), (job_id,)).fetchone()
+        return self.to_job(row) if row else None
+
+    def count(self):
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        with self.lock:
+            for status, count in self.get_connection().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'):
+                counts[status] = count
+        return counts
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """
+    Runs derived-data maintenance (and heavy writes such as bulk imports) off the request thread:
+    a route enqueues a registered job by name and returns right away, and a pool of worker threads runs it
+    inside an app context. The workers are started with the first job, so an app that never enqueues one has no threads.
+    enqueue(unique=True) reuses a queued job with the same name and arguments, so a burst of writes asking
+    for the same rebuild costs one rebuild; delay makes a job wait that many seconds, to gather such bursts.
+    Jobs run, failed and the time they waited and ran are counted per name, see stats() and render_metrics().
+    """
+    def __init__(self, app, store, workers=JOB_WORKERS, poll_seconds=JOB_POLL_SECONDS):
+        self.app = app
+        self.store = store
+        self.number_of_workers = workers
+        self.poll_seconds = poll_seconds
+        self.functions = {}
+        self.local_jobs = set()
+        self.condition = threading.Condition()
+        self.workers = []
+        self.lock = threading.Lock()
+        # name -> [jobs done, jobs failed, seconds waited, seconds run], for the jobs run by this process
+        self.totals = {}
+
+    # local jobs rebuild the in-memory data of the process that enqueued them, so only that process runs them.
+    # rerun=False for the jobs that must not run again from the start when the process running them died
+    def register(self, name, function, local=False, rerun=True):
+        self.functions[name] = function
+        if local:
+            self.local_jobs.add(name)
+        if not rerun:
+            self.store.names_not_to_rerun.add(name)
+
+    def enqueue(self, name, delay=0, unique=False, **arguments):
+        if name not in self.functions:
+            raise KeyError('No job named {}'.format(name))
+        owner = os.getpid() if name in self.local_jobs else None
+        job_id = self.store.find_queued(name, arguments, owner) if unique else None
+        if job_id is None:
+            job_id = self.store.add(Job(name, arguments, owner=owner, run_after=time.time() + delay))
+        self.start_workers()
+        with self.condition:
+            self.condition.notify()
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def start_workers(self):
+        with self.lock:
+            # after a fork (gunicorn --preload), the threads of the parent do not exist in the child
+            self.workers = [worker for worker in self.workers if worker.is_alive()]
+            while len(self.workers) < self.number_of_workers:
+                worker = threading.Thread(target=self.work, name='job-worker-{}'.format(len(self.workers) + 1), daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def work(self):
+        while True:
+            job = self.store.claim(os.getpid())
+            if job is None:
+                with self.condition:
+                    self.condition.wait(self.poll_seconds)
+                continue
+            self.run(job)
+
+    def run(self, job):
+        try:
+            with self.app.app_context():
+                job.result = self.functions[job.name](**job.arguments)
+            job.status = DONE
+        except Exception as error:
+            job.status = FAILED
+            # GET /internal/jobs/<id> is not authenticated: the traceback only goes to the log
+            job.error = traceback.format_exception_only(type(error), error)[-1].strip()
+            self.app.logger.exception('Job %s (%s) failed', job.id, job.name)
+        job.finished_at = time.time()
+        self.store.finish(job)
+        with self.lock:
+            totals = self.totals.setdefault(job.name, [0, 0, 0.0, 0.0])
+            totals[0 if job.status == DONE else 1] += 1
+            totals[2] += max(0.0, job.started_at - max(job.enqueued_at, job.run_after))
+            totals[3] += job.finished_at - job.started_at
+
+    def stats(self):
+        with self.lock:
+            jobs = {name: {'done': done, 'failed': failed, 'wait_seconds': round(wait_seconds, 6), 'run_seconds': round(run_seconds, 6)}
+                    for name, (done, failed, wait_seconds, run_seconds) in sorted(self.totals.items())}
+            workers = sum(1 for worker in self.workers if worker.is_alive())
+        return {
+            'backend': 'sqlite' if isinstance(self.store, SqliteJobStore) else 'memory',
+            'workers': workers,
+            'queue': self.store.count(),
+            'jobs': jobs
+            }
+
+    # queue depth and the job counters of this process, in the Prometheus text format (appended to GET /metrics)
+    def render_metrics(self):
+        stats = self.stats()
+        lines = ['# HELP trivia_jobs Jobs in the queue, per status.', '# TYPE trivia_jobs gauge']
+        for status, count in sorted(stats['queue'].items()):
+            lines.append('trivia_jobs{{status="{}"}} {}'.format(status, count))
+        lines += ['# HELP trivia_jobs_run_total Jobs run by this process, per name and result.', '# TYPE trivia_jobs_run_total counter']
+        for name, totals in stats['jobs'].items():
+            lines.append('trivia_jobs_run_total{{name="{}",result="done"}} {}'.format(name, totals['done']))
+            lines.append('trivia_jobs_run_total{{name="{}",result="failed"}} {}'.format(name, totals['failed']))
+        lines += ['# HELP trivia_job_wait_seconds_total Time jobs waited in the queue once due, per name.', '# TYPE trivia_job_wait_seconds_total counter']
+        for name, totals in stats['jobs'].items():
+            lines.append('trivia_job_wait_seconds_total{{name="{}"}} {}'.format(name, totals['wait_seconds']))
+        lines += ['# HELP trivia_job_run_seconds_total Time spent running jobs, per name.', '# TYPE trivia_job_run_seconds_total counter']
+        for name, totals in stats['jobs'].items():
+            lines.append('trivia_job_run_seconds_total{{name="{}"}} {}'.format(name, totals['run_seconds']))
+        return '\n'.join(lines) + '\n'
+
+
+# build the job queue selected by JOB_QUEUE_BACKEND ('memory', the default, or 'sqlite') in the app config or the environment
+def create_job_queue(app):
+    backend = app.config.get('JOB_QUEUE_BACKEND', os.getenv('JOB_QUEUE_BACKEND', 'memory'))
+    if backend == 'sqlite':
+        path = app.config.get('JOB_QUEUE_PATH', os.getenv('JOB_QUEUE_PATH', os.path.join(tempfile.gettempdir(), 'trivia-jobs.sqlite3')))
+        store = SqliteJobStore(path)
+    else:
+        store = InMemoryJobStore()
+    return JobQueue(app, store, workers=int(app.config.get('JOB_WORKERS', os.getenv('JOB_WORKERS', JOB_WORKERS))),
+                    poll_seconds=app.config.get('JOB_POLL_SECONDS', JOB_POLL_SECONDS))
@@ -0,0 +1,176 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request, current_app, has_app_context, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds (in seconds) of the buckets of the request latency histograms
+LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_query_logger = logging.getLogger('flaskr.slow_queries')
+
+
+class LatencyHistogram:
+    """
+    Cumulative histogram in the Prometheus format: how many observations fell into each bucket, their sum and their count.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS_SECONDS):
+        self.buckets = buckets
+        # one more slot for the observations above the largest bucket (le="+Inf")
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # (le, cumulative count) of every bucket, ending with +Inf
+    def cumulative_counts(self):
+        total = 0
+        for bucket, bucket_count in zip(list(self.buckets) + ['+Inf'], self.bucket_counts):
+            total += bucket_count
+            yield bucket, total
+
+
+class RequestMetrics:
+    """
+    Per-endpoint request metrics: a latency histogram and a request count per status code,
+    the number of SQL queries and the time spent in them, and the number of commits (counted by the engine events below).
+    Endpoints are labelled with their route rule ('/questions/<int:question_id>'), so there is one series per route, not per URL.
+    """
+    def __init__(self, slow_query_seconds=None):
+        self.slow_query_seconds = slow_query_seconds
+        self.lock = threading.Lock()
+        # (endpoint, method) -> LatencyHistogram
+        self.latencies = {}
+        # (endpoint, method, status) -> number of requests
+        self.responses = {}
+        # (endpoint, method) -> [number of queries, seconds spent in queries, number of commits]
+        self.queries = {}
+        self.slow_queries = 0
+
+    def observe_request(self, endpoint, method, status, duration, query_count, query_seconds, commit_count=0):
+        with self.lock:
+            key = (endpoint, method)
+            if key not in self.latencies:
+                self.latencies[key] = LatencyHistogram()
+                self.queries[key] = [0, 0.0, 0]
+            self.latencies[key].observe(duration)
+            self.responses[endpoint, method, status] = self.responses.get((endpoint, method, status), 0) + 1
+            self.queries[key][0] += query_count
+            self.queries[key][1] += query_seconds
+            self.queries[key][2] += commit_count
+
+    # called for every SQL statement; logs it if it took longer than slow_query_seconds
+    def observe_query(self, statement, parameters, duration):
+        if has_request_context() and 'query_count' in g:
+            g.query_count += 1
+            g.query_seconds += duration
+        if self.slow_query_seconds is not None and duration >= self.slow_query_seconds:
+            with self.lock:
+                self.slow_queries += 1
+            slow_query_logger.warning('slow query (%.1f ms) on %s: %s %r', duration * 1000,
+                                      request.path if has_request_context() else '-', statement, parameters)
+
+    # called for every commit of a database transaction
+    def observe_commit(self):
+        if has_request_context() and 'commit_count' in g:
+            g.commit_count += 1
+
+    # every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append('# HELP trivia_request_duration_seconds Time spent handling requests, per route.')
+            lines.append('# TYPE trivia_request_duration_seconds histogram')
+            for (endpoint, method), histogram in sorted(self.latencies.items()):
+                labels = 'endpoint="{}",method="{}"'.format(endpoint, method)
+                for bucket, count in histogram.cumulative_counts():
+                    lines.append('trivia_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bucket, count))
+                lines.append('trivia_request_duration_seconds_sum{{{}}} {}'.format(labels, histogram.sum))
+                lines.append('trivia_request_duration_seconds_count{{{}}} {}'.format(labels, histogram.count))
+            lines.append('# HELP trivia_requests_total Requests handled, per route and status code.')
+            lines.append('# TYPE trivia_requests_total counter')
+            for (endpoint, method, status), count in sorted(self.responses.items()):
+                lines.append('trivia_requests_total{{endpoint="{}",method="{}",status="{}"}} {}'.format(endpoint, method, status, count))
+            lines.append('# HELP trivia_db_queries_total SQL queries issued, per route.')
+            lines.append('# TYPE trivia_db_queries_total counter')
+            for (endpoint, method), (query_count, _, _) in sorted(self.queries.items()):
+                lines.append('trivia_db_queries_total{{endpoint="{}",method="{}"}} {}'.format(endpoint, method, query_count))
+            lines.append('# HELP trivia_db_query_duration_seconds_total Time spent in SQL queries, per route.')
+            lines.append('# TYPE trivia_db_query_duration_seconds_total counter')
+            for (endpoint, method), (_, query_seconds, _) in sorted(self.queries.items()):
+                lines.append('trivia_db_query_duration_seconds_total{{endpoint="{}",method="{}"}} {}'.format(endpoint, method, query_seconds))
+            lines.append('# HELP trivia_db_commits_total Database transactions committed, per route.')
+            lines.append('# TYPE trivia_db_commits_total counter')
+            for (endpoint, method), (_, _, commit_count) in sorted(self.queries.items()):
+                lines.append('trivia_db_commits_total{{endpoint="{}",method="{}"}} {}'.format(endpoint, method, commit_count))
+            lines.append('# HELP trivia_db_slow_queries_total SQL queries slower than SLOW_QUERY_SECONDS.')
+            lines.append('# TYPE trivia_db_slow_queries_total counter')
+            lines.append('trivia_db_slow_queries_total {}'.format(self.slow_queries))
+        return '\n'.join(lines) + '\n'
+
+
+# time every statement, on every engine (the primary database, the replica, and any engine bound later by setup_db),
+# and hand it to the RequestMetrics of the current app. The start time is kept on the execution context of the statement,
+# which is dropped with it, so a statement that raises (and never reaches after_cursor_execute) leaves nothing behind
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started_at = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, 'query_started_at', None)
+    if started_at is None:
+        return
+    duration = time.perf_counter() - started_at
+    metrics = current_app.extensions.get('request_metrics') if has_app_context() else None
+    if metrics is not None:
+        metrics.observe_query(statement, parameters, duration)
+
+
+@event.listens_for(Engine, 'commit')
+def commit(connection):
+    metrics = current_app.extensions.get('request_metrics') if has_app_context() else None
+    if metrics is not None:
+        metrics.observe_commit()
+
+
+"""
+register_metrics(app)
+    times every request and counts its SQL queries and commits, adds a Server-Timing header to every response
+    (total time, time in SQL and the number of queries, number of commits, time in Python), and returns the RequestMetrics for GET /metrics.
+    SLOW_QUERY_SECONDS (app config or environment) logs the queries slower than that to the 'flaskr.slow_queries' logger.
+"""
+def register_metrics(app):
+    slow_query_seconds = app.config.get('SLOW_QUERY_SECONDS', os.getenv('SLOW_QUERY_SECONDS'))
+    metrics = RequestMetrics(float(slow_query_seconds) if slow_query_seconds not in (None, '') else None)
+    app.extensions['request_metrics'] = metrics
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started_at = time.perf_counter()
+        g.query_count = 0
+        g.query_seconds = 0.0
+        g.commit_count = 0
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_started_at' not in g:
+            return response
+        duration = time.perf_counter() - g.request_started_at
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_request(endpoint, request.method, response.status_code, duration, g.query_count, g.query_seconds, g.commit_count)
+        response.headers.add('Server-Timing', 'db;dur={:.2f};desc="{} queries", commits;desc="{}", app;dur={:.2f}, total;dur={:.2f}'.format(
+            g.query_seconds * 1000, g.query_count, g.commit_count, (duration - g.query_seconds) * 1000, duration * 1000))
+        return response
+
+    return metrics
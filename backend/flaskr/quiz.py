@@ -0,0 +1,338 @@
+import random
+import threading
+import time
+from array import array
+
+from models import db, Question
+
+# how long (in seconds) the in-memory question ids are trusted before they are reloaded from the database,
+# so that questions created or deleted by other worker processes are eventually picked up
+QUIZ_INDEX_REFRESH_SECONDS = 300
+# how often (in seconds) every deck is reshuffled, on top of the reshuffle each time a deck has been dealt through
+QUIZ_DECK_RESHUFFLE_SECONDS = 60
+# category of the questions that do not exist (anymore) in category_by_id, and of the ids that are not questions
+NO_QUESTION = -1
+# category of the questions without a category in category_by_id (category ids start at 1)
+NO_CATEGORY = 0
+# difficulty of the questions without a difficulty in difficulty_by_id, they are only asked outside of the adaptive mode
+NO_DIFFICULTY = 0
+# the adaptive mode moves between these difficulties, starting at DEFAULT_QUIZ_DIFFICULTY
+MIN_QUIZ_DIFFICULTY = 1
+MAX_QUIZ_DIFFICULTY = 5
+DEFAULT_QUIZ_DIFFICULTY = 3
+# the adaptive mode asks a harder question after this many right answers in a row, and an easier one after as many wrong ones
+ADAPTIVE_STREAK = 2
+
+
+class QuestionDeck:
+    """
+    The ids of the questions of one category (or of every category), shuffled, and the position of the next id to deal.
+    Quizzes of every player are dealt from the same deck: each draw continues from the position and skips the ids
+    the player has already been asked, so no draw scans the questions table or even the whole deck in the common case.
+    The deck is reshuffled each time it has been dealt through, and every QUIZ_DECK_RESHUFFLE_SECONDS.
+    Ids are kept in a compact array('i'), 4 bytes per question, so decks stay small for millions of questions.
+    Deleted questions are left in the array and skipped, until the next reshuffle drops them.
+    """
+    def __init__(self, question_ids=()):
+        self.ids = array('i', question_ids)
+        self.size = len(self.ids)
+        self.position = 0
+        self.reshuffle()
+
+    def reshuffle(self, contains=None):
+        if contains is not None and self.size < len(self.ids):
+            self.ids = array('i', [question_id for question_id in self.ids if contains(question_id)])
+        random.shuffle(self.ids)
+        self.position = 0
+        self.shuffled_at = time.monotonic()
+
+    # insert the new id at a random position, so the deck stays shuffled
+    def add(self, question_id):
+        self.ids.append(question_id)
+        swap_position = random.randrange(len(self.ids))
+        self.ids[-1], self.ids[swap_position] = self.ids[swap_position], question_id
+        self.size += 1
+
+    """
+    deal(contains, asked_questions)
+        returns the next id of the deck that is still in it (contains) and has not been asked yet,
+        or None after going once around the whole deck without finding one.
+    """
+    def deal(self, contains, asked_questions):
+        for _ in range(len(self.ids)):
+            if self.position >= len(self.ids):
+                self.reshuffle(contains)
+            question_id = self.ids[self.position]
+            self.position += 1
+            if question_id not in asked_questions and contains(question_id):
+                return question_id
+        return None
+
+
+class QuizQuestionSelector:
+    """
+    Picks a question that has not been asked yet, for POST /quizzes and the quiz sessions.
+    Keeps one precomputed QuestionDeck for 'ALL' and one per category, and one per (category, difficulty) and per difficulty
+    of 'ALL' for the adaptive mode, so a question of a given difficulty is dealt without any query.
+    The category and the difficulty of every question id are kept in arrays('i') indexed by id (category_by_id,
+    difficulty_by_id), which answer "is this id still in that deck" in O(1).
+    POST /questions and DELETE /questions/<id> update the decks in place; everything is reloaded from the database
+    every QUIZ_INDEX_REFRESH_SECONDS, to pick up the changes of other worker processes.
+    load_rows() and get_question(id) replace the database as the source of the (id, category, difficulty) rows
+    and of the questions, e.g. with the question snapshot.
+    With reload_on_read=False the decks are never reloaded while picking: the caller checks needs_reload() and calls load(rows)
+    itself, e.g. the async mode, which reads the rows through its AsyncSession and has no db.session (no Flask app context).
+    """
+    def __init__(self, refresh_seconds=QUIZ_INDEX_REFRESH_SECONDS, reshuffle_seconds=QUIZ_DECK_RESHUFFLE_SECONDS, load_rows=None, get_question=None,
+                 reload_on_read=True):
+        self.refresh_seconds = refresh_seconds
+        self.reshuffle_seconds = reshuffle_seconds
+        self.load_rows = load_rows
+        self.get_question = get_question
+        self.reload_on_read = reload_on_read
+        self.lock = threading.RLock()
+        # held by the thread reloading the decks, which reads the rows without holding self.lock
+        self.load_lock = threading.Lock()
+        self.all_questions = None
+        self.decks_by_category = {}
+        # (category id, or None for 'ALL', difficulty) -> QuestionDeck
+        self.decks_by_difficulty = {}
+        self.category_by_id = array('i')
+        self.difficulty_by_id = array('i')
+        self.loaded_at = 0
+
+    # rows are the (id, category, difficulty) of every question, from load_rows() or db.session if not given
+    def load(self, rows=None):
+        if rows is None and self.load_rows is not None:
+            rows = self.load_rows()
+        elif rows is None:
+            rows = db.session.query(Question.id, Question.category, Question.difficulty)
+        category_by_id = array('i')
+        difficulty_by_id = array('i')
+        ids_by_category = {}
+        ids_by_difficulty = {}
+        for question_id, category, difficulty in rows:
+            category = NO_CATEGORY if category is None else category
+            difficulty = NO_DIFFICULTY if difficulty is None else difficulty
+            if question_id >= len(category_by_id):
+                category_by_id.extend([NO_QUESTION] * (question_id + 1 - len(category_by_id)))
+                difficulty_by_id.extend([NO_DIFFICULTY] * (question_id + 1 - len(difficulty_by_id)))
+            category_by_id[question_id] = category
+            difficulty_by_id[question_id] = difficulty
+            ids_by_category.setdefault(category, array('i')).append(question_id)
+            if difficulty != NO_DIFFICULTY:
+                ids_by_difficulty.setdefault((None, difficulty), array('i')).append(question_id)
+                if category != NO_CATEGORY:
+                    ids_by_difficulty.setdefault((category, difficulty), array('i')).append(question_id)
+        all_questions = QuestionDeck([question_id for question_id, category in enumerate(category_by_id) if category != NO_QUESTION])
+        decks_by_category = {category: QuestionDeck(question_ids) for category, question_ids in ids_by_category.items() if category != NO_CATEGORY}
+        decks_by_difficulty = {bucket: QuestionDeck(question_ids) for bucket, question_ids in ids_by_difficulty.items()}
+        with self.lock:
+            self.category_by_id = category_by_id
+            self.difficulty_by_id = difficulty_by_id
+            self.all_questions = all_questions
+            self.decks_by_category = decks_by_category
+            self.decks_by_difficulty = decks_by_difficulty
+            self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self.lock:
+            self.all_questions = None
+
+    # the decks were dropped by invalidate() since reload_if_needed, so they must be loaded again before dealing
+    def is_invalidated(self):
+        return self.reload_on_read and self.all_questions is None
+
+    def needs_reload(self):
+        return self.all_questions is None or time.monotonic() - self.loaded_at > self.refresh_seconds
+
+    # must be called without the lock held: the rows are read outside of it and only the swap of the decks takes it,
+    # so the other threads keep dealing from the current decks meanwhile (and only wait if there are none yet)
+    def reload_if_needed(self):
+        if not (self.reload_on_read and self.needs_reload()):
+            return
+        if not self.load_lock.acquire(blocking=self.all_questions is None):
+            return
+        try:
+            if self.needs_reload():
+                self.load()
+        finally:
+            self.load_lock.release()
+
+    def get_category(self, question_id):
+        return self.category_by_id[question_id] if 0 <= question_id < len(self.category_by_id) else NO_QUESTION
+
+    def get_difficulty(self, question_id):
+        return self.difficulty_by_id[question_id] if 0 <= question_id < len(self.difficulty_by_id) else NO_DIFFICULTY
+
+    # the deck of the category (or of all categories if category_id is None), of one difficulty if given,
+    # and the test telling if an id is still in it. Must be called with the lock held, once the decks are loaded
+    def get_deck(self, category_id=None, difficulty=None):
+        if difficulty is not None:
+            deck = self.decks_by_difficulty.get((category_id, difficulty), QuestionDeck())
+            if category_id is None:
+                return deck, lambda question_id: self.get_category(question_id) != NO_QUESTION and self.get_difficulty(question_id) == difficulty
+            return deck, lambda question_id: self.get_category(question_id) == category_id and self.get_difficulty(question_id) == difficulty
+        if category_id is None:
+            return self.all_questions, lambda question_id: self.get_category(question_id) != NO_QUESTION
+        return self.decks_by_category.get(category_id, QuestionDeck()), lambda question_id: self.get_category(question_id) == category_id
+
+    # the ids of every question of the category (or of all categories if category_id is None), as a new array('i')
+    def question_ids(self, category_id=None):
+        while True:
+            self.reload_if_needed()
+            with self.lock:
+                if self.is_invalidated():
+                    continue
+                deck, contains = self.get_deck(category_id)
+                return array('i', [question_id for question_id in deck.ids if contains(question_id)])
+
+    # keep the decks in step with POST /questions and DELETE /questions/<id>
+    def add_question(self, question):
+        with self.lock:
+            if self.all_questions is None or self.get_category(question.id) != NO_QUESTION:
+                return
+            category = NO_CATEGORY if question.category is None else question.category
+            difficulty = NO_DIFFICULTY if question.difficulty is None else question.difficulty
+            if question.id >= len(self.category_by_id):
+                self.category_by_id.extend([NO_QUESTION] * (question.id + 1 - len(self.category_by_id)))
+                self.difficulty_by_id.extend([NO_DIFFICULTY] * (question.id + 1 - len(self.difficulty_by_id)))
+            self.category_by_id[question.id] = category
+            self.difficulty_by_id[question.id] = difficulty
+            self.all_questions.add(question.id)
+            if category != NO_CATEGORY:
+                self.decks_by_category.setdefault(category, QuestionDeck()).add(question.id)
+            if difficulty != NO_DIFFICULTY:
+                self.decks_by_difficulty.setdefault((None, difficulty), QuestionDeck()).add(question.id)
+                if category != NO_CATEGORY:
+                    self.decks_by_difficulty.setdefault((category, difficulty), QuestionDeck()).add(question.id)
+
+    def remove_question(self, question_id):
+        with self.lock:
+            if self.all_questions is None:
+                return
+            category = self.get_category(question_id)
+            if category == NO_QUESTION:
+                return
+            self.category_by_id[question_id] = NO_QUESTION
+            self.all_questions.size -= 1
+            if category in self.decks_by_category:
+                self.decks_by_category[category].size -= 1
+            difficulty = self.get_difficulty(question_id)
+            for bucket in [(None, difficulty), (category, difficulty)]:
+                if bucket in self.decks_by_difficulty:
+                    self.decks_by_difficulty[bucket].size -= 1
+
+    # must be called with the lock held
+    def deal(self, deck, contains, asked_questions):
+        number_of_asked_questions_in_deck = sum(1 for question_id in asked_questions if contains(question_id))
+        if number_of_asked_questions_in_deck >= deck.size:
+            return None
+        if time.monotonic() - deck.shuffled_at > self.reshuffle_seconds:
+            deck.reshuffle(contains)
+        return deck.deal(contains, asked_questions)
+
+    # with a difficulty, deal from the bucket of that difficulty, or of the nearest difficulty that still has questions
+    def pick_question_id(self, category_id, previous_questions, difficulty=None):
+        asked_questions = set(previous_questions)
+        while True:
+            self.reload_if_needed()
+            with self.lock:
+                if self.is_invalidated():
+                    continue
+                if difficulty is None:
+                    return self.deal(*self.get_deck(category_id), asked_questions)
+                difficulties = sorted((bucket_difficulty for bucket_category, bucket_difficulty in self.decks_by_difficulty if bucket_category == category_id),
+                                      key=lambda bucket_difficulty: (abs(bucket_difficulty - difficulty), bucket_difficulty))
+                for bucket_difficulty in difficulties:
+                    question_id = self.deal(*self.get_deck(category_id, bucket_difficulty), asked_questions)
+                    if question_id is not None:
+                        return question_id
+                return None
+
+    # return a random Question of the category (or of all categories if category_id is None)
+    # whose id is not in previous_questions, or None if every question has been asked.
+    # With a difficulty, the question is of that difficulty if one is left, else of the nearest one
+    def pick_question(self, category_id, previous_questions, difficulty=None):
+        while True:
+            question_id = self.pick_question_id(category_id, previous_questions, difficulty)
+            if question_id is None:
+                return None
+            question = self.get_question(question_id) if self.get_question else Question.query.get(question_id)
+            if question is not None:
+                return question
+            # the question was deleted by another worker since the decks were loaded
+            self.remove_question(question_id)
+
+
+"""
+next_difficulty(difficulty, recent_answers)
+    the difficulty of the next question of the adaptive mode: one level harder after ADAPTIVE_STREAK right answers in a row,
+    one level easier after as many wrong ones, else the same. recent_answers are booleans (right or wrong), oldest first.
+"""
+def next_difficulty(difficulty, recent_answers, streak=ADAPTIVE_STREAK):
+    last_answers = recent_answers[-streak:]
+    if len(last_answers) == streak and all(last_answers):
+        difficulty += 1
+    elif len(last_answers) == streak and not any(last_answers):
+        difficulty -= 1
+    return min(MAX_QUIZ_DIFFICULTY, max(MIN_QUIZ_DIFFICULTY, difficulty))
+
+
+"""
+get_adaptive_difficulty(request_body)
+    the difficulty of the next question if POST /quizzes asks for the adaptive mode ("adaptive": true), else None.
+    "difficulty" is the current difficulty (DEFAULT_QUIZ_DIFFICULTY if missing) and "recent_answers" the booleans
+    of the player's last answers. Raises ValueError if they are not an integer and a list of booleans.
+"""
+def get_adaptive_difficulty(request_body):
+    if not request_body.get('adaptive', False):
+        return None
+    difficulty = request_body.get('difficulty', DEFAULT_QUIZ_DIFFICULTY)
+    recent_answers = request_body.get('recent_answers', [])
+    if type(difficulty) is not int:
+        raise ValueError('difficulty must be an integer')
+    if not isinstance(recent_answers, list) or not all(type(answer) is bool for answer in recent_answers):
+        raise ValueError('recent_answers must be a list of booleans')
+    return next_difficulty(difficulty, recent_answers)
+
+
+# int(value), rejecting booleans, floats with a fraction (int() would round 1.9 down) and anything int() refuses with ValueError(message)
+def to_integer(value, message):
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(message)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(message)
+
+
+"""
+get_quiz_category_id(request_body)
+    the category of POST /quizzes and POST /quizzes/sessions as an integer id, or None for every category
+    ({"id": 0, "type": "click"}, the 'ALL' button). The frontend sends the id as a string (it comes from Object.keys),
+    so it is converted. Raises ValueError if quiz_category is missing or its id is not an integer.
+"""
+def get_quiz_category_id(request_body):
+    quiz_category = request_body.get('quiz_category', None)
+    if quiz_category is None:
+        raise ValueError('Quiz category is not provided')
+    if not isinstance(quiz_category, dict):
+        raise ValueError('quiz_category must be an object with an id')
+    category_id = to_integer(quiz_category.get('id'), 'quiz_category.id must be an integer')
+    # handle case when user clicks on 'ALL' category
+    if category_id == 0 and quiz_category.get('type') == 'click':
+        return None
+    return category_id
+
+
+"""
+get_previous_question_ids(request_body)
+    the ids of previous_questions as integers (strings such as "12" are converted).
+    Raises ValueError if it is not a list of integers.
+"""
+def get_previous_question_ids(request_body):
+    previous_questions = request_body.get('previous_questions', [])
+    if not isinstance(previous_questions, list):
+        raise ValueError('previous_questions must be a list of question ids')
+    return [to_integer(question_id, 'previous_questions must be a list of question ids') for question_id in previous_questions]
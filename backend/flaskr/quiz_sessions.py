@@ -0,0 +1,196 @@
+import random
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# how long (in seconds) an idle quiz session is kept
+QUIZ_SESSION_TTL_SECONDS = 3600
+# how many quiz sessions the in-process store keeps before it evicts the least recently used one
+MAX_QUIZ_SESSIONS = 10000
+
+
+class QuizSession:
+    """
+    A quiz game played on the server: the ids of the questions of the category, shuffled once when the session is created,
+    and the position of the next question to ask. Asking the next question is O(1) and needs no previous_questions.
+    Ids are kept in a compact array('i'), 4 bytes per question.
+    """
+    def __init__(self, category_id, question_ids, position=0):
+        self.category_id = category_id
+        self.question_ids = question_ids
+        self.position = position
+
+    @classmethod
+    def create(cls, category_id, question_ids):
+        shuffled_question_ids = array('i', question_ids)
+        random.shuffle(shuffled_question_ids)
+        return cls(category_id, shuffled_question_ids)
+
+    # return the id of the next question to ask, or None if every question has been asked
+    def next_question_id(self):
+        if self.position >= len(self.question_ids):
+            return None
+        question_id = self.question_ids[self.position]
+        self.position += 1
+        return question_id
+
+    def format(self):
+        return format_quiz_session(self.category_id, len(self.question_ids), self.position)
+
+
+def format_quiz_session(category_id, total_questions, asked_questions):
+    return {
+        'category_id': category_id,
+        'total_questions': total_questions,
+        'asked_questions': asked_questions
+        }
+
+
+class InMemoryQuizSessionStore:
+    """
+    Keeps quiz sessions in this process, in least recently used order.
+    Sessions idle for longer than ttl seconds expire, and the least recently used session is evicted once max_sessions is reached.
+    """
+    def __init__(self, ttl=QUIZ_SESSION_TTL_SECONDS, max_sessions=MAX_QUIZ_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+
+    def get(self, session_id):
+        with self.lock:
+            return self.get_unlocked(session_id)
+
+    def get_unlocked(self, session_id):
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            return None
+        session, last_used_at = entry
+        if time.monotonic() - last_used_at > self.ttl:
+            del self.sessions[session_id]
+            return None
+        self.sessions[session_id] = (session, time.monotonic())
+        self.sessions.move_to_end(session_id)
+        return session
+
+    # advance the session under the lock, so that concurrent calls never get the same question:
+    # return (id of the next question or None, session.format()), or None if the session does not exist or has expired
+    def next_question_id(self, session_id):
+        with self.lock:
+            session = self.get_unlocked(session_id)
+            if session is None:
+                return None
+            return session.next_question_id(), session.format()
+
+    def save(self, session_id, session):
+        with self.lock:
+            self.sessions[session_id] = (session, time.monotonic())
+            self.sessions.move_to_end(session_id)
+            self.evict_expired_sessions()
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    # the least recently used sessions are at the front, so stop at the first one that has not expired
+    def evict_expired_sessions(self):
+        now = time.monotonic()
+        while self.sessions:
+            session_id, (session, last_used_at) = next(iter(self.sessions.items()))
+            if now - last_used_at <= self.ttl:
+                break
+            del self.sessions[session_id]
+
+
+class RedisQuizSessionStore:
+    """
+    Keeps quiz sessions in Redis, so that every worker process sees the same sessions.
+    client is any redis-py compatible client (redis.Redis, or a local stand-in such as fakeredis.FakeRedis).
+    A session is two keys: a hash holding the category, the number of questions and the position,
+    and a string holding the shuffled ids packed as array('i') bytes, written once when the session is created.
+    Both expire after ttl seconds without being used.
+    """
+    key_prefix = 'trivia:quiz-session:'
+
+    def __init__(self, client, ttl=QUIZ_SESSION_TTL_SECONDS):
+        self.client = client
+        self.ttl = ttl
+
+    def get_keys(self, session_id):
+        key = self.key_prefix + session_id
+        return key, key + ':question-ids'
+
+    def get(self, session_id):
+        key, question_ids_key = self.get_keys(session_id)
+        pipeline = self.client.pipeline()
+        pipeline.hgetall(key)
+        pipeline.get(question_ids_key)
+        pipeline.expire(key, self.ttl)
+        pipeline.expire(question_ids_key, self.ttl)
+        fields, packed_question_ids = pipeline.execute()[:2]
+        if not fields or packed_question_ids is None:
+            return None
+        category_id = fields[b'category_id']
+        question_ids = array('i')
+        question_ids.frombytes(packed_question_ids)
+        return QuizSession(int(category_id) if category_id else None, question_ids, min(int(fields[b'position']), len(question_ids)))
+
+    def save(self, session_id, session):
+        key, question_ids_key = self.get_keys(session_id)
+        pipeline = self.client.pipeline()
+        pipeline.hset(key, mapping={
+            'category_id': '' if session.category_id is None else session.category_id,
+            'total_questions': len(session.question_ids),
+            'position': session.position
+            })
+        pipeline.set(question_ids_key, session.question_ids.tobytes())
+        pipeline.expire(key, self.ttl)
+        pipeline.expire(question_ids_key, self.ttl)
+        pipeline.execute()
+
+    # HINCRBY gives every call its own position, then GETRANGE reads the one id at that position:
+    # two O(1) round trips whatever the size of the category, and concurrent calls never get the same question.
+    # return (id of the next question or None, session.format()), or None if the session does not exist or has expired
+    def next_question_id(self, session_id):
+        key, question_ids_key = self.get_keys(session_id)
+        pipeline = self.client.pipeline()
+        pipeline.hincrby(key, 'position', 1)
+        pipeline.hmget(key, 'category_id', 'total_questions')
+        pipeline.expire(key, self.ttl)
+        pipeline.expire(question_ids_key, self.ttl)
+        position, (category_id, total_questions) = pipeline.execute()[:2]
+        if total_questions is None:
+            # HINCRBY created a hash for a session that does not exist
+            self.client.delete(key)
+            return None
+        total_questions = int(total_questions)
+        category_id = int(category_id) if category_id else None
+        if position > total_questions:
+            return None, format_quiz_session(category_id, total_questions, total_questions)
+        item_size = array('i').itemsize
+        packed_question_id = self.client.getrange(question_ids_key, (position - 1) * item_size, position * item_size - 1)
+        if len(packed_question_id) != item_size:
+            return None
+        return array('i', packed_question_id)[0], format_quiz_session(category_id, total_questions, position)
+
+    def delete(self, session_id):
+        return self.client.delete(*self.get_keys(session_id)) > 0
+
+
+# build the quiz session store selected by QUIZ_SESSION_STORE ('memory', the default, or 'redis') in the app config
+def create_quiz_session_store(config):
+    ttl = config.get('QUIZ_SESSION_TTL_SECONDS', QUIZ_SESSION_TTL_SECONDS)
+    if config.get('QUIZ_SESSION_STORE', 'memory') == 'redis':
+        # redis is only needed when sessions are kept in Redis
+        import redis
+        client = redis.Redis.from_url(config.get('QUIZ_SESSION_REDIS_URL', 'redis://localhost:6379/0'))
+        return RedisQuizSessionStore(client, ttl=ttl)
+    return InMemoryQuizSessionStore(ttl=ttl, max_sessions=config.get('MAX_QUIZ_SESSIONS', MAX_QUIZ_SESSIONS))
+
+
+def new_session_id():
+    return secrets.token_urlsafe(16)
@@ -0,0 +1,159 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, abort
+
+# where the token buckets are kept (RATE_LIMIT_BACKEND in the app config or the environment):
+# 'memory' in this process, 'redis' shared by every worker, or 'none' to turn the rate limit off
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+# requests per second a client may send to each rate limited endpoint, on average
+RATE_LIMIT_PER_SECOND = 10
+# requests a client may send at once after being idle (the size of its bucket)
+RATE_LIMIT_BURST = 40
+# how many clients the in-process limiter keeps a bucket for before it evicts the least recently seen one
+MAX_RATE_LIMITED_CLIENTS = 100000
+
+
+class InMemoryRateLimiter:
+    """
+    Token buckets kept in this process, one per client and endpoint.
+    A bucket holds up to burst tokens and refills at rate tokens per second; every request takes one token,
+    and a request finding less than one token is rejected. So a client may send burst requests at once,
+    then rate requests per second. Buckets are kept in least recently used order and bounded to max_clients:
+    an evicted bucket was idle, so it would have been full anyway.
+    """
+    def __init__(self, rate=RATE_LIMIT_PER_SECOND, burst=RATE_LIMIT_BURST, max_clients=MAX_RATE_LIMITED_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        # key -> (tokens, updated_at)
+        self.buckets = OrderedDict()
+
+    # take a token from the bucket of key, and return (allowed, seconds to wait before the next token)
+    def acquire(self, key):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / self.rate
+
+
+class RedisRateLimiter:
+    """
+    Token buckets kept in Redis, so that every worker process counts the requests of a client together.
+    client is any redis-py compatible client (redis.Redis, or a local stand-in such as fakeredis.FakeRedis).
+    A bucket is a hash (tokens, updated_at) updated by a Lua script, so taking a token is one atomic round trip,
+    and it expires once it would be full again. The time is Redis' own, so the clocks of the workers do not matter.
+    """
+    key_prefix = 'trivia:rate-limit:'
+
+    # Lua numbers are truncated to integers in the reply, so the seconds to wait are returned as a string
+    acquire_script = '''
+        redis.replicate_commands()
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated_at = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + (now - updated_at) * rate)
+        local allowed = 0
+        local retry_after = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        else
+            retry_after = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return {allowed, tostring(retry_after)}
+    '''
+
+    def __init__(self, client, rate=RATE_LIMIT_PER_SECOND, burst=RATE_LIMIT_BURST):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.script = client.register_script(self.acquire_script)
+
+    def acquire(self, key):
+        allowed, retry_after = self.script(keys=[self.key_prefix + key], args=[self.rate, self.burst])
+        return allowed == 1, float(retry_after)
+
+
+class RateLimit:
+    """
+    Rejects the requests of a client to a rate limited endpoint with 429 Too Many Requests once its token bucket is empty,
+    with a Retry-After header telling how many seconds to wait. Clients are told apart by their IP address
+    (request.remote_addr: behind a reverse proxy, wrap the app in werkzeug's ProxyFix so it is the client's address),
+    and every endpoint has its own buckets, so a burst of searches does not block the quiz.
+    Rejected requests are counted, see stats().
+    """
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    # take a token from the bucket of the client at client_address for endpoint, and return (allowed, seconds to wait
+    # before retrying, rounded up for the Retry-After header). Also used by the async mode (flaskr/asgi.py)
+    def acquire(self, endpoint, client_address):
+        if self.limiter is None:
+            return True, 0
+        allowed, retry_after = self.limiter.acquire('{}:{}'.format(endpoint, client_address))
+        self.count(allowed)
+        return allowed, 0 if allowed else max(1, math.ceil(retry_after))
+
+    # decorate a view function (below @app.route) to rate limit it
+    def limited(self, view_function):
+        @wraps(view_function)
+        def rate_limited_view(**view_arguments):
+            allowed, retry_after = self.acquire(request.endpoint, request.remote_addr)
+            if not allowed:
+                abort(429, description='Rate limit exceeded, retry in {} seconds'.format(retry_after), retry_after=retry_after)
+            return view_function(**view_arguments)
+        return rate_limited_view
+
+    def count(self, allowed):
+        with self.lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.rejected += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.limiter is not None,
+                'allowed': self.allowed,
+                'rejected': self.rejected
+                }
+
+
+# build the rate limit selected by RATE_LIMIT_BACKEND
+def create_rate_limit(config):
+    backend = config.get('RATE_LIMIT_BACKEND', RATE_LIMIT_BACKEND)
+    rate = config.get('RATE_LIMIT_PER_SECOND', RATE_LIMIT_PER_SECOND)
+    burst = config.get('RATE_LIMIT_BURST', RATE_LIMIT_BURST)
+    if backend == 'none':
+        return RateLimit(None)
+    if backend == 'redis':
+        # redis is only needed when the buckets are kept in Redis
+        import redis
+        client = redis.Redis.from_url(config.get('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0'))
+        return RateLimit(RedisRateLimiter(client, rate=rate, burst=burst))
+    return RateLimit(InMemoryRateLimiter(rate=rate, burst=burst,
+                                         max_clients=config.get('MAX_RATE_LIMITED_CLIENTS', MAX_RATE_LIMITED_CLIENTS)))
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, request, make_response
+
+# how long (in seconds) a cached response is served before the endpoint is called again
+RESPONSE_CACHE_SECONDS = 60
+# bounds of the in-process response cache: least recently used responses are evicted beyond them
+MAX_CACHED_RESPONSES = 1000
+MAX_CACHED_RESPONSE_BYTES = 32 * 1024 * 1024
+# Cache-Control max-age sent with cached responses that do not set their own. 0 makes browsers revalidate
+# with the ETag on every request, so a new or deleted question shows up right away (as a 200 instead of a 304).
+RESPONSE_CACHE_MAX_AGE = 0
+
+
+class CachedResponse:
+    """
+    What is kept of a response: status, headers and body. The body is already encoded, so serving it again costs
+    neither database queries nor JSON encoding.
+    """
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def to_response(self):
+        return Response(self.body, status=self.status_code, headers=self.headers)
+
+
+class InMemoryResponseStore:
+    """
+    Keeps cached responses in this process, in least recently used order, bounded by max_entries responses
+    and max_bytes of body. Each response is registered under its tags, so invalidate_tags() drops exactly the responses
+    built from the data that changed.
+    """
+    def __init__(self, max_entries=MAX_CACHED_RESPONSES, max_bytes=MAX_CACHED_RESPONSE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (CachedResponse, tags, expires_at)
+        self.entries = OrderedDict()
+        # tag -> set of keys
+        self.keys_by_tag = {}
+        self.size_in_bytes = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() > entry[2]:
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, cached_response, tags, ttl):
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (cached_response, tags, time.monotonic() + ttl)
+            self.size_in_bytes += len(cached_response.body)
+            for tag in tags:
+                self.keys_by_tag.setdefault(tag, set()).add(key)
+            while self.entries and (len(self.entries) > self.max_entries or self.size_in_bytes > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+
+    # must be called with the lock held
+    def remove(self, key):
+        cached_response, tags, _ = self.entries.pop(key)
+        self.size_in_bytes -= len(cached_response.body)
+        for tag in tags:
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+
+    def invalidate_tags(self, tags):
+        with self.lock:
+            for tag in tags:
+                for key in list(self.keys_by_tag.get(tag, ())):
+                    self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_tag.clear()
+            self.size_in_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size_in_bytes': self.size_in_bytes
+                }
+
+
+class RedisResponseStore:
+    """
+    Keeps cached responses in Redis, so that every worker process shares them and sees the invalidations of the others.
+    client is any redis-py compatible client (redis.Redis, or a local stand-in such as fakeredis.FakeRedis).
+    A response is a hash (status, headers, body) expiring after ttl seconds, and each tag is a set of the keys it covers.
+    Redis' own maxmemory policy bounds the size of the cache.
+    """
+    key_prefix = 'trivia:response:'
+    tag_prefix = 'trivia:response-tag:'
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        fields = self.client.hgetall(self.key_prefix + key)
+        if not fields:
+            return None
+        return CachedResponse(int(fields[b'status_code']), json.loads(fields[b'headers']), fields[b'body'])
+
+    def set(self, key, cached_response, tags, ttl):
+        pipeline = self.client.pipeline()
+        pipeline.hset(self.key_prefix + key, mapping={
+            'status_code': cached_response.status_code,
+            'headers': json.dumps(cached_response.headers),
+            'body': cached_response.body
+            })
+        pipeline.expire(self.key_prefix + key, ttl)
+        for tag in tags:
+            pipeline.sadd(self.tag_prefix + tag, key)
+            pipeline.expire(self.tag_prefix + tag, ttl)
+        pipeline.execute()
+
+    def invalidate_tags(self, tags):
+        for tag in tags:
+            keys = self.client.smembers(self.tag_prefix + tag)
+            self.client.delete(self.tag_prefix + tag, *[self.key_prefix + key.decode('utf-8') for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.key_prefix + '*')) + list(self.client.scan_iter(match=self.tag_prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        return {}
+
+
+class ResponseCache:
+    """
+    Caches the responses of GET endpoints, keyed by path and query string, with the tags given by the endpoint.
+    Endpoints creating or deleting questions call invalidate_tags() with the tags of the data they changed.
+    Only 200 responses are cached. Every cached response gets an ETag (and a Cache-Control if the endpoint did not set one),
+    and requests sending the ETag back in If-None-Match get a 304 Not Modified.
+    Hits and misses are counted, see stats().
+    """
+    def __init__(self, store, ttl=RESPONSE_CACHE_SECONDS, max_age=RESPONSE_CACHE_MAX_AGE):
+        self.store = store
+        self.ttl = ttl
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # the same key for ?page=2&after_id=10 and ?after_id=10&page=2. arguments are (name, value) pairs
+    def make_key(self, path, arguments):
+        return path + '?' + '&'.join('{}={}'.format(name, value) for name, value in sorted(arguments))
+
+    def get_key(self):
+        return self.make_key(request.path, request.args.items(multi=True))
+
+    # the cached response of key, or None (counted as a miss)
+    def get(self, key):
+        cached_response = self.store.get(key)
+        self.count(cached_response is not None)
+        return cached_response
+
+    # keep cached_response under key, unless a write invalidated the cache while it was built (since invalidations_before),
+    # which may have made it stale
+    def set(self, key, cached_response, tags, invalidations_before):
+        if self.invalidations == invalidations_before:
+            self.store.set(key, cached_response, tags, self.ttl)
+
+    # decorate a view function (below @app.route) to serve its responses from the cache.
+    # get_tags is called with the view arguments, and returns the tags of the response.
+    def cached(self, get_tags):
+        def decorator(view_function):
+            @wraps(view_function)
+            def cached_view(**view_arguments):
+                key = self.get_key()
+                cached_response = self.get(key)
+                if cached_response is None:
+                    invalidations_before = self.invalidations
+                    response = make_response(view_function(**view_arguments))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    if response.get_etag() == (None, None):
+                        response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+                    if 'Cache-Control' not in response.headers:
+                        response.cache_control.public = True
+                        response.cache_control.max_age = self.max_age
+                    cached_response = CachedResponse(response.status_code, list(response.headers.items()), response.get_data())
+                    self.set(key, cached_response, get_tags(**view_arguments), invalidations_before)
+                return cached_response.to_response().make_conditional(request)
+            return cached_view
+        return decorator
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def invalidate_tags(self, tags):
+        with self.lock:
+            self.invalidations += 1
+        self.store.invalidate_tags(tags)
+
+    def clear(self):
+        self.store.clear()
+        with self.lock:
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / requests, 4) if requests else None,
+                'invalidations': self.invalidations,
+                **self.store.stats()
+                }
+
+
+# build the response cache selected by RESPONSE_CACHE_BACKEND ('memory', the default, or 'redis') in the app config
+def create_response_cache(config):
+    ttl = config.get('RESPONSE_CACHE_SECONDS', RESPONSE_CACHE_SECONDS)
+    max_age = config.get('RESPONSE_CACHE_MAX_AGE', RESPONSE_CACHE_MAX_AGE)
+    if config.get('RESPONSE_CACHE_BACKEND', 'memory') == 'redis':
+        # redis is only needed when responses are cached in Redis
+        import redis
+        client = redis.Redis.from_url(config.get('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+        return ResponseCache(RedisResponseStore(client), ttl=ttl, max_age=max_age)
+    store = InMemoryResponseStore(
+        max_entries=config.get('MAX_CACHED_RESPONSES', MAX_CACHED_RESPONSES),
+        max_bytes=config.get('MAX_CACHED_RESPONSE_BYTES', MAX_CACHED_RESPONSE_BYTES))
+    return ResponseCache(store, ttl=ttl, max_age=max_age)
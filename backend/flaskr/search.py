@@ -0,0 +1,173 @@
+import bisect
+import re
+import threading
+import time
+
+from sqlalchemy import func, desc
+from sqlalchemy.engine import make_url
+
+from models import read_only_session, Question, TEXT_SEARCH_CONFIG, QUESTION_ROW_COLUMNS
+
+# how long (in seconds) the in-process inverted index is trusted before it is rebuilt from the database
+SEARCH_INDEX_REFRESH_SECONDS = 300
+
+WORD_PATTERN = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def tokenize(text):
+    return WORD_PATTERN.findall((text or '').lower())
+
+
+class PostgresQuestionSearch:
+    """
+    Full-text search over questions.question using the GIN index on to_tsvector(question) (see models.py).
+    Every word of the search term is matched as a prefix, so results show up while the user is still typing,
+    and the best matches (ts_rank) come first. Ranking, counting and pagination all run in SQL.
+    """
+    def __init__(self):
+        self.document = func.to_tsvector(TEXT_SEARCH_CONFIG, func.coalesce(Question.question, ''))
+
+    # build a tsquery where every word must match as a prefix: 'hall mir' -> 'hall:* & mir:*'
+    def build_query(self, search_term):
+        words = tokenize(search_term)
+        if not words:
+            return None
+        return func.to_tsquery(TEXT_SEARCH_CONFIG, ' & '.join('{}:*'.format(word) for word in words))
+
+    # return the questions on this page of the results (rows of QUESTION_ROW_COLUMNS), and the total number of matching questions
+    def search(self, search_term, limit, offset=0):
+        ts_query = self.build_query(search_term)
+        if ts_query is None:
+            return [], 0
+        matching_questions = read_only_session().query(*QUESTION_ROW_COLUMNS).filter(self.document.op('@@')(ts_query))
+        total_questions = matching_questions.count()
+        rank = func.ts_rank(self.document, ts_query)
+        questions_on_this_page = matching_questions.order_by(desc(rank), Question.id).offset(offset).limit(limit).all()
+        return questions_on_this_page, total_questions
+
+    # the GIN index is maintained by PostgreSQL itself
+    def add_question(self, question):
+        pass
+
+    def invalidate(self):
+        pass
+
+    def load(self, rows=None):
+        pass
+
+    def remove_question(self, question_id):
+        pass
+
+
+class InvertedIndexQuestionSearch:
+    """
+    In-process fallback for databases without full-text search (SQLite in tests and benchmarks).
+    Keeps word -> set of question ids, and a sorted list of every word, so that the words starting with
+    a prefix are found with a binary search. Like PostgresQuestionSearch, every word of the search term must match
+    as a prefix, and questions containing the words more often come first.
+    """
+    def __init__(self, refresh_seconds=SEARCH_INDEX_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.RLock()
+        self.postings = None
+        self.words = []
+        self.word_counts = {}
+        self.loaded_at = 0
+
+    # rows are the (id, question) of every question, read from the database if not given
+    def load(self, rows=None):
+        if rows is None:
+            rows = read_only_session().query(Question.id, Question.question)
+        with self.lock:
+            self.postings = {}
+            self.words = []
+            self.word_counts = {}
+            for question_id, question_text in rows:
+                self.index_question(question_id, question_text)
+            self.words = sorted(self.postings)
+            self.loaded_at = time.monotonic()
+
+    def index_question(self, question_id, question_text):
+        counts = {}
+        for word in tokenize(question_text):
+            counts[word] = counts.get(word, 0) + 1
+        for word in counts:
+            self.postings.setdefault(word, set()).add(question_id)
+        self.word_counts[question_id] = counts
+
+    def invalidate(self):
+        with self.lock:
+            self.postings = None
+
+    def needs_reload(self):
+        return self.postings is None or time.monotonic() - self.loaded_at > self.refresh_seconds
+
+    def ensure_loaded(self):
+        if self.needs_reload():
+            self.load()
+
+    # ids of the questions having a word that starts with prefix, and how often each question has such words
+    def match_prefix(self, prefix):
+        matches = {}
+        position = bisect.bisect_left(self.words, prefix)
+        while position < len(self.words) and self.words[position].startswith(prefix):
+            word = self.words[position]
+            for question_id in self.postings.get(word, ()):
+                matches[question_id] = matches.get(question_id, 0) + self.word_counts[question_id][word]
+            position += 1
+        return matches
+
+    def search(self, search_term, limit, offset=0):
+        self.ensure_loaded()
+        ids_on_this_page, total_questions = self.search_ids(search_term, limit, offset)
+        rows = read_only_session().query(*QUESTION_ROW_COLUMNS).filter(Question.id.in_(ids_on_this_page))
+        questions_by_id = {row.id: row for row in rows}
+        return [questions_by_id[question_id] for question_id in ids_on_this_page if question_id in questions_by_id], total_questions
+
+    # the ids of the questions on this page of the results, and the total number of matching questions
+    def search_ids(self, search_term, limit, offset=0):
+        words = tokenize(search_term)
+        if not words:
+            return [], 0
+        with self.lock:
+            scores = None
+            for word in words:
+                matches = self.match_prefix(word)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {question_id: score + matches[question_id] for question_id, score in scores.items() if question_id in matches}
+                if not scores:
+                    return [], 0
+        ranked_question_ids = sorted(scores, key=lambda question_id: (-scores[question_id], question_id))
+        return ranked_question_ids[offset:offset + limit], len(ranked_question_ids)
+
+    # keep the index in step with POST /questions and DELETE /questions/<id>
+    def add_question(self, question):
+        with self.lock:
+            if self.postings is None:
+                return
+            self.index_question(question.id, question.question)
+            for word in self.word_counts[question.id]:
+                position = bisect.bisect_left(self.words, word)
+                if position == len(self.words) or self.words[position] != word:
+                    self.words.insert(position, word)
+
+    def remove_question(self, question_id):
+        with self.lock:
+            if self.postings is None:
+                return
+            for word in self.word_counts.pop(question_id, {}):
+                self.postings[word].discard(question_id)
+
+
+# full-text search on PostgreSQL, the in-process inverted index on any other database.
+# QUESTION_SEARCH_BACKEND ('postgres' or 'inverted_index') in the app config overrides the choice.
+def create_question_search(app):
+    backend = app.config.get('QUESTION_SEARCH_BACKEND')
+    if backend is None:
+        # from the URL, so that the engine is not created while the app is created
+        backend = 'postgres' if make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() == 'postgresql' else 'inverted_index'
+    if backend == 'postgres':
+        return PostgresQuestionSearch()
+    return InvertedIndexQuestionSearch()
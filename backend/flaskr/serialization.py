@@ -0,0 +1,61 @@
+from flask import json
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# items encoded per chunk of a streamed JSON response
+STREAM_CHUNK_ITEMS = 100
+
+
+class OrjsonEncoder(JSONEncoder):
+    """
+    JSON encoder for jsonify backed by orjson, which encodes large lists of questions several times faster
+    than the json module. Keeps the behaviour of Flask's encoder: sorted keys (JSON_SORT_KEYS),
+    pretty printing when Flask asks for an indent, integer keys (the categories dictionary)
+    and Flask's default() for the types orjson does not know.
+    """
+    def encode(self, o):
+        options = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if self.indent:
+            options |= orjson.OPT_INDENT_2
+        return orjson.dumps(o, default=self.default, option=options).decode('utf-8')
+
+
+"""
+register_json_encoder(app)
+    sets the JSON encoder used by jsonify, from JSON_ENCODER in the app config:
+    'orjson', 'default' (Flask's encoder), or 'auto' (the default: orjson if it is installed)
+"""
+def register_json_encoder(app):
+    json_encoder = app.config.get('JSON_ENCODER', 'auto')
+    if json_encoder == 'orjson' and orjson is None:
+        raise RuntimeError("JSON_ENCODER is 'orjson' but orjson is not installed")
+    if json_encoder == 'orjson' or (json_encoder == 'auto' and orjson is not None):
+        app.json_encoder = OrjsonEncoder
+
+
+"""
+stream_json_object(head, items_key, items, chunk_size)
+    yields the JSON of the object head with items_key set to the list items, encoded (with the app's JSON encoder)
+    chunk_size items at a time, so a large list is sent while it is encoded instead of being built in memory as one string.
+    items may be a generator. Must run in an app context (wrap it in stream_with_context)
+"""
+def stream_json_object(head, items_key, items, chunk_size=STREAM_CHUNK_ITEMS):
+    encoded_head = json.dumps(head)
+    yield '{}{}{}: ['.format(encoded_head[:-1], ', ' if head else '', json.dumps(items_key))
+    chunk = []
+    separator = ''
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield separator + json.dumps(chunk)[1:-1]
+            separator = ', '
+            chunk = []
+    if chunk:
+        yield separator + json.dumps(chunk)[1:-1]
+    yield ']}'
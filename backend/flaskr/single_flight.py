@@ -0,0 +1,58 @@
+import threading
+
+
+class InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call for a key is running, the other threads calling with the same key
+    wait for it and get its result (or its exception) instead of running the function again.
+    Nothing is cached, the next call after it returned runs the function again.
+    So a burst of the same search from a whole classroom costs one database query instead of one per student.
+    Coalesced calls are counted, see stats().
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> InFlightCall
+        self.calls = {}
+        self.calls_run = 0
+        self.calls_coalesced = 0
+
+    # return function(), or the result of the call with the same key already running in another thread
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = InFlightCall()
+                self.calls_run += 1
+            else:
+                self.calls_coalesced += 1
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls_run': self.calls_run,
+                'calls_coalesced': self.calls_coalesced,
+                'calls_in_flight': len(self.calls)
+                }
@@ -0,0 +1,317 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from flask import has_app_context
+
+from models import db, Question, Category
+
+try:
+    # serializes the rebuilds of the worker processes, there is no such lock on Windows
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# how often (in seconds) a worker checks if the snapshot file was replaced by another worker
+SNAPSHOT_CHECK_SECONDS = 1
+# how long (in seconds) after a write the snapshot is rebuilt, so a burst of writes costs one rebuild.
+# 0 rebuilds it right away, in the request that wrote
+SNAPSHOT_REBUILD_DELAY_SECONDS = 1
+
+SNAPSHOT_MAGIC = b'TRIVSNAP'
+SNAPSHOT_VERSION = 1
+# magic, version, number of questions, number of categories, bytes of question text, bytes of category text, built at.
+# Padded to 48 bytes so the int64 offsets that follow are aligned
+SNAPSHOT_HEADER = struct.Struct('=8sIIIQQd4x')
+# stored instead of a NULL category or difficulty
+NULL_VALUE = -2 ** 31
+
+
+"""
+write_snapshot(path, question_rows, category_rows)
+    writes the snapshot of the questions and categories to path, atomically: the file is written next to it,
+    then renamed over it, so a worker opening path sees the old or the new snapshot, never half of one.
+    question_rows are (id, question, answer, category, difficulty) ordered by id, category_rows (id, type).
+    The layout, in the byte order of this machine, is the header then:
+        text_offsets        int64[2 * questions + 1]  question i is text[text_offsets[2i]:text_offsets[2i + 1]],
+                                                      its answer text[text_offsets[2i + 1]:text_offsets[2i + 2]]
+        type_offsets        int64[categories + 1]     category i is category_text[type_offsets[i]:type_offsets[i + 1]]
+        question_ids        int32[questions]          sorted, so a question is found by binary search
+        categories          int32[questions]
+        difficulties        int32[questions]
+        ids_by_category     int32[questions]          the question ids ordered by (category, id)
+        positions_by_category int32[questions]        the position of each of them in question_ids
+        category_ids        int32[categories]         sorted
+        category_starts     int32[categories]         the questions of category i are ids_by_category[category_starts[i]:category_ends[i]]
+        category_ends       int32[categories]
+        text                UTF-8
+        category_text       UTF-8
+"""
+def write_snapshot(path, question_rows, category_rows):
+    question_ids, categories, difficulties = array('i'), array('i'), array('i')
+    text_offsets = array('q', [0])
+    text = bytearray()
+    for question_id, question, answer, category, difficulty in question_rows:
+        question_ids.append(question_id)
+        categories.append(NULL_VALUE if category is None else category)
+        difficulties.append(NULL_VALUE if difficulty is None else difficulty)
+        for value in (question, answer):
+            text += (value or '').encode('utf-8')
+            text_offsets.append(len(text))
+
+    category_ids = array('i')
+    type_offsets = array('q', [0])
+    category_text = bytearray()
+    for category_id, category_type in sorted(category_rows):
+        category_ids.append(category_id)
+        category_text += (category_type or '').encode('utf-8')
+        type_offsets.append(len(category_text))
+
+    positions_by_category = array('i', sorted(range(len(question_ids)), key=lambda position: (categories[position], question_ids[position])))
+    ids_by_category = array('i', [question_ids[position] for position in positions_by_category])
+    sorted_categories = [categories[position] for position in positions_by_category]
+    category_starts = array('i', [bisect_left(sorted_categories, category_id) for category_id in category_ids])
+    category_ends = array('i', [bisect_right(sorted_categories, category_id) for category_id in category_ids])
+
+    folder = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=folder, prefix='.snapshot-')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as snapshot_file:
+            snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(question_ids), len(category_ids),
+                                                     len(text), len(category_text), time.time()))
+            for values in (text_offsets, type_offsets, question_ids, categories, difficulties, ids_by_category, positions_by_category,
+                           category_ids, category_starts, category_ends):
+                values.tofile(snapshot_file)
+            snapshot_file.write(text)
+            snapshot_file.write(category_text)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+# write the snapshot of the questions and categories tables of db.session (needs an app context).
+# It reads the primary database, not the replica, which may not have the last writes yet
+def build_snapshot(path):
+    question_rows = db.session.query(Question.id, Question.question, Question.answer, Question.category, Question.difficulty) \
+        .order_by(Question.id).yield_per(10000)
+    category_rows = db.session.query(Category.id, Category.type).all()
+    write_snapshot(path, question_rows, category_rows)
+
+
+class QuestionSnapshot:
+    """
+    A snapshot file opened read-only with mmap. The arrays are memoryviews of the mapping, so opening it reads nothing
+    and every worker process shares the same pages of the OS page cache, however many workers map it.
+    A question is found by id with a binary search, a page of questions (of all categories or of one) is a slice.
+    Rows are (id, question, answer, category, difficulty) like QUESTION_ROW_COLUMNS, so format_question_row formats them.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            status = os.fstat(snapshot_file.fileno())
+            self.mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        # the file is replaced (never rewritten) by a rebuild, so a new inode or mtime means a new snapshot
+        self.identity = (status.st_ino, status.st_mtime_ns, status.st_size)
+        magic, version, self.number_of_questions, self.number_of_categories, text_bytes, category_text_bytes, self.built_at = \
+            SNAPSHOT_HEADER.unpack_from(self.mapping)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('{} is not a question snapshot of version {}'.format(path, SNAPSHOT_VERSION))
+        view = memoryview(self.mapping)
+        offset = SNAPSHOT_HEADER.size
+
+        def take(typecode, length):
+            nonlocal offset
+            size = length * struct.calcsize(typecode)
+            values = view[offset:offset + size].cast(typecode)
+            offset += size
+            return values
+
+        questions, categories = self.number_of_questions, self.number_of_categories
+        self.text_offsets = take('q', 2 * questions + 1)
+        self.type_offsets = take('q', categories + 1)
+        self.question_ids = take('i', questions)
+        self.categories = take('i', questions)
+        self.difficulties = take('i', questions)
+        self.ids_by_category = take('i', questions)
+        self.positions_by_category = take('i', questions)
+        self.category_ids = take('i', categories)
+        self.category_starts = take('i', categories)
+        self.category_ends = take('i', categories)
+        self.text = take('B', text_bytes)
+        self.category_text = take('B', category_text_bytes)
+
+    def get_text(self, index):
+        return str(self.text[self.text_offsets[index]:self.text_offsets[index + 1]], 'utf-8')
+
+    def get_row(self, position):
+        category = self.categories[position]
+        difficulty = self.difficulties[position]
+        return (self.question_ids[position], self.get_text(2 * position), self.get_text(2 * position + 1),
+                None if category == NULL_VALUE else category, None if difficulty == NULL_VALUE else difficulty)
+
+    # the row of the question, or None if it is not in the snapshot
+    def get_question_row(self, question_id):
+        position = bisect_left(self.question_ids, question_id)
+        if position < self.number_of_questions and self.question_ids[position] == question_id:
+            return self.get_row(position)
+        return None
+
+    # the question as a Question that is not in any session, or None if it is not in the snapshot
+    def get_question(self, question_id):
+        row = self.get_question_row(question_id)
+        if row is None:
+            return None
+        return Question(id=row[0], question=row[1], answer=row[2], category=row[3], difficulty=row[4])
+
+    # the rows of a page of questions ordered by id: from offset, or after the id after_id if given
+    def page(self, limit, offset=0, after_id=None):
+        if after_id is not None:
+            offset = bisect_right(self.question_ids, after_id)
+        return [self.get_row(position) for position in range(max(offset, 0), min(offset + limit, self.number_of_questions))]
+
+    # the index of the category in category_ids, or None if it is not in the snapshot
+    def find_category(self, category_id):
+        index = bisect_left(self.category_ids, category_id)
+        if index < self.number_of_categories and self.category_ids[index] == category_id:
+            return index
+        return None
+
+    def has_category(self, category_id):
+        return self.find_category(category_id) is not None
+
+    def count_questions(self, category_id=None):
+        if category_id is None:
+            return self.number_of_questions
+        index = self.find_category(category_id)
+        return 0 if index is None else self.category_ends[index] - self.category_starts[index]
+
+    # the rows of a page of the questions of the category ordered by id, like page()
+    def category_page(self, category_id, limit, offset=0, after_id=None):
+        index = self.find_category(category_id)
+        if index is None:
+            return []
+        start, end = self.category_starts[index], self.category_ends[index]
+        if after_id is not None:
+            first = bisect_right(self.ids_by_category, after_id, start, end)
+        else:
+            first = start + max(offset, 0)
+        return [self.get_row(self.positions_by_category[index_by_category]) for index_by_category in range(first, min(first + limit, end))]
+
+    # {id: type} of every category, the categories of GET /questions
+    def get_categories(self):
+        return {self.category_ids[index]: str(self.category_text[self.type_offsets[index]:self.type_offsets[index + 1]], 'utf-8')
+                for index in range(self.number_of_categories)}
+
+    # the (id, category, difficulty) of every question, for QuizQuestionSelector.load
+    def quiz_rows(self):
+        for position in range(self.number_of_questions):
+            category = self.categories[position]
+            difficulty = self.difficulties[position]
+            yield self.question_ids[position], None if category == NULL_VALUE else category, None if difficulty == NULL_VALUE else difficulty
+
+
+class QuestionSnapshotStore:
+    """
+    The snapshot of an app: built on first use if the file does not exist, reopened when another worker replaced it
+    (checked every check_seconds), and rebuilt rebuild_delay seconds after this worker wrote questions, by a 'rebuild-snapshot' job
+of job_queue (see flaskr/jobs.py) so that a burst of writes costs one rebuild.
+    Rebuilds of all workers are serialized with a lock file, and each one reads the database after taking the lock,
+    so the last rebuild always sees the last write. on_reload functions are called when a new snapshot is opened.
+    """
+    def __init__(self, app, path, check_seconds=SNAPSHOT_CHECK_SECONDS, rebuild_delay=SNAPSHOT_REBUILD_DELAY_SECONDS, job_queue=None):
+        self.app = app
+        self.path = path
+        self.check_seconds = check_seconds
+        self.rebuild_delay = rebuild_delay
+        self.job_queue = job_queue
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.checked_at = 0
+        self.rebuilds = 0
+        self.reloads = 0
+        self.on_reload = []
+
+    def get(self):
+        if self.snapshot is None or time.monotonic() - self.checked_at > self.check_seconds:
+            with self.lock:
+                reloaded = self.refresh()
+            if reloaded:
+                self.notify_reload()
+        return self.snapshot
+
+    # must be called with the lock held, returns True if a new snapshot was opened
+    def refresh(self):
+        self.checked_at = time.monotonic()
+        try:
+            status = os.stat(self.path)
+        except FileNotFoundError:
+            self.rebuild_now()
+            status = os.stat(self.path)
+        if self.snapshot is not None and self.snapshot.identity == (status.st_ino, status.st_mtime_ns, status.st_size):
+            return False
+        # the previous mapping is closed once the requests still reading it let go of it
+        self.snapshot = QuestionSnapshot(self.path)
+        self.reloads += 1
+        return True
+
+    # called without the lock held, since on_reload functions take their own locks
+    def notify_reload(self):
+        for on_reload in self.on_reload:
+            on_reload()
+
+    def rebuild_now(self):
+        with open(self.path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if has_app_context():
+                build_snapshot(self.path)
+            else:
+                with self.app.app_context():
+                    build_snapshot(self.path)
+        self.rebuilds += 1
+
+    def rebuild(self):
+        with self.lock:
+            self.rebuild_now()
+            reloaded = self.refresh()
+        if reloaded:
+            self.notify_reload()
+
+    # called after questions or categories were written
+    def request_rebuild(self):
+        if self.rebuild_delay <= 0 or self.job_queue is None:
+            self.rebuild()
+            return
+        self.job_queue.enqueue('rebuild-snapshot', delay=self.rebuild_delay, unique=True)
+
+    def stats(self):
+        with self.lock:
+            snapshot = self.snapshot
+            return {
+                'path': self.path,
+                'questions': snapshot.number_of_questions if snapshot else None,
+                'categories': snapshot.number_of_categories if snapshot else None,
+                'size_in_bytes': len(snapshot.mapping) if snapshot else None,
+                'built_at': snapshot.built_at if snapshot else None,
+                'rebuilds': self.rebuilds,
+                'reloads': self.reloads
+                }
+
+
+# the snapshot store selected by QUESTION_SNAPSHOT_PATH (app config or environment), or None to read the database.
+# job_queue must have a 'rebuild-snapshot' job calling rebuild()
+def create_question_snapshot_store(app, job_queue=None):
+    path = app.config.get('QUESTION_SNAPSHOT_PATH', os.getenv('QUESTION_SNAPSHOT_PATH'))
+    if not path:
+        return None
+    return QuestionSnapshotStore(app, path,
+                                 check_seconds=app.config.get('SNAPSHOT_CHECK_SECONDS', SNAPSHOT_CHECK_SECONDS),
+                                 rebuild_delay=app.config.get('SNAPSHOT_REBUILD_DELAY_SECONDS', SNAPSHOT_REBUILD_DELAY_SECONDS),
+                                 job_queue=job_queue)
@@ -0,0 +1,7 @@
+-- Full-text search index for POST /questions/search, with the 'simple' configuration, which keeps stopwords and does not stem,
+-- so that the search finds "the" and matches the beginning of words like the in-process index.
+-- New databases get it from db.create_all(); run this once on databases restored from trivia.psql:
+--   psql trivia < migrations/001_questions_full_text_search.sql
+-- CONCURRENTLY builds the index without locking the questions table against writes.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_questions_question_fts_simple
+    ON questions USING gin (to_tsvector('simple', coalesce(question, '')));
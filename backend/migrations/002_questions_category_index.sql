@@ -0,0 +1,28 @@
+-- Typed category foreign key and the (category, id) index of the questions table.
+-- New databases get both from db.create_all(); run this once on existing databases:
+--   psql trivia < migrations/002_questions_category_index.sql
+-- Databases restored from trivia.psql already have an integer category column and the "category" foreign key,
+-- so only the index is built there. Databases created by db.create_all() before this change have a varchar column,
+-- which is converted (this rewrites the table and locks it, so run it outside peak hours).
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'questions' AND column_name = 'category') <> 'integer' THEN
+        -- categories that are not a number, or not an existing category, are cleared rather than failing the migration
+        UPDATE questions SET category = NULL
+            WHERE CASE WHEN category ~ '^[0-9]+$' THEN category::integer NOT IN (SELECT id FROM categories)
+                       ELSE category IS NOT NULL END;
+        ALTER TABLE questions ALTER COLUMN category TYPE integer USING category::integer;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM information_schema.table_constraints
+                   WHERE table_name = 'questions' AND constraint_type = 'FOREIGN KEY') THEN
+        ALTER TABLE questions ADD CONSTRAINT category FOREIGN KEY (category)
+            REFERENCES categories (id) ON UPDATE CASCADE ON DELETE SET NULL;
+    END IF;
+END
+$$;
+
+-- CONCURRENTLY builds the index without locking the questions table against writes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_questions_category_id ON questions (category, id);
+
+ANALYZE questions;
@@ -1,5 +1,13 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+import threading
+import time
+from functools import wraps
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, create_engine, event, DDL, select, update, func, inspect, text, literal, union_all
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+from flask import current_app, g, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
 import json
 from dotenv import load_dotenv
@@ -8,20 +16,251 @@ load_dotenv()
 database_name = 'trivia'
 database_username = os.getenv('DB_USERNAME')
 database_password = os.getenv('DB_PASSWORD')
-database_path = 'postgresql+psycopg2://{}:{}@{}/{}'.format(database_username, database_password, 'localhost:5432', database_name)
+default_database_path = os.getenv('DATABASE_URL', 'postgresql+psycopg2://{}:{}@{}/{}'.format(database_username, database_password, 'localhost:5432', database_name))
+# optional read replica, used by the read-only endpoints
+replica_database_path = os.getenv('DATABASE_REPLICA_URL')
+# for this many seconds after a client wrote, its reads go to the primary database instead of the replica, which may lag
+# behind (REPLICA_READ_YOUR_WRITES_SECONDS in the app config or the environment). The client is told with this cookie
+REPLICA_READ_YOUR_WRITES_SECONDS = int(os.getenv('REPLICA_READ_YOUR_WRITES_SECONDS', 5))
+READ_PRIMARY_COOKIE = 'trivia_read_primary'
+
+# how many times run_in_transaction() runs a transaction again after a serialization failure or a deadlock,
+# waiting TRANSACTION_RETRY_DELAY_SECONDS before the first retry and twice as long before each next one
+TRANSACTION_RETRIES = 3
+TRANSACTION_RETRY_DELAY_SECONDS = 0.01
+# SQLSTATEs meaning the transaction can be run again: serialization_failure and deadlock_detected
+RETRYABLE_SQLSTATES = {'40001', '40P01'}
+
+# connection pool settings, from the environment (or .env). Under gunicorn with many threads,
+# DB_POOL_SIZE + DB_MAX_OVERFLOW should be at least the number of threads of a worker.
+DEFAULT_ENGINE_OPTIONS = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+    # seconds to wait for a free connection before giving up
+    'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+    # seconds after which a connection is replaced, so that connections closed by the server or a proxy are not reused
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+}
 
 db = SQLAlchemy()
 
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    The default connection pool of SQLAlchemy, which also measures how long requests wait for a free connection.
+    A long wait means the pool is too small for the number of threads.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self.wait_lock:
+                self.checkouts += 1
+                self.total_wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
+# engine options for database_path: the pool settings above, overridden by SQLALCHEMY_ENGINE_OPTIONS in the app config.
+# SQLite keeps the pool chosen by SQLAlchemy, since a file or in-memory database has no server connections to pool.
+def get_engine_options(app, database_path):
+    engine_options = {}
+    if make_url(database_path).get_backend_name() != 'sqlite':
+        engine_options.update(DEFAULT_ENGINE_OPTIONS, poolclass=InstrumentedQueuePool)
+    engine_options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    return engine_options
+
+# when setup_db creates the missing tables (DATABASE_INIT in the app config or the environment):
+# 'lazy' on the first request, 'eager' right away, 'manual' only with `flask init-db`
+DATABASE_INIT = os.getenv('DATABASE_INIT', 'lazy')
+database_init_lock = threading.Lock()
+
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service.
+    The database is, in order: database_path, SQLALCHEMY_DATABASE_URI in the app config,
+    the DATABASE_URL environment variable, then the local trivia database.
+    A read replica is bound if SQLALCHEMY_REPLICA_URI (app config) or DATABASE_REPLICA_URL (environment) is set.
+    Nothing connects to the database here: engines are created on first use, and the tables are created
+    according to DATABASE_INIT, so that booting a worker (or a test) costs no database round trip.
 """
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    database_path = database_path or app.config.get("SQLALCHEMY_DATABASE_URI") or default_database_path
+    replica_path = app.config.get("SQLALCHEMY_REPLICA_URI", replica_database_path)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(app, database_path)
+    if replica_path:
+        app.config["SQLALCHEMY_BINDS"] = {'replica': replica_path}
     db.app = app
     db.init_app(app)
-    db.create_all()
+    database_init = app.config.get('DATABASE_INIT', DATABASE_INIT)
+    if database_init == 'eager':
+        init_db(app)
+    elif database_init == 'lazy':
+        @app.before_request
+        def initialize_database_on_first_request():
+            ensure_db_initialized(app)
+    if replica_path:
+        app.teardown_appcontext(remove_replica_session)
+        read_your_writes_seconds = int(app.config.get('REPLICA_READ_YOUR_WRITES_SECONDS', REPLICA_READ_YOUR_WRITES_SECONDS))
+
+        @app.before_request
+        def read_from_primary_after_a_write():
+            g.read_primary = READ_PRIMARY_COOKIE in request.cookies
+
+        @app.after_request
+        def remember_the_write(response):
+            if db.session.info.get('committed') and read_your_writes_seconds > 0:
+                response.set_cookie(READ_PRIMARY_COOKIE, '1', max_age=read_your_writes_seconds, httponly=True, samesite='Lax')
+            return response
+
+# create the missing tables (and the indexes and question counters created with them)
+def init_db(app):
+    with app.app_context():
+        db.create_all(bind=None)
+    app.extensions['database_initialized'] = True
+
+# init_db once per app, for the lazy mode and the CLI commands
+def ensure_db_initialized(app):
+    if app.extensions.get('database_initialized'):
+        return
+    with database_init_lock:
+        if not app.extensions.get('database_initialized'):
+            init_db(app)
+
+# the session bound to the read replica, created on first use
+def get_replica_session(app):
+    replica_session = app.extensions.get('read_replica_session')
+    if replica_session is None:
+        with database_init_lock:
+            replica_session = app.extensions.get('read_replica_session')
+            if replica_session is None:
+                replica_session = db.create_scoped_session(options={'bind': db.get_engine(app, bind='replica'), 'binds': {}})
+                app.extensions['read_replica_session'] = replica_session
+    return replica_session
+
+def remove_replica_session(exception):
+    replica_session = current_app.extensions.get('read_replica_session')
+    if replica_session is not None:
+        replica_session.remove()
+
+"""
+read_only_session()
+    the session for the read-only endpoints: bound to the read replica if one is configured, else db.session.
+    Rows read through it may lag a little behind the writes of db.session, except for a client that wrote in the last
+    REPLICA_READ_YOUR_WRITES_SECONDS (or in this request), which reads from db.session so it sees its own writes.
+"""
+def read_only_session():
+    if 'replica' in (current_app.config.get('SQLALCHEMY_BINDS') or {}):
+        if db.session.info.get('committed') or (has_request_context() and g.get('read_primary')):
+            return db.session
+        return get_replica_session(current_app)
+    return db.session
+
+# mark the sessions that committed, for read_only_session() and the read-your-writes cookie
+@event.listens_for(Session, 'after_commit')
+def remember_commit(session):
+    session.info['committed'] = True
+
+"""
+commit_session()
+    commits db.session, unless run_in_transaction() is running: then the writes are only flushed (so new rows get their ids,
+    and constraint errors are raised right away), and committed with the others when the transaction ends.
+    Question.insert()/update()/delete() and delete_questions() commit through it
+"""
+def commit_session():
+    if db.session.info.get('in_transaction'):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+# a serialization failure or a deadlock on PostgreSQL, or a SQLite database locked by another writer for longer than its busy timeout
+def is_retryable_error(error):
+    original_error = getattr(error, 'orig', None)
+    if getattr(original_error, 'pgcode', None) in RETRYABLE_SQLSTATES:
+        return True
+    return isinstance(error, OperationalError) and 'database is locked' in str(original_error)
+
+"""
+run_in_transaction(function, retries=TRANSACTION_RETRIES, durable=True)
+    calls function() and commits everything it wrote with one commit (so one fsync) instead of one per
+    Question.insert()/update()/delete(), and returns its result. If function or the commit fail with a serialization failure
+    or a deadlock (is_retryable_error), the transaction is rolled back and function is called again, up to retries times,
+    so function must only write to the database (leave the cache invalidations to after it returns).
+    durable=False does not wait for the commit to reach the disk (synchronous_commit = off, on PostgreSQL only),
+    for writes that may be lost if the database server crashes, such as telemetry: a crash loses the last commits
+    as a whole, it never leaves one half done. Called inside another run_in_transaction, it joins that transaction.
+"""
+def run_in_transaction(function, retries=TRANSACTION_RETRIES, durable=True):
+    session = db.session
+    if session.info.get('in_transaction'):
+        return function()
+    for attempt in range(retries + 1):
+        session.info['in_transaction'] = True
+        try:
+            if not durable and session.connection().dialect.name == 'postgresql':
+                session.execute(text('SET LOCAL synchronous_commit TO OFF'))
+            result = function()
+            session.commit()
+            return result
+        except DBAPIError as error:
+            session.rollback()
+            if attempt == retries or not is_retryable_error(error):
+                raise
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.info['in_transaction'] = False
+        time.sleep(TRANSACTION_RETRY_DELAY_SECONDS * 2 ** attempt)
+
+# decorator form of run_in_transaction, for a function doing a multi-step write: @transactional() or @transactional(durable=False)
+def transactional(retries=TRANSACTION_RETRIES, durable=True):
+    def decorator(function):
+        @wraps(function)
+        def transactional_function(*args, **kwargs):
+            return run_in_transaction(lambda: function(*args, **kwargs), retries=retries, durable=durable)
+        return transactional_function
+    return decorator
+
+"""
+get_pool_stats(app)
+    connection pool statistics of the primary database, and of the read replica if there is one
+"""
+def get_pool_stats(app):
+    engines = {'primary': db.get_engine(app)}
+    if 'replica' in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        engines['replica'] = db.get_engine(app, bind='replica')
+    return {name: format_pool_stats(engine.pool) for name, engine in engines.items()}
+
+def format_pool_stats(pool):
+    stats = {'pool_class': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'pool_size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            })
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool.wait_lock:
+            stats.update({
+                'checkouts': pool.checkouts,
+                'total_wait_ms': round(pool.total_wait_seconds * 1000, 3),
+                'average_wait_ms': round(pool.total_wait_seconds * 1000 / pool.checkouts, 3) if pool.checkouts else 0.0,
+                'max_wait_ms': round(pool.max_wait_seconds * 1000, 3)
+                })
+    return stats
 
 """
 Question
@@ -33,9 +272,17 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    # same foreign key as in trivia.psql: deleting a category keeps its questions, without a category
+    category = Column(Integer, ForeignKey('categories.id', name='category', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
+    # the questions of a category, in id order: serves WHERE category = ? ORDER BY id LIMIT/OFFSET
+    # (GET /categories/<id>/questions), COUNT(*) per category, and the (id, category) reads of the quiz, from the index alone.
+    # Existing databases get it from migrations/002_questions_category_index.sql
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+    )
+
     # add the default value for id as None
     # to avoid the error: TypeError: __init__() missing 1 required positional argument: 'id' when unpacking the Question JSON object into a Question object
     def __init__(self, question, answer, category, difficulty, id=None):
@@ -45,16 +292,25 @@ class Question(db.Model):
         self.difficulty = difficulty
         self.id = id
         
+    # the question counters (see QuestionCount) are updated in the same transaction as the question
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        update_question_counts({self.category: 1})
+        commit_session()
 
     def update(self):
-        db.session.commit()
+        category_history = inspect(self).attrs.category.history
+        if category_history.deleted and category_history.added:
+            update_question_counts({category_history.deleted[0]: -1, category_history.added[0]: 1})
+        commit_session()
 
     def delete(self):
+        # read before the delete: on an expired question (e.g. run again by run_in_transaction), reading it would
+        # flush the delete first, and then find no row
+        category = self.category
         db.session.delete(self)
-        db.session.commit()
+        update_question_counts({category: -1})
+        commit_session()
 
     def format(self):
         return {
@@ -65,6 +321,52 @@ class Question(db.Model):
             'difficulty': self.difficulty
             }
 
+# text search configuration used by the full-text search index and by flaskr/search.py.
+# 'simple' only lowercases the words: stopwords ("the", "of") can be searched and words are not stemmed,
+# like the in-process inverted index, so both backends find the same questions
+TEXT_SEARCH_CONFIG = 'simple'
+
+# GIN index for the full-text search of POST /questions/search. It only exists on PostgreSQL,
+# other databases use the in-process inverted index of flaskr/search.py.
+# Existing databases get it from migrations/001_questions_full_text_search.sql
+event.listen(
+    Question.__table__,
+    'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_questions_question_fts_simple ON questions USING gin (to_tsvector('{}', coalesce(question, '')))".format(TEXT_SEARCH_CONFIG)).execute_if(dialect='postgresql')
+)
+
+"""
+delete_questions(question_ids)
+    deletes the questions with these ids with one DELETE ... WHERE id IN (...) statement, and updates the question counters,
+    in one transaction. Returns the (id, category) of the deleted questions; the other ids did not exist.
+    The questions are locked (SELECT ... FOR UPDATE on PostgreSQL) between reading their categories and deleting them.
+"""
+def delete_questions(question_ids):
+    questions_to_delete = db.session.query(Question.id, Question.category).filter(Question.id.in_(question_ids)).with_for_update().all()
+    if questions_to_delete:
+        db.session.query(Question).filter(Question.id.in_([question_id for question_id, _ in questions_to_delete])) \
+            .delete(synchronize_session=False)
+        category_deltas = {}
+        for _, category in questions_to_delete:
+            category_deltas[category] = category_deltas.get(category, 0) - 1
+        update_question_counts(category_deltas)
+    commit_session()
+    return questions_to_delete
+
+# the columns of Question.format(), to read questions as plain rows instead of Question objects.
+# Skipping the ORM objects (and the identity map) makes large pages and exports much cheaper.
+QUESTION_ROW_COLUMNS = (Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+
+# same dictionary as Question.format(), for a row of QUESTION_ROW_COLUMNS
+def format_question_row(row):
+    return {
+        'id': row[0],
+        'question': row[1],
+        'answer': row[2],
+        'category': row[3],
+        'difficulty': row[4]
+        }
+
 """
 Category
 
@@ -84,3 +386,112 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
             }
+
+"""
+QuestionCount
+
+"""
+# the category_id of the counter of all questions (the frontend also uses 0 for "ALL")
+ALL_QUESTIONS = 0
+
+class QuestionCount(db.Model):
+    """
+    Denormalized number of questions, in total (category_id = ALL_QUESTIONS) and per category, so that
+    total_questions is read from one row instead of counting the questions table.
+    Question.insert()/update()/delete() and the bulk import keep them up to date in the same transaction as the questions,
+    and reconcile_question_counts() (`flask reconcile-question-counts`) recomputes them.
+    """
+    __tablename__ = 'question_counts'
+
+    category_id = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False)
+
+# statements adding the deltas ({category_id: delta}, None for the questions without a category)
+# to the counters of their categories and to the total. Categories are updated in id order, so that concurrent
+# transactions lock the counter rows in the same order.
+def question_count_updates(category_deltas):
+    deltas = {ALL_QUESTIONS: sum(category_deltas.values())}
+    for category_id, delta in category_deltas.items():
+        if category_id is not None:
+            deltas[int(category_id)] = deltas.get(int(category_id), 0) + delta
+    return [update(QuestionCount).where(QuestionCount.category_id == category_id).values(count=QuestionCount.count + delta)
+            .execution_options(synchronize_session=False)
+            for category_id, delta in sorted(deltas.items()) if delta]
+
+def update_question_counts(category_deltas):
+    for statement in question_count_updates(category_deltas):
+        db.session.execute(statement)
+
+"""
+count_questions(category_id=None)
+    the number of questions, in total or in a category, read from its counter.
+    Falls back to COUNT(*) if there is no counter (e.g. for a category added since the last reconciliation).
+"""
+def count_questions(category_id=None):
+    session = read_only_session()
+    count = session.query(QuestionCount.count).filter(QuestionCount.category_id == (category_id or ALL_QUESTIONS)).scalar()
+    if count is None:
+        query = session.query(func.count(Question.id))
+        if category_id is not None:
+            query = query.filter(Question.category == category_id)
+        count = query.scalar()
+    return count
+
+# {category_id: count} of every counter, ALL_QUESTIONS included
+def read_question_counts(session):
+    return dict(session.query(QuestionCount.category_id, QuestionCount.count))
+
+"""
+missing_question_counts_query(counts, category_ids)
+    like count_questions, for the counters read_question_counts did not find: a query of (category_id, count) counting
+    the questions of the categories of category_ids without a counter in counts, and of every category (ALL_QUESTIONS)
+    if that counter is missing too. None if no counter is missing. Run it with session.execute, sync or async.
+"""
+def missing_question_counts_query(counts, category_ids):
+    queries = []
+    missing_category_ids = [category_id for category_id in category_ids if category_id not in counts]
+    if missing_category_ids:
+        queries.append(select(Category.id, func.count(Question.id))
+                       .select_from(Category.__table__.outerjoin(Question.__table__, Question.category == Category.id))
+                       .where(Category.id.in_(missing_category_ids))
+                       .group_by(Category.id))
+    if ALL_QUESTIONS not in counts:
+        queries.append(select(literal(ALL_QUESTIONS), func.count(Question.id)))
+    if not queries:
+        return None
+    return union_all(*queries) if len(queries) > 1 else queries[0]
+
+# count the questions, in total and per category (categories without questions included)
+def compute_question_counts(connection):
+    counts = {ALL_QUESTIONS: connection.execute(select(func.count(Question.id))).scalar()}
+    counts_by_category = select(Category.id, func.count(Question.id)) \
+        .select_from(Category.__table__.outerjoin(Question.__table__, Question.category == Category.id)) \
+        .group_by(Category.id)
+    counts.update(dict(connection.execute(counts_by_category).all()))
+    return counts
+
+def write_question_counts(connection, counts):
+    connection.execute(QuestionCount.__table__.delete())
+    connection.execute(QuestionCount.__table__.insert(), [{'category_id': category_id, 'count': count} for category_id, count in counts.items()])
+
+"""
+reconcile_question_counts()
+    recomputes every question counter from the questions table, and returns {category_id: (old count, new count)}
+    of the counters that were wrong (or missing). On PostgreSQL the questions table is locked against writes meanwhile,
+    so that no insert or delete is lost between the count and the update.
+"""
+def reconcile_question_counts():
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute('LOCK TABLE questions IN SHARE MODE')
+    old_counts = read_question_counts(db.session)
+    new_counts = compute_question_counts(connection)
+    write_question_counts(connection, new_counts)
+    db.session.commit()
+    return {category_id: (old_counts.get(category_id), count) for category_id, count in new_counts.items() if old_counts.get(category_id) != count}
+
+# fill the counters when the question_counts table is still empty, e.g. right after it was created on an existing database
+@event.listens_for(db.Model.metadata, 'after_create')
+def seed_question_counts(metadata, connection, **kw):
+    if connection.execute(select(func.count()).select_from(QuestionCount.__table__)).scalar() == 0:
+        write_question_counts(connection, compute_question_counts(connection))
@@ -1,10 +1,24 @@
 import os
+import re
 import unittest
 import json
+import gzip
+import sqlite3
+import subprocess
+import sys
+import asyncio
+import importlib.util
+import tempfile
+import threading
+import time
+from flask import jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import OperationalError, IntegrityError
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+import models
+from models import setup_db, run_in_transaction, Question, Category
+from flaskr.jobs import Job, JobQueue, InMemoryJobStore, SqliteJobStore
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -58,6 +72,67 @@ class TriviaTestCase(unittest.TestCase):
             self.assertEqual(response_body['success'], False)
             self.assertEqual(response_body['message'], 'Resource Not Found')
             
+    
+    def test_get_all_categories_again_with_the_returned_etag_returns_304_without_body(self):
+        res = self.client().get('/categories')
+        etag = res.headers.get('ETag')
+        res_revalidated = self.client().get('/categories', headers={'If-None-Match': etag})
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(etag)
+        self.assertIn('no-cache', res.headers.get('Cache-Control'))
+        self.assertNotIn('max-age', res.headers.get('Cache-Control'))
+        self.assertEqual(res_revalidated.status_code, 304)
+        self.assertEqual(res_revalidated.data, b'')
+    
+    def test_get_all_categories_with_the_etag_from_before_a_new_question_returns_the_new_counts(self):
+        client = self.client()
+        res = client.get('/categories')
+        created_question_id = json.loads(client.post('/questions', json=self.new_question).data)['created_question_id']
+        res_revalidated = client.get('/categories', headers={'If-None-Match': res.headers.get('ETag')})
+        client.delete('/questions/{}'.format(created_question_id))
+
+        self.assertEqual(res_revalidated.status_code, 200)
+        self.assertNotEqual(res_revalidated.headers.get('ETag'), res.headers.get('ETag'))
+        self.assertEqual(json.loads(res_revalidated.data)['question_counts']['5'], json.loads(res.data)['question_counts']['5'] + 1)
+    
+    def test_get_all_categories_then_questions_counts_a_category_cache_hit(self):
+        # a second GET /categories would be served by the response cache, GET /questions reads the category cache
+        self.client().get('/categories')
+        self.client().get('/questions')
+        res = self.client().get('/internal/cache/categories')
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['category_cache']['misses'], 1)
+        self.assertEqual(response_body['category_cache']['hits'], 1)
+    
+    def test_a_question_count_read_before_a_write_is_not_kept_by_the_count_cache(self):
+        from flaskr import QuestionCountCache
+        question_count_cache = QuestionCountCache()
+        invalidations_before = question_count_cache.invalidations
+        # a question is created while the count is read
+        question_count_cache.invalidate()
+        question_count_cache.store(None, 19, invalidations_before)
+        is_stale_count_cached = question_count_cache.get_cached() is not None
+        question_count_cache.store(None, 20, question_count_cache.invalidations)
+        
+        self.assertFalse(is_stale_count_cached)
+        self.assertEqual(question_count_cache.get_cached(), 20)
+    
+    def test_categories_read_before_a_write_are_returned_but_not_kept_by_the_category_cache(self):
+        from flaskr.categories import CategoryCache
+        category_cache = CategoryCache()
+        invalidations_before = category_cache.invalidations
+        # a question is created while the categories are read
+        category_cache.invalidate()
+        stale_catalogue = category_cache.store([Category(id=1, type='Science')], {1: 5}, invalidations_before)
+        is_stale_catalogue_cached = category_cache.get_cached() is not None
+        category_cache.store([Category(id=1, type='Science')], {1: 6}, category_cache.invalidations)
+        
+        self.assertEqual(stale_catalogue.question_counts, {1: 5})
+        self.assertFalse(is_stale_catalogue_cached)
+        self.assertEqual(category_cache.get_cached().question_counts, {1: 6})
     #-------------------------------------------
     
     # -------Test for ['GET'] /questions endpoint-------
@@ -80,6 +155,25 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(response_body['success'], False)
         self.assertEqual(response_body['message'], 'Resource Not Found')
+    
+    def test_get_questions_after_a_particular_id_returns_only_questions_with_greater_ids_and_the_next_cursor(self):
+        res = self.client().get('/questions?after_id=5')
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['success'], True)
+        self.assertTrue(response_body['questions'])
+        self.assertTrue(all(question['id'] > 5 for question in response_body['questions']))
+        self.assertLessEqual(len(response_body['questions']), 10)
+        self.assertIn('next_after_id', response_body)
+        
+    def test_get_questions_page_and_after_id_cursor_return_the_same_second_page(self):
+        first_page = json.loads(self.client().get('/questions?after_id=0').data)
+        second_page_by_cursor = json.loads(self.client().get('/questions?after_id={}'.format(first_page['next_after_id'])).data)
+        second_page_by_number = json.loads(self.client().get('/questions?page=2').data)
+        
+        self.assertEqual(second_page_by_cursor['questions'], second_page_by_number['questions'])
+        self.assertEqual(second_page_by_cursor['total_questions'], second_page_by_number['total_questions'])
     #-------------------------------------------
     
     # -------Test for ['DELETE'] /questions/<int:question_id> endpoint-------
@@ -132,6 +226,57 @@ class TriviaTestCase(unittest.TestCase):
     
     #-------------------------------------------
     
+    # -------Test for ['POST'] /questions/bulk and ['GET'] /questions/export endpoints-------
+    def test_bulk_import_questions_inserts_valid_rows_and_reports_invalid_rows_by_line(self):
+        ndjson_body = '\n'.join([
+            json.dumps(self.new_question),
+            'this is not json',
+            json.dumps({"question": "Is this valid?", "answer": "no", "difficulty": 1, "category": 1000}),
+            json.dumps({"question": "", "answer": "no", "difficulty": 1, "category": 1})
+            ])
+        res = self.client().post('/questions/bulk', data=ndjson_body, content_type='application/x-ndjson')
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(response_body['success'])
+        self.assertEqual(response_body['inserted_questions'], 1)
+        self.assertEqual(response_body['rejected_questions'], 3)
+        self.assertEqual([error['line'] for error in response_body['errors']], [2, 3, 4])
+    
+    def test_bulk_import_questions_rejects_booleans_fractions_and_duplicate_ids_without_the_database_error(self):
+        existing_question_id = json.loads(self.client().get('/questions').data)['questions'][0]['id']
+        ndjson_body = '\n'.join([
+            json.dumps({**self.new_question, "category": True}),
+            json.dumps({**self.new_question, "difficulty": 1.9}),
+            json.dumps({**self.new_question, "id": existing_question_id})
+            ])
+        res = self.client().post('/questions/bulk', data=ndjson_body, content_type='application/x-ndjson')
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['inserted_questions'], 0)
+        self.assertEqual([error['line'] for error in response_body['errors']], [1, 2, 3])
+        self.assertEqual(response_body['errors'][2]['error'], 'Unprocessable Entity: refused by the database (e.g. a duplicate id)')
+    
+    def test_bulk_import_questions_with_empty_body_returns_400(self):
+        res = self.client().post('/questions/bulk', data='', content_type='application/x-ndjson')
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(response_body['success'])
+        self.assertEqual(response_body['message'], 'Bad Request')
+    
+    def test_export_questions_streams_every_question_as_one_json_line(self):
+        res = self.client().get('/questions/export')
+        exported_questions = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+        total_questions = json.loads(self.client().get('/questions').data)['total_questions']
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(exported_questions), total_questions)
+        self.assertEqual([question['id'] for question in exported_questions], sorted(question['id'] for question in exported_questions))
+    #-------------------------------------------
+    
     # -------Test for ['GET'] /categories/<int:category_id>/questions endpoint-------
     def test_get_questions_belong_to_a_particular_category_return_questions_of_that_category_and_their_total_number(self):
         res = self.client().get('/categories/1/questions')
@@ -165,6 +310,45 @@ class TriviaTestCase(unittest.TestCase):
         self.assertGreaterEqual(response_body['total_questions'], 0)
         self.assertIsNone(response_body['current_category'])
     
+    def test_search_for_questions_with_the_beginning_of_words_returns_questions_having_every_word(self):
+        res = self.client().post('/questions/search', json={'searchTerm': 'Hall Mirr'})
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['total_questions'], 1)
+        self.assertIn('Hall of Mirrors', response_body['questions'][0]['question'])
+    
+    def test_search_for_questions_with_a_stopword_returns_every_question_having_a_word_starting_with_it(self):
+        with self.app.app_context():
+            expected_question_ids = sorted(question.id for question in Question.query.all()
+                                           if any(word.startswith('the') for word in re.findall(r'[^\W_]+', question.question.lower())))
+        res = self.client().post('/questions/search?per_page=1000', json={'searchTerm': 'the'})
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(len(expected_question_ids), 0)
+        self.assertEqual(response_body['total_questions'], len(expected_question_ids))
+        self.assertEqual(sorted(question['id'] for question in response_body['questions']), expected_question_ids)
+    
+    def test_search_for_questions_does_not_match_the_search_term_in_the_middle_of_a_word(self):
+        # unlike the former ILIKE '%title%', 'entitled' does not match 'title'
+        res = self.client().post('/questions/search', json={'searchTerm': 'title'})
+        found_questions = [question['question'] for question in json.loads(res.data)['questions']]
+        res_middle_of_word = self.client().post('/questions/search', json={'searchTerm': 'itle'})
+        
+        self.assertTrue(any('title' in question.lower().split() for question in found_questions))
+        self.assertFalse(any('entitled' in question.lower() for question in found_questions))
+        self.assertEqual(json.loads(res_middle_of_word.data)['total_questions'], 0)
+    
+    def test_search_for_questions_with_a_search_term_that_matches_nothing_returns_no_questions(self):
+        res = self.client().post('/questions/search', json={'searchTerm': 'xylophonezzz'})
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(response_body['success'])
+        self.assertEqual(response_body['questions'], [])
+        self.assertEqual(response_body['total_questions'], 0)
+    
     def test_search_for_questions_containing_search_term_but_missing_search_term_in_the_request_returns_400(self):
         res = self.client().post('/questions/search', json={})
         response_body = json.loads(res.data)
@@ -216,6 +400,44 @@ class TriviaTestCase(unittest.TestCase):
             self.assertTrue(category_of_current_question in ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports'])
             self.assertTrue(question_object.id != 1)
     
+    def test_get_question_to_play_quiz_given_every_question_of_the_category_as_previous_questions_returns_None(self):
+        questions_of_science = json.loads(self.client().get('/categories/1/questions').data)['questions']
+        previous_questions = [question['id'] for question in questions_of_science]
+        res = self.client().post('/quizzes', json={'previous_questions': previous_questions, 'quiz_category': {'id': 1, 'type': 'Science'}})
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(response_body['success'])
+        self.assertIsNone(response_body['question'])
+    
+    def test_get_question_to_play_quiz_given_all_but_one_question_of_the_category_as_previous_questions_returns_the_remaining_question(self):
+        questions_of_science = json.loads(self.client().get('/categories/1/questions').data)['questions']
+        previous_questions = [question['id'] for question in questions_of_science[1:]]
+        res = self.client().post('/quizzes', json={'previous_questions': previous_questions, 'quiz_category': {'id': 1, 'type': 'Science'}})
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['question']['id'], questions_of_science[0]['id'])
+    
+    def test_play_quiz_of_all_categories_to_the_end_asks_every_question_once_but_not_deleted_ones(self):
+        client = self.client()
+        created_question_id = json.loads(client.post('/questions', json=self.new_question).data)['created_question_id']
+        deleted_question_id = json.loads(client.post('/questions', json=self.new_question).data)['created_question_id']
+        client.delete('/questions/{}'.format(deleted_question_id))
+        previous_questions = []
+        while True:
+            response_body = json.loads(client.post('/quizzes', json={'previous_questions': previous_questions, 'quiz_category': {'id': 0, 'type': 'click'}}).data)
+            if response_body['question'] is None:
+                break
+            previous_questions.append(response_body['question']['id'])
+        total_questions = json.loads(client.get('/categories').data)['total_questions']
+        client.delete('/questions/{}'.format(created_question_id))
+
+        self.assertEqual(len(previous_questions), total_questions)
+        self.assertEqual(len(set(previous_questions)), total_questions)
+        self.assertIn(created_question_id, previous_questions)
+        self.assertNotIn(deleted_question_id, previous_questions)
+    
     def test_get_question_to_play_quiz_without_sending_the_request_body_returns_400(self):
         res = self.client().post('/quizzes', json={})
         response_body = json.loads(res.data)
@@ -231,6 +453,805 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertFalse(response_body['success'])
         self.assertEqual(response_body['message'], 'Bad Request')
+    
+    def test_get_question_to_play_quiz_with_the_category_id_and_previous_questions_as_strings_like_the_frontend(self):
+        questions_of_science = json.loads(self.client().get('/categories/1/questions').data)['questions']
+        previous_questions = [str(question['id']) for question in questions_of_science[1:]]
+        res = self.client().post('/quizzes', json={'previous_questions': previous_questions, 'quiz_category': {'id': '1', 'type': 'Science'}})
+        response_body = json.loads(res.data)
+        res_session = self.client().post('/quizzes/sessions', json={'quiz_category': {'id': '1', 'type': 'Science'}})
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['question']['id'], questions_of_science[0]['id'])
+        self.assertEqual(res_session.status_code, 201)
+        self.assertEqual(json.loads(res_session.data)['total_questions'], len(questions_of_science))
+    
+    def test_get_question_to_play_quiz_with_a_category_id_or_previous_question_that_is_not_an_integer_returns_400(self):
+        res_category = self.client().post('/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 'science', 'type': 'Science'}})
+        res_previous = self.client().post('/quizzes', json={'previous_questions': ['1', 'two'], 'quiz_category': {'id': '1', 'type': 'Science'}})
+        res_session = self.client().post('/quizzes/sessions', json={'quiz_category': {'type': 'Science'}})
+        
+        self.assertEqual(res_category.status_code, 400)
+        self.assertEqual(res_previous.status_code, 400)
+        self.assertEqual(json.loads(res_previous.data)['success'], False)
+        self.assertEqual(res_session.status_code, 400)
+
+    def test_quiz_picks_deal_from_the_current_decks_while_another_thread_reloads_them(self):
+        from flaskr.quiz import QuizQuestionSelector
+        reload_started = threading.Event()
+        finish_reload = threading.Event()
+        loads = []
+        def load_rows():
+            loads.append(time.monotonic())
+            if len(loads) > 1:
+                reload_started.set()
+                finish_reload.wait(5)
+            return [(1, 1, 1), (2, 1, 2)]
+        # refresh_seconds=-1: every pick finds the decks out of date
+        selector = QuizQuestionSelector(refresh_seconds=-1, load_rows=load_rows)
+        selector.load()
+        reloading_thread = threading.Thread(target=selector.pick_question_id, args=(1, []))
+        reloading_thread.start()
+        reload_started.wait(5)
+        started_at = time.monotonic()
+        question_id = selector.pick_question_id(1, [])
+        pick_seconds = time.monotonic() - started_at
+        finish_reload.set()
+        reloading_thread.join()
+
+        self.assertIn(question_id, [1, 2])
+        self.assertLess(pick_seconds, 1)
+        self.assertEqual(len(loads), 2)
+    #-------------------------------------------
+    
+    # -------Test for ['GET'] /internal/pool endpoint-------
+    def test_get_connection_pool_stats_returns_the_stats_of_the_primary_database_pool(self):
+        self.client().get('/questions')
+        res = self.client().get('/internal/pool')
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(response_body['success'])
+        self.assertIn('primary', response_body['pools'])
+        self.assertTrue(response_body['pools']['primary']['pool_class'])
+        self.assertIn('status', response_body['pools']['primary'])
+    #-------------------------------------------
+    
+    # -------Test for the response cache-------
+    def test_get_questions_twice_is_served_from_the_response_cache_the_second_time(self):
+        client = self.client()
+        res = client.get('/questions?page=1')
+        res_cached = client.get('/questions?page=1')
+        response_body = json.loads(client.get('/internal/cache/responses').data)
+
+        self.assertEqual(res_cached.status_code, 200)
+        self.assertEqual(res_cached.data, res.data)
+        self.assertEqual(res_cached.headers.get('ETag'), res.headers.get('ETag'))
+        self.assertIn('max-age', res.headers.get('Cache-Control'))
+        self.assertEqual(response_body['response_cache']['hits'], 1)
+        self.assertEqual(response_body['response_cache']['misses'], 1)
+
+    def test_create_a_question_invalidates_only_the_cached_responses_it_changes(self):
+        client = self.client()
+        client.get('/categories/5/questions')
+        client.get('/categories/1/questions')
+        created_question_id = json.loads(client.post('/questions', json=self.new_question).data)['created_question_id']
+        res_category_5 = client.get('/categories/5/questions')
+        client.get('/categories/1/questions')
+        response_body = json.loads(client.get('/internal/cache/responses').data)
+        client.delete('/questions/{}'.format(created_question_id))
+
+        self.assertIn(created_question_id, [question['id'] for question in json.loads(res_category_5.data)['questions']])
+        self.assertEqual(response_body['response_cache']['hits'], 1)
+        self.assertEqual(response_body['response_cache']['misses'], 3)
+
+    def test_drop_the_cached_responses_and_categories_needs_the_admin_token(self):
+        client = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'INTERNAL_ADMIN_TOKEN': 'admin-secret'}).test_client()
+        client.get('/questions?page=1')
+        res_without_header = client.delete('/internal/cache/responses')
+        res_wrong_token = client.delete('/internal/cache/categories', headers={'Authorization': 'Bearer guess'})
+        res_without_configured_token = self.client().delete('/internal/cache/responses', headers={'Authorization': 'Bearer '})
+        entries_after_refused_deletes = json.loads(client.get('/internal/cache/responses').data)['response_cache']['entries']
+        res_clear = client.delete('/internal/cache/responses', headers={'Authorization': 'Bearer admin-secret'})
+        res_invalidate = client.delete('/internal/cache/categories', headers={'Authorization': 'Bearer admin-secret'})
+
+        for res in [res_without_header, res_wrong_token, res_without_configured_token]:
+            self.assertEqual(res.status_code, 403)
+            self.assertEqual(json.loads(res.data), {'success': False, 'error': 403, 'message': 'Forbidden'})
+        self.assertEqual(entries_after_refused_deletes, 1)
+        self.assertEqual(res_clear.status_code, 200)
+        self.assertEqual(json.loads(res_clear.data)['response_cache']['entries'], 0)
+        self.assertEqual(res_invalidate.status_code, 200)
+    #-------------------------------------------
+
+    # -------Test for the adaptive quiz mode-------
+    def test_play_adaptive_quiz_after_two_right_answers_asks_a_harder_question(self):
+        res = self.client().post('/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 0, 'type': 'click'},
+                                                   'adaptive': True, 'difficulty': 3, 'recent_answers': [False, True, True]})
+        response_body = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['difficulty'], 4)
+        self.assertEqual(response_body['question']['difficulty'], 4)
+
+    def test_play_adaptive_quiz_after_every_question_of_the_difficulty_asks_the_nearest_difficulty(self):
+        with self.app.app_context():
+            questions_of_difficulty_4 = [question.id for question in Question.query.filter(Question.difficulty == 4)]
+        res = self.client().post('/quizzes', json={'previous_questions': questions_of_difficulty_4, 'quiz_category': {'id': 0, 'type': 'click'},
+                                                   'adaptive': True, 'difficulty': 4, 'recent_answers': [True, False]})
+        response_body = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['difficulty'], 4)
+        self.assertIn(response_body['question']['difficulty'], [3, 5])
+
+    def test_play_adaptive_quiz_with_recent_answers_that_are_not_booleans_returns_400(self):
+        res = self.client().post('/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 0, 'type': 'click'},
+                                                   'adaptive': True, 'recent_answers': 'yes'})
+        response_body = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(response_body['success'], False)
+    #-------------------------------------------
+
+    # -------Test for the question snapshot-------
+    def create_snapshot_app(self, **config):
+        snapshot_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_folder.cleanup)
+        return create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'QUESTION_SNAPSHOT_PATH': os.path.join(snapshot_folder.name, 'questions.snapshot'),
+                           'SNAPSHOT_REBUILD_DELAY_SECONDS': 0, 'RESPONSE_CACHE_SECONDS': 0, **config})
+
+    def test_get_questions_from_the_snapshot_returns_the_same_pages_as_the_database(self):
+        snapshot_client = self.create_snapshot_app().test_client()
+        for path in ['/questions?page=1', '/questions?page=2', '/questions?after_id=5', '/categories/1/questions', '/categories/1000/questions']:
+            res = self.client().get(path)
+            res_snapshot = snapshot_client.get(path)
+
+            self.assertEqual(res_snapshot.status_code, res.status_code, path)
+            self.assertEqual(json.loads(res_snapshot.data), json.loads(res.data), path)
+
+    def test_create_then_delete_a_question_rebuilds_the_snapshot(self):
+        snapshot_client = self.create_snapshot_app().test_client()
+        total_questions = json.loads(snapshot_client.get('/questions').data)['total_questions']
+        created_question_id = json.loads(snapshot_client.post('/questions', json=self.new_question).data)['created_question_id']
+        res_after_create = json.loads(snapshot_client.get('/questions?after_id={}'.format(created_question_id - 1)).data)
+        snapshot_client.delete('/questions/{}'.format(created_question_id))
+        res_after_delete = snapshot_client.get('/questions?after_id={}'.format(created_question_id - 1))
+        snapshot_stats = json.loads(snapshot_client.get('/internal/snapshot').data)['snapshot']
+
+        self.assertEqual(res_after_create['total_questions'], total_questions + 1)
+        self.assertEqual(res_after_create['questions'][0]['id'], created_question_id)
+        self.assertEqual(res_after_delete.status_code, 404)
+        self.assertEqual(snapshot_stats['questions'], total_questions)
+        self.assertEqual(snapshot_stats['rebuilds'], 3)
+
+    def test_cached_pages_read_before_the_snapshot_rebuild_are_dropped_when_the_new_snapshot_is_opened(self):
+        snapshot_client = self.create_snapshot_app(SNAPSHOT_REBUILD_DELAY_SECONDS=0.2, SNAPSHOT_CHECK_SECONDS=0, RESPONSE_CACHE_SECONDS=60).test_client()
+        total_questions = json.loads(snapshot_client.get('/questions').data)['total_questions']
+        created_question_id = json.loads(snapshot_client.post('/questions', json=self.new_question).data)['created_question_id']
+        # read from the previous snapshot, and cached
+        total_questions_before_the_rebuild = json.loads(snapshot_client.get('/questions').data)['total_questions']
+        deadline = time.monotonic() + 10
+        while json.loads(snapshot_client.get('/internal/snapshot').data)['snapshot']['questions'] != total_questions + 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        total_questions_after_the_rebuild = json.loads(snapshot_client.get('/questions').data)['total_questions']
+        self.client().delete('/questions/{}'.format(created_question_id))
+
+        self.assertEqual(total_questions_before_the_rebuild, total_questions)
+        self.assertEqual(total_questions_after_the_rebuild, total_questions + 1)
+
+    def test_play_quiz_from_the_snapshot_asks_every_question_of_the_category_once(self):
+        snapshot_client = self.create_snapshot_app().test_client()
+        with self.app.app_context():
+            questions_of_category_1 = {question.id for question in Question.query.filter(Question.category == 1)}
+        previous_questions = []
+        while True:
+            question = json.loads(snapshot_client.post('/quizzes', json={'previous_questions': previous_questions, 'quiz_category': {'id': 1, 'type': 'Science'}}).data)['question']
+            if question is None:
+                break
+            previous_questions.append(question['id'])
+
+        self.assertEqual(sorted(previous_questions), sorted(questions_of_category_1))
+    #-------------------------------------------
+
+    # -------Test for the job queue-------
+    def wait_for_job(self, client, job_id, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = json.loads(client.get('/internal/jobs/{}'.format(job_id)).data)['job']
+            if job['status'] in ('done', 'failed') or time.monotonic() > deadline:
+                return job
+            time.sleep(0.05)
+
+    def test_bulk_import_questions_in_the_background_returns_202_then_the_job_returns_the_import_summary(self):
+        client = self.client()
+        total_questions = json.loads(client.get('/questions').data)['total_questions']
+        ndjson_body = '\n'.join([json.dumps(self.new_question), 'this is not json'])
+        res = client.post('/questions/bulk?background=true', data=ndjson_body, content_type='application/x-ndjson')
+        response_body = json.loads(res.data)
+        job = self.wait_for_job(client, response_body['job_id'])
+
+        self.assertEqual(res.status_code, 202)
+        self.assertTrue(response_body['success'])
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['result']['inserted_questions'], 1)
+        self.assertEqual([error['line'] for error in job['result']['errors']], [2])
+        self.assertEqual(json.loads(client.get('/questions').data)['total_questions'], total_questions + 1)
+
+    def test_enqueue_a_maintenance_job_returns_202_and_unknown_jobs_return_404(self):
+        client = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'INTERNAL_ADMIN_TOKEN': 'admin-secret'}).test_client()
+        admin_headers = {'Authorization': 'Bearer admin-secret'}
+        res = client.post('/internal/jobs/reconcile-question-counts', headers=admin_headers)
+        job = self.wait_for_job(client, json.loads(res.data)['job_id'])
+        res_unknown_name = client.post('/internal/jobs/drop-everything', headers=admin_headers)
+        res_unknown_id = client.get('/internal/jobs/1000000')
+        metrics = client.get('/metrics').data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['result'], {'corrected_question_counts': 0})
+        self.assertEqual(res_unknown_name.status_code, 404)
+        self.assertEqual(res_unknown_id.status_code, 404)
+        self.assertIn('trivia_jobs_run_total{name="reconcile-question-counts",result="done"} 1', metrics)
+
+    def test_enqueue_a_job_without_the_admin_token_returns_403(self):
+        client_without_token = self.client()
+        client = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'INTERNAL_ADMIN_TOKEN': 'admin-secret'}).test_client()
+        
+        res_without_configured_token = client_without_token.post('/internal/jobs/reconcile-question-counts', headers={'Authorization': 'Bearer '})
+        res_without_header = client.post('/internal/jobs/reconcile-question-counts')
+        res_wrong_token = client.post('/internal/jobs/reconcile-question-counts', headers={'Authorization': 'Bearer guess'})
+        
+        for res in [res_without_configured_token, res_without_header, res_wrong_token]:
+            self.assertEqual(res.status_code, 403)
+            self.assertEqual(json.loads(res.data), {'success': False, 'error': 403, 'message': 'Forbidden'})
+        self.assertEqual(sum(json.loads(client.get('/internal/jobs').data)['job_queue']['queue'].values()), 0)
+
+    def test_sqlite_job_store_keeps_queued_jobs_across_reopening(self):
+        job_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(job_folder.cleanup)
+        job_path = os.path.join(job_folder.name, 'jobs.sqlite3')
+        job_id = SqliteJobStore(job_path).add(Job('import-questions', {'path': '/tmp/questions.ndjson'}))
+        reopened_store = SqliteJobStore(job_path)
+        job = reopened_store.claim(os.getpid())
+
+        self.assertEqual(job.id, job_id)
+        self.assertEqual(job.arguments, {'path': '/tmp/questions.ndjson'})
+        self.assertIsNone(reopened_store.claim(os.getpid()))
+        self.assertEqual(reopened_store.count()['running'], 1)
+
+    def test_sqlite_job_store_fails_the_imports_of_a_dead_worker_and_queues_its_other_jobs_again(self):
+        job_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(job_folder.cleanup)
+        job_path = os.path.join(job_folder.name, 'jobs.sqlite3')
+        dead_worker = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead_worker.wait()
+        store = SqliteJobStore(job_path)
+        import_job_id = store.add(Job('import-questions', {'path': '/tmp/questions.ndjson'}))
+        reconcile_job_id = store.add(Job('reconcile-question-counts', {}))
+        store.claim(dead_worker.pid)
+        store.claim(dead_worker.pid)
+        reopened_store = SqliteJobStore(job_path)
+        reopened_store.names_not_to_rerun.add('import-questions')
+        import_job = reopened_store.get(import_job_id)
+
+        self.assertEqual(import_job.status, 'failed')
+        self.assertEqual(import_job.error, 'The worker process running the job died')
+        self.assertEqual(reopened_store.get(reconcile_job_id).status, 'queued')
+
+    def test_a_failed_job_keeps_the_error_message_without_the_traceback(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+        job_queue = JobQueue(app, InMemoryJobStore(), workers=1, poll_seconds=0.01)
+        def failing_job(path):
+            raise FileNotFoundError('No such file: {}'.format(path))
+        job_queue.register('failing-job', failing_job)
+        job_id = job_queue.enqueue('failing-job', path='questions.ndjson')
+        deadline = time.monotonic() + 10
+        while job_queue.get(job_id).status != 'failed' and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(job_queue.get(job_id).error, 'FileNotFoundError: No such file: questions.ndjson')
+    #-------------------------------------------
+
+    # -------Test for the rate limit and the search single flight-------
+    def test_play_quiz_beyond_the_rate_limit_burst_returns_429_with_retry_after(self):
+        client = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'RATE_LIMIT_PER_SECOND': 0.01, 'RATE_LIMIT_BURST': 2}).test_client()
+        quiz = {'previous_questions': [], 'quiz_category': {'id': 1, 'type': 'Science'}}
+        responses = [client.post('/quizzes', json=quiz) for _ in range(3)]
+        response_body = json.loads(responses[2].data)
+
+        self.assertEqual([res.status_code for res in responses], [200, 200, 429])
+        self.assertEqual(response_body['success'], False)
+        self.assertEqual(response_body['error'], 429)
+        self.assertEqual(response_body['message'], 'Too Many Requests')
+        self.assertGreaterEqual(int(responses[2].headers['Retry-After']), 1)
+
+    def test_rate_limited_quiz_does_not_limit_search_of_the_same_client(self):
+        client = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'RATE_LIMIT_PER_SECOND': 0.01, 'RATE_LIMIT_BURST': 1}).test_client()
+        quiz = {'previous_questions': [], 'quiz_category': {'id': 1, 'type': 'Science'}}
+        client.post('/quizzes', json=quiz)
+        res_quiz = client.post('/quizzes', json=quiz)
+        res_search = client.post('/questions/search', json={'searchTerm': 'title'})
+        response_body = json.loads(client.get('/internal/rate-limit').data)
+
+        self.assertEqual(res_quiz.status_code, 429)
+        self.assertEqual(res_search.status_code, 200)
+        self.assertEqual(response_body['rate_limit']['rejected'], 1)
+
+    def test_concurrent_identical_calls_of_a_single_flight_run_the_function_once(self):
+        from flaskr.single_flight import SingleFlight
+        single_flight = SingleFlight()
+        function_started = threading.Event()
+        release_function = threading.Event()
+        calls = []
+
+        def slow_search():
+            calls.append(1)
+            function_started.set()
+            release_function.wait(5)
+            return ['question']
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(single_flight.do('title', slow_search)))
+        leader.start()
+        function_started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(single_flight.do('title', slow_search))) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        while single_flight.stats()['calls_coalesced'] < 3:
+            time.sleep(0.001)
+        release_function.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['question']] * 4)
+        self.assertEqual(single_flight.stats(), {'calls_run': 1, 'calls_coalesced': 3, 'calls_in_flight': 0})
+    #-------------------------------------------
+
+    # -------Test for batch fetch and batch delete of questions-------
+    def test_get_questions_by_ids_returns_the_questions_in_order_and_the_missing_ids(self):
+        res = self.client().get('/questions?ids=4,2,1000000')
+        response_body = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([question['id'] for question in response_body['questions']], [4, 2])
+        self.assertEqual(response_body['missing_ids'], [1000000])
+
+    def test_delete_questions_by_ids_deletes_them_and_reports_the_missing_ids(self):
+        client = self.client()
+        created_question_ids = [json.loads(client.post('/questions', json=self.new_question).data)['created_question_id'] for _ in range(3)]
+        total_before = json.loads(client.get('/categories').data)['total_questions']
+        res = client.delete('/questions', json={'ids': created_question_ids + [1000000]})
+        response_body = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['deleted_question_ids'], created_question_ids)
+        self.assertEqual(response_body['missing_ids'], [1000000])
+        self.assertEqual(json.loads(client.get('/questions?ids={}'.format(created_question_ids[0])).data)['missing_ids'], [created_question_ids[0]])
+        self.assertEqual(json.loads(client.get('/categories').data)['total_questions'], total_before - 3)
+
+    def test_delete_questions_with_ids_that_are_not_integers_returns_400(self):
+        res = self.client().delete('/questions?ids=1,abc')
+        response_body = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(response_body['success'], False)
+    #-------------------------------------------
+
+    # -------Test for the question counters-------
+    def test_get_all_categories_returns_the_number_of_questions_of_each_category(self):
+        res = self.client().get('/categories')
+        response_body = json.loads(res.data)
+        with self.app.app_context():
+            expected_total = Question.query.count()
+            expected_science_count = Question.query.filter(Question.category == 1).count()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['total_questions'], expected_total)
+        self.assertEqual(response_body['question_counts']['1'], expected_science_count)
+
+    def test_create_then_delete_a_question_updates_the_question_counters(self):
+        client = self.client()
+        total_before = json.loads(client.get('/categories').data)['total_questions']
+        created_question_id = json.loads(client.post('/questions', json=self.new_question).data)['created_question_id']
+        total_after_create = json.loads(client.get('/categories').data)
+        client.delete('/questions/{}'.format(created_question_id))
+        total_after_delete = json.loads(client.get('/categories').data)['total_questions']
+
+        self.assertEqual(total_after_create['total_questions'], total_before + 1)
+        self.assertEqual(json.loads(client.get('/questions?page=1').data)['total_questions'], total_before)
+        self.assertEqual(total_after_delete, total_before)
+
+    def test_reconcile_question_counts_corrects_a_wrong_counter(self):
+        with self.app.app_context():
+            models.update_question_counts({1: 5})
+            models.db.session.commit()
+            result = self.app.test_cli_runner().invoke(args=['reconcile-question-counts'])
+            corrected_again = models.reconcile_question_counts()
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('category 1', result.output)
+        self.assertIn('Corrected 2 question counters', result.output)
+        self.assertEqual(corrected_again, {})
+
+    def test_get_all_categories_counts_the_questions_of_a_category_without_counter(self):
+        with self.app.app_context():
+            expected_count = Question.query.filter(Question.category == 1).count()
+            models.db.session.query(models.QuestionCount).filter(models.QuestionCount.category_id.in_([1, models.ALL_QUESTIONS])).delete(synchronize_session=False)
+            models.db.session.commit()
+            expected_total = Question.query.count()
+        try:
+            response_body = json.loads(self.client().get('/categories').data)
+        finally:
+            with self.app.app_context():
+                models.reconcile_question_counts()
+
+        self.assertEqual(response_body['question_counts']['1'], expected_count)
+        self.assertGreater(response_body['question_counts']['1'], 0)
+        self.assertEqual(response_body['total_questions'], expected_total)
+    #-------------------------------------------
+
+    # -------Test for ['GET'] /metrics endpoint and Server-Timing-------
+    def test_get_questions_returns_server_timing_header_with_the_number_of_queries(self):
+        res = self.client().get('/questions?page=1')
+        server_timing = res.headers.get('Server-Timing')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('db;dur=', server_timing)
+        self.assertIn('total;dur=', server_timing)
+        self.assertRegex(server_timing, r'desc="[1-9][0-9]* queries"')
+
+    def test_get_metrics_returns_latency_histogram_and_query_counts_per_route(self):
+        client = self.client()
+        client.get('/questions?page=1')
+        client.get('/questions/1000000/not-a-route')
+        res = client.get('/metrics')
+        metrics = res.data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('trivia_request_duration_seconds_bucket{endpoint="/questions",method="GET",le="+Inf"} 1', metrics)
+        self.assertIn('trivia_requests_total{endpoint="unmatched",method="GET",status="404"} 1', metrics)
+        self.assertRegex(metrics, r'trivia_db_queries_total\{endpoint="/questions",method="GET"\} [1-9]')
+
+    def test_a_statement_that_raises_leaves_no_start_time_on_the_connection(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'SLOW_QUERY_SECONDS': 0})
+        with app.app_context():
+            connection = models.db.session.connection()
+            with self.assertRaises(Exception):
+                connection.exec_driver_sql('SELECT * FROM no_such_table')
+            models.db.session.rollback()
+            connection = models.db.session.connection()
+            with self.assertLogs('flaskr.slow_queries', level='WARNING') as logs:
+                connection.exec_driver_sql('SELECT 1')
+
+            self.assertNotIn('query_started_at', connection.info)
+            self.assertIn('SELECT 1', logs.output[-1])
+            models.db.session.remove()
+
+    # -------Test for page sizes, streaming and compression-------
+    def test_get_questions_with_per_page_returns_that_many_questions_up_to_the_maximum(self):
+        client = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'MAX_QUESTIONS_PER_PAGE': 12}).test_client()
+        res_five = json.loads(client.get('/questions?per_page=5').data)
+        res_too_many = json.loads(client.get('/questions?per_page=1000').data)
+        res_second_page = json.loads(client.get('/questions?per_page=5&page=2').data)
+
+        self.assertEqual(len(res_five['questions']), 5)
+        self.assertEqual(len(res_too_many['questions']), 12)
+        self.assertEqual(res_second_page['questions'][0], res_too_many['questions'][5])
+
+    def test_get_a_large_page_streams_the_same_json_as_a_small_page(self):
+        streaming_client = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'STREAM_MIN_QUESTIONS': 5, 'RESPONSE_CACHE_SECONDS': 0}).test_client()
+        for path in ['/questions?per_page=15', '/categories/1/questions?per_page=15', '/questions?per_page=5&after_id=2']:
+            res = self.client().get(path)
+            res_streamed = streaming_client.get(path)
+
+            self.assertTrue(res_streamed.is_streamed, path)
+            self.assertEqual(res_streamed.mimetype, 'application/json', path)
+            self.assertEqual(json.loads(res_streamed.data), json.loads(res.data), path)
+
+    def test_get_questions_with_accept_encoding_gzip_returns_a_gzip_body_above_the_threshold(self):
+        client = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'COMPRESSION_MIN_BYTES': 1024}).test_client()
+        res = client.get('/questions?per_page=15')
+        res_gzip = client.get('/questions?per_page=15', headers={'Accept-Encoding': 'gzip'})
+        res_small_page = client.get('/questions?per_page=1', headers={'Accept-Encoding': 'gzip'})
+        res_not_modified = client.get('/questions?per_page=15', headers={'Accept-Encoding': 'gzip', 'If-None-Match': res_gzip.headers['ETag']})
+
+        self.assertIsNone(res.headers.get('Content-Encoding'))
+        self.assertEqual(res_gzip.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res_gzip.headers['Vary'])
+        self.assertLess(len(res_gzip.data), len(res.data))
+        self.assertEqual(gzip.decompress(res_gzip.data), res.data)
+        self.assertTrue(res_gzip.headers['ETag'].startswith('W/'))
+        self.assertIsNone(res_small_page.headers.get('Content-Encoding'))
+        self.assertEqual(res_not_modified.status_code, 304)
+    #-------------------------------------------
+
+    # -------Test for transactions and commit counts-------
+    def test_questions_inserted_in_one_transaction_are_committed_once(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+        @app.route('/test/questions/three', methods=['POST'])
+        def insert_three_questions():
+            new_questions = [Question(question='Transaction question {}?'.format(number), answer='yes', category=1, difficulty=1) for number in range(3)]
+            run_in_transaction(lambda: [new_question.insert() for new_question in new_questions])
+            return jsonify({'created_question_ids': [new_question.id for new_question in new_questions]})
+        client = app.test_client()
+        res = client.post('/test/questions/three')
+        created_question_ids = json.loads(res.data)['created_question_ids']
+        res_create_one = client.post('/questions', json=self.new_question)
+        metrics = client.get('/metrics').data.decode('utf-8')
+        client.delete('/questions?ids={}'.format(','.join(str(question_id) for question_id in created_question_ids + [json.loads(res_create_one.data)['created_question_id']])))
+
+        self.assertEqual(len(set(created_question_ids)), 3)
+        self.assertIn('commits;desc="1"', res.headers['Server-Timing'])
+        self.assertIn('commits;desc="1"', res_create_one.headers['Server-Timing'])
+        self.assertIn('trivia_db_commits_total{endpoint="/test/questions/three",method="POST"} 1', metrics)
+
+    def test_run_in_transaction_runs_again_after_a_locked_database_and_not_after_other_errors(self):
+        calls = []
+        def insert_after_a_lock():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                raise OperationalError('INSERT INTO questions', {}, sqlite3.OperationalError('database is locked'))
+            Question(question='Retried question?', answer='yes', category=1, difficulty=1).insert()
+        def fail_with_integrity_error():
+            raise IntegrityError('INSERT INTO questions', {}, sqlite3.IntegrityError('UNIQUE constraint failed'))
+        with self.app.app_context():
+            run_in_transaction(insert_after_a_lock)
+            retried_question = Question.query.filter(Question.question == 'Retried question?').one()
+            with self.assertRaises(IntegrityError):
+                run_in_transaction(fail_with_integrity_error)
+            retried_question.delete()
+
+        self.assertEqual(calls, [0, 1])
+
+    def test_client_that_wrote_reads_from_the_primary_instead_of_the_replica(self):
+        replica_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(replica_folder.cleanup)
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'SQLALCHEMY_REPLICA_URI': 'sqlite:///' + os.path.join(replica_folder.name, 'replica.db')})
+        res = app.test_client().post('/questions', json=self.new_question)
+        with app.test_request_context('/questions'):
+            app.preprocess_request()
+            is_replica_read_before_the_write = models.read_only_session() is not models.db.session
+        with app.test_request_context('/questions', headers={'Cookie': res.headers['Set-Cookie'].split(';')[0]}):
+            app.preprocess_request()
+            is_primary_read_after_the_write = models.read_only_session() is models.db.session
+        app.test_client().delete('/questions/{}'.format(json.loads(res.data)['created_question_id']))
+
+        self.assertTrue(res.headers['Set-Cookie'].startswith('trivia_read_primary=1'))
+        self.assertTrue(is_replica_read_before_the_write)
+        self.assertTrue(is_primary_read_after_the_write)
+    #-------------------------------------------
+
+    # -------Test for the JSON encoders-------
+    def test_get_questions_with_orjson_encoder_returns_the_same_response_as_the_default_encoder(self):
+        if importlib.util.find_spec('orjson') is None:
+            self.skipTest('orjson is not installed')
+        default_response = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'JSON_ENCODER': 'default'}).test_client().get('/questions?page=1')
+        orjson_response = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'JSON_ENCODER': 'orjson'}).test_client().get('/questions?page=1')
+
+        self.assertEqual(orjson_response.status_code, 200)
+        self.assertEqual(json.loads(orjson_response.data), json.loads(default_response.data))
+        self.assertEqual(list(json.loads(orjson_response.data)['categories']), list(json.loads(default_response.data)['categories']))
+
+    def test_get_questions_returns_the_same_questions_as_question_format(self):
+        res = self.client().get('/questions?page=1')
+        response_body = json.loads(res.data)
+        with self.app.app_context():
+            expected_questions = [question.format() for question in Question.query.order_by(Question.id).limit(10)]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body['questions'], expected_questions)
+    #-------------------------------------------
+
+    # -------Test for DATABASE_INIT-------
+    def test_create_app_with_lazy_or_manual_database_init_does_not_connect_to_the_database(self):
+        unreachable_database_path = 'sqlite:////nonexistent-folder/trivia.db'
+        for database_init in ['lazy', 'manual']:
+            app = create_app({'SQLALCHEMY_DATABASE_URI': unreachable_database_path, 'DATABASE_INIT': database_init})
+
+            self.assertFalse(app.extensions.get('database_initialized'))
+
+    def test_first_request_with_lazy_database_init_creates_the_tables_once(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'DATABASE_INIT': 'lazy'})
+        first_response = app.test_client().get('/categories')
+        second_response = app.test_client().get('/categories')
+
+        self.assertTrue(app.extensions.get('database_initialized'))
+        self.assertNotEqual(first_response.status_code, 500)
+        self.assertEqual(second_response.status_code, first_response.status_code)
+    #-------------------------------------------
+
+    # -------Test for the async (ASGI) mode-------
+    def call_asgi_app(self, asgi_app, method, path, query_string=b'', json_body=None):
+        sent_messages = []
+        async def receive():
+            return {'type': 'http.request', 'body': json.dumps(json_body).encode('utf-8') if json_body is not None else b'', 'more_body': False}
+        async def send(message):
+            sent_messages.append(message)
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': [], 'client': ('127.0.0.1', 50000)}
+        asyncio.run(asgi_app(scope, receive, send))
+        return sent_messages[0]['status'], json.loads(sent_messages[1]['body'])
+    
+    # a Flask app and an async app on the same SQLite file, with the categories and questions of backend/data
+    def create_sqlite_flask_and_asgi_apps(self, **config):
+        from flaskr.asgi import create_asgi_app
+        from flaskr.bulk import import_categories, import_questions
+        database_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(database_folder.cleanup)
+        database_path = 'sqlite:///' + os.path.join(database_folder.name, 'trivia.db')
+        flask_app = create_app({'SQLALCHEMY_DATABASE_URI': database_path, 'DATABASE_INIT': 'eager', **config})
+        with flask_app.app_context():
+            with open(os.path.join(os.path.dirname(__file__), 'data', 'categories.ndjson'), 'rb') as categories_file:
+                import_categories(categories_file)
+            with open(os.path.join(os.path.dirname(__file__), 'data', 'questions.ndjson'), 'rb') as questions_file:
+                import_questions(questions_file)
+        return flask_app, create_asgi_app({'SQLALCHEMY_DATABASE_URI': database_path, **config})
+    
+    @unittest.skipUnless(importlib.util.find_spec('asyncpg'), 'the async mode needs asyncpg')
+    def test_async_mode_returns_the_same_categories_and_questions_as_the_flask_app(self):
+        from flaskr.asgi import create_asgi_app
+        asgi_app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+        
+        self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/categories'), (200, json.loads(self.client().get('/categories').data)))
+        self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/questions', b'page=2'), (200, json.loads(self.client().get('/questions?page=2').data)))
+        self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/categories/1000/questions')[0], 422)
+    
+    @unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'the async mode on SQLite needs aiosqlite')
+    def test_async_mode_on_sqlite_returns_the_same_json_as_the_flask_app(self):
+        flask_app, asgi_app = self.create_sqlite_flask_and_asgi_apps()
+        flask_client = flask_app.test_client()
+        
+        self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/categories'), (200, json.loads(flask_client.get('/categories').data)))
+        self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/questions', b'page=2'), (200, json.loads(flask_client.get('/questions?page=2').data)))
+        self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/categories/1/questions', b'after_id=0&per_page=2'),
+                         (200, json.loads(flask_client.get('/categories/1/questions?after_id=0&per_page=2').data)))
+        self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/categories/1000/questions')[0], 422)
+        # the category id comes as a string from the frontend, and must be an integer
+        status, response_body = self.call_asgi_app(asgi_app, 'POST', '/quizzes', json_body={'quiz_category': {'id': '1', 'type': 'Science'}, 'previous_questions': ['1']})
+        self.assertEqual(status, 200)
+        self.assertEqual(response_body['question']['category'], 1)
+        self.assertEqual(self.call_asgi_app(asgi_app, 'POST', '/quizzes', json_body={'quiz_category': {'id': 'one', 'type': 'Science'}})[0], 400)
+        self.assertEqual(self.call_asgi_app(asgi_app, 'POST', '/questions', json_body={**self.new_question, 'difficulty': 'hard'})[0], 400)
+    
+    @unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'the async mode on SQLite needs aiosqlite')
+    def test_async_mode_drops_the_cached_pages_a_new_question_changes(self):
+        _, asgi_app = self.create_sqlite_flask_and_asgi_apps(RESPONSE_CACHE_SECONDS=60)
+        total_questions = self.call_asgi_app(asgi_app, 'GET', '/questions')[1]['total_questions']
+        category_total = self.call_asgi_app(asgi_app, 'GET', '/categories/5/questions')[1]['total_questions']
+        
+        status, _ = self.call_asgi_app(asgi_app, 'POST', '/questions', json_body=self.new_question)
+        
+        self.assertEqual(status, 201)
+        self.assertEqual(asgi_app.response_cache.stats()['misses'], 2)
+        self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/questions')[1]['total_questions'], total_questions + 1)
+        self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/categories/5/questions')[1]['total_questions'], category_total + 1)
+        self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/questions')[1]['total_questions'], total_questions + 1)
+        self.assertEqual(asgi_app.response_cache.stats()['hits'], 1)
+    
+    @unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'the async mode on SQLite needs aiosqlite')
+    def test_async_mode_rate_limits_the_quiz_like_the_flask_app(self):
+        _, asgi_app = self.create_sqlite_flask_and_asgi_apps(RATE_LIMIT_PER_SECOND=0.01, RATE_LIMIT_BURST=1)
+        quiz_request = {'quiz_category': {'id': 1, 'type': 'Science'}, 'previous_questions': []}
+        
+        self.assertEqual(self.call_asgi_app(asgi_app, 'POST', '/quizzes', json_body=quiz_request)[0], 200)
+        self.assertEqual(self.call_asgi_app(asgi_app, 'POST', '/quizzes', json_body=quiz_request), (429, {'success': False, 'error': 429, 'message': 'Too Many Requests'}))
+
+    def run_asgi_lifespan(self, asgi_app):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        async def receive():
+            return messages.pop(0)
+        async def send(message):
+            pass
+        asyncio.run(asgi_app({'type': 'lifespan'}, receive, send))
+
+    @unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'the async mode on SQLite needs aiosqlite')
+    def test_async_mode_creates_the_tables_according_to_database_init(self):
+        from flaskr.asgi import create_asgi_app
+        database_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(database_folder.cleanup)
+        def list_tables(database_name):
+            with sqlite3.connect(os.path.join(database_folder.name, database_name)) as connection:
+                return [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        manual_app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(database_folder.name, 'manual.db'), 'DATABASE_INIT': 'manual'})
+        eager_app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(database_folder.name, 'eager.db'), 'DATABASE_INIT': 'eager'})
+        lazy_app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(database_folder.name, 'lazy.db'), 'DATABASE_INIT': 'lazy'})
+        self.run_asgi_lifespan(manual_app)
+        self.run_asgi_lifespan(eager_app)
+        self.run_asgi_lifespan(lazy_app)
+
+        self.assertEqual(list_tables('manual.db'), [])
+        self.assertIn('questions', list_tables('eager.db'))
+        self.assertEqual(list_tables('lazy.db'), [])
+        self.assertEqual(self.call_asgi_app(lazy_app, 'GET', '/categories')[0], 404)
+        self.assertIn('questions', list_tables('lazy.db'))
+
+    @unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'the async mode on SQLite needs aiosqlite')
+    def test_async_mode_logs_the_exceptions_it_turns_into_500(self):
+        _, asgi_app = self.create_sqlite_flask_and_asgi_apps()
+        async def failing_handler(request, session):
+            raise RuntimeError('handler failed')
+        asgi_app.routes.append(('GET', '/failing', failing_handler, {}))
+
+        with self.assertLogs('flaskr.asgi', level='ERROR') as logs:
+            self.assertEqual(self.call_asgi_app(asgi_app, 'GET', '/failing'), (500, {'success': False, 'error': 500, 'message': 'Internal Server Error'}))
+        self.assertIn('handler failed', logs.output[0])
+    #-------------------------------------------
+    
+    # -------Test for /quizzes/sessions endpoints-------
+    def test_create_a_quiz_session_then_ask_every_question_of_the_category_once_then_None(self):
+        res = self.client().post('/quizzes/sessions', json={'quiz_category': {'id': 1, 'type': 'Science'}})
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 201)
+        self.assertTrue(response_body['success'])
+        self.assertTrue(response_body['session_id'])
+        self.assertGreater(response_body['total_questions'], 0)
+        
+        asked_question_ids = []
+        for _ in range(response_body['total_questions']):
+            next_question = json.loads(self.client().post('/quizzes/sessions/{}/next'.format(response_body['session_id'])).data)['question']
+            if next_question:
+                self.assertEqual(int(next_question['category']), 1)
+                asked_question_ids.append(next_question['id'])
+        last_response_body = json.loads(self.client().post('/quizzes/sessions/{}/next'.format(response_body['session_id'])).data)
+        
+        self.assertEqual(len(asked_question_ids), len(set(asked_question_ids)))
+        self.assertIsNone(last_response_body['question'])
+    
+    def test_create_a_quiz_session_without_quiz_category_returns_400(self):
+        res = self.client().post('/quizzes/sessions', json={'previous_questions': []})
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(response_body['success'])
+        self.assertEqual(response_body['message'], 'Bad Request')
+    
+    def test_get_next_question_of_a_quiz_session_that_does_not_exist_returns_404(self):
+        res = self.client().post('/quizzes/sessions/does-not-exist/next')
+        response_body = json.loads(res.data)
+        
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(response_body['success'])
+        self.assertEqual(response_body['message'], 'Resource Not Found')
+
+    def ask_every_question_concurrently(self, quiz_session_store, question_ids):
+        from flaskr.quiz_sessions import QuizSession
+        quiz_session_store.save('concurrent', QuizSession.create(1, question_ids))
+        asked_question_ids = []
+        def ask_questions():
+            while True:
+                question_id, _ = quiz_session_store.next_question_id('concurrent')
+                if question_id is None:
+                    return
+                asked_question_ids.append(question_id)
+        threads = [threading.Thread(target=ask_questions) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return asked_question_ids
+
+    def test_concurrent_next_questions_of_an_in_memory_quiz_session_are_all_different(self):
+        from flaskr.quiz_sessions import InMemoryQuizSessionStore
+        question_ids = list(range(1, 2001))
+        asked_question_ids = self.ask_every_question_concurrently(InMemoryQuizSessionStore(), question_ids)
+
+        self.assertEqual(sorted(asked_question_ids), question_ids)
+
+    @unittest.skipUnless(importlib.util.find_spec('fakeredis'), 'the Redis session store test needs fakeredis')
+    def test_concurrent_next_questions_of_a_redis_quiz_session_are_all_different(self):
+        import fakeredis
+        from flaskr.quiz_sessions import RedisQuizSessionStore
+        quiz_session_store = RedisQuizSessionStore(fakeredis.FakeRedis())
+        question_ids = list(range(1, 201))
+        asked_question_ids = self.ask_every_question_concurrently(quiz_session_store, question_ids)
+
+        self.assertEqual(sorted(asked_question_ids), question_ids)
+        self.assertEqual(quiz_session_store.next_question_id('concurrent'), (None, {'category_id': 1, 'total_questions': 200, 'asked_questions': 200}))
+        self.assertEqual(quiz_session_store.get('concurrent').format(), {'category_id': 1, 'total_questions': 200, 'asked_questions': 200})
+        self.assertIsNone(quiz_session_store.next_question_id('does-not-exist'))
     #-------------------------------------------
     
 # Make the tests conveniently executable